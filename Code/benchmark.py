@@ -0,0 +1,308 @@
+"""Benchmark suite of the simulation engines, mc_price and the payoffs.
+
+Every benchmark is timed separately for the first call (JIT compilation or loading from the Numba cache) and
+for the steady state (median over the repeated calls), and reports the throughput in paths per second, the peak RSS
+and a checksum of the result. The engines use the counter-based generator, so the checksums do not depend on
+the number of threads and can be compared against a stored baseline.
+
+Usage:
+    python benchmark.py --save-baseline Data/evaluation/benchmark_baseline.json
+    python benchmark.py --baseline Data/evaluation/benchmark_baseline.json --tolerance 0.15
+    python benchmark.py --cold --only euler qe
+    python benchmark.py --precompile
+    python benchmark.py --cold-start --cold
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import resource
+import subprocess
+
+import numpy as np
+
+from math import sqrt
+
+HESTON_PARAMS = [(1.3125, 0.5125, -0.3937, 0.0641, 0.3),   # from stoch vol
+                 (1.,     0.4,    -0.1,    0.2,    0.2),   # from school
+                 (0.5,    1.,     -0.9,    0.04,   0.04),  # from andersen paper 1
+                 (0.3,    0.9,    -0.5,    0.04,   0.04),  # from andersen paper 2
+                 (1.,     1.,     -0.3,    0.04,   0.09)]  # from andersen paper 3
+
+SEED = 42
+
+def _reset_peak_rss():
+    """Resets the peak RSS of the process where the OS allows it (Linux), so that it can be measured per benchmark."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as file:
+            file.write('5')
+        return True
+    except OSError:
+        return False
+
+def _peak_rss_mb() -> float:
+    """Peak RSS of the process in MB, since the last reset if it was possible."""
+    try:
+        with open('/proc/self/status') as file:
+            for line in file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])/1024.
+    except OSError:
+        pass
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss/1024.**2 if sys.platform == 'darwin' else maxrss/1024.
+
+def _checksum(result) -> float:
+    """Scalar summary of a result used to detect changes of the numbers."""
+    if isinstance(result, (list, tuple)):
+        result = result[0]
+    return float(np.mean(result))
+
+def make_benchmarks(n_simulations: int,
+                    N_T:           int,
+                    T:             float,
+                    params_n:      int,
+                    tg_tables:     str = None,
+                    storage_dtype: str = 'float64') -> dict:
+    """Builds the benchmarks.
+    Args:
+        n_simulations (int):           Number of simulations per engine call, the engines return 4*n_simulations paths.
+        N_T (int):                     Number of steps in time.
+        T (float):                     Maturity.
+        params_n (int):                Number of the Heston parameter set in HESTON_PARAMS, starting from 1.
+        tg_tables (str, optional):     Directory of the stored TG tables. Defaults to None (small tables are built in memory).
+        storage_dtype (str, optional): Floating-point type the full-path engines store the paths in, 'float64' or 'float32'.
+                                       A storage option only, the paths are integrated in double precision. Defaults to 'float64'.
+    Returns:
+        A dict name -> (callable, number of paths processed per call).
+    """
+    import hestonmc
+    import derivatives
+    from hestonmc import MarketState, HestonParameters, mc_price
+    from tg_tables import build_tg_tables, open_tg_tables
+
+    state  = MarketState(100., 0.)
+    params = HestonParameters(*HESTON_PARAMS[params_n - 1])
+    tables = open_tg_tables(tg_tables) if tg_tables is not None else build_tg_tables(N=100_000)
+    n_paths = 4*n_simulations
+    storage_dtype = np.dtype(storage_dtype).type
+
+    def engine(simulate, **kwargs):
+        return lambda: simulate(state=state, heston_params=params, T=T, N_T=N_T, n_simulations=n_simulations, seed=SEED, **kwargs)
+
+    benchmarks = {'euler':          (engine(hestonmc.simulate_heston_euler, storage_dtype=storage_dtype), n_paths),
+                  'qe':             (engine(hestonmc.simulate_heston_andersen_qe, storage_dtype=storage_dtype), n_paths),
+                  'qe_log_prices':  (engine(hestonmc.simulate_heston_andersen_qe, storage_dtype=storage_dtype, log_prices=True), n_paths),
+                  'tg':             (engine(hestonmc.simulate_heston_andersen_tg, storage_dtype=storage_dtype, **tables), n_paths),
+                  'em':             (engine(hestonmc.simulate_heston_em, storage_dtype=storage_dtype), n_paths),
+                  'euler_terminal': (engine(hestonmc.simulate_heston_euler_terminal), n_paths),
+                  'qe_terminal':    (engine(hestonmc.simulate_heston_andersen_qe_terminal), n_paths),
+                  'tg_terminal':    (engine(hestonmc.simulate_heston_andersen_tg_terminal, **tables), n_paths)}
+
+    def price():
+        return mc_price(payoff = derivatives.european_call_payoff(T, 100., state.interest_rate),
+                        simulate = hestonmc.simulate_heston_andersen_qe_terminal, state = state, heston_params = params,
+                        T = T, N_T = N_T, absolute_error = 0., batch_size = n_simulations, MAX_ITER = 1,
+                        random_seed = SEED, counter_rng = True)
+    benchmarks['mc_price'] = (price, n_paths)
+
+    # the payoffs get geometric Brownian paths, so that no engine is compiled or warmed up before its own benchmark
+    rng      = np.random.default_rng(SEED)
+    S        = 100.*np.exp(np.cumsum(0.2*sqrt(T/N_T)*rng.standard_normal((n_paths, N_T)), axis=1))
+    strikes  = np.linspace(60., 140., 32)
+    payoffs  = {'european_call':        derivatives.european_call_payoff(T, 100.),
+                'european_put':         derivatives.european_put_payoff(T, 100.),
+                'asian_call_AM':        derivatives.asian_call_AM_payoff(T, 100.),
+                'asian_put_AM':         derivatives.asian_put_AM_payoff(T, 100.),
+                'asian_call_GM':        derivatives.asian_call_GM_payoff(T, 100.),
+                'asian_put_GM':         derivatives.asian_put_GM_payoff(T, 100.),
+                'european_call_strikes': derivatives.european_call_strikes_payoff(T, strikes),
+                'asian_call_AM_strikes': derivatives.asian_call_AM_strikes_payoff(T, strikes)}
+    for name, payoff in payoffs.items():
+        benchmarks['payoff_' + name] = ((lambda payoff=payoff: hestonmc._payoff_values(payoff, S)), n_paths)
+
+    logS     = np.ascontiguousarray(np.log(S))
+    payoffs  = {'european_call_log':    derivatives.european_call_log_payoff(T, 100.),
+                'asian_call_AM_log':    derivatives.asian_call_AM_log_payoff(T, 100.),
+                'asian_call_GM_log':    derivatives.asian_call_GM_log_payoff(T, 100.)}
+    for name, payoff in payoffs.items():
+        benchmarks['payoff_' + name] = ((lambda payoff=payoff: hestonmc._payoff_values(payoff, logS)), n_paths)
+
+    return benchmarks
+
+def run_benchmark(func:   callable,
+                  n_paths: int,
+                  repeat: int) -> dict:
+    """Times one benchmark.
+    Args:
+        func (callable): The benchmark.
+        n_paths (int):   Number of paths processed per call.
+        repeat (int):    Number of the steady-state calls.
+    Returns:
+        A dict with the first call time, the median steady-state time, the throughput, the peak RSS and the checksum.
+    """
+    _reset_peak_rss()
+    st     = time.perf_counter()
+    result = func()
+    first  = time.perf_counter() - st
+
+    times = []
+    for _ in range(repeat):
+        st     = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - st)
+    steady = float(np.median(times))
+
+    return {'first_call_s':    first,
+            'compile_s':       max(first - steady, 0.),
+            'steady_s':        steady,
+            'paths_per_s':     n_paths/steady,
+            'peak_rss_mb':     _peak_rss_mb(),
+            'checksum':        _checksum(result)}
+
+COLD_START_SCRIPT = """
+import sys, time, json
+st = time.perf_counter()
+import hestonmc
+import derivatives
+imported = time.perf_counter() - st
+state  = hestonmc.MarketState(100., 0.)
+params = hestonmc.HestonParameters(*{params})
+price  = hestonmc.mc_price(payoff = derivatives.european_call_payoff({T}, 100.), simulate = hestonmc.simulate_heston_andersen_qe,
+                           state = state, heston_params = params, T = {T}, N_T = {N_T}, absolute_error = 0., batch_size = {n_simulations},
+                           MAX_ITER = 1, random_seed = {seed}, counter_rng = True)
+json.dump({{'import_s': imported, 'first_price_s': time.perf_counter() - st, 'price': float(price)}}, sys.stdout)
+"""
+
+def cold_start(n_simulations: int,
+               N_T:           int,
+               T:             float,
+               params_n:      int) -> dict:
+    """Measures the start of a short-lived pricing worker: a new interpreter imports hestonmc and derivatives and prices
+       one European call with mc_price. Run after --precompile it measures loading from the Numba cache, with --cold
+       the full compilation.
+    Args:
+        n_simulations (int): Number of simulations of the batch.
+        N_T (int):           Number of steps in time.
+        T (float):           Maturity.
+        params_n (int):      Number of the Heston parameter set in HESTON_PARAMS, starting from 1.
+    Returns:
+        A dict with the import time, the time from the start of the import to the first price (both measured inside the worker),
+        the wall time of the whole process including the interpreter start and the price.
+    """
+    script = COLD_START_SCRIPT.format(params=HESTON_PARAMS[params_n - 1], T=T, N_T=N_T, n_simulations=n_simulations, seed=SEED)
+    st     = time.perf_counter()
+    out    = subprocess.run([sys.executable, '-c', script], cwd=os.path.dirname(os.path.abspath(__file__)),
+                            capture_output=True, text=True, check=True).stdout
+    result = json.loads(out)
+    result['process_s'] = time.perf_counter() - st
+    return result
+
+def compare(results:   dict,
+            baseline:  dict,
+            tolerance: float,
+            rtol:      float = 1e-6) -> list:
+    """Compares the results with the baseline.
+    Args:
+        results (dict):          Results of run_benchmark keyed by the benchmark name.
+        baseline (dict):         Stored results.
+        tolerance (float):       Allowed relative drop of the throughput.
+        rtol (float, optional):  Allowed relative change of the checksum. Defaults to 1e-6.
+    Returns:
+        The list of messages about the regressions, empty if there are none.
+    """
+    problems = []
+    for name, res in results.items():
+        if name not in baseline:
+            continue
+        base = baseline[name]
+        if res['paths_per_s'] < (1. - tolerance)*base['paths_per_s']:
+            problems.append(f"{name}: throughput {res['paths_per_s']:.3g} paths/s is {1 - res['paths_per_s']/base['paths_per_s']:.0%} "
+                            f"below the baseline {base['paths_per_s']:.3g} paths/s")
+        if abs(res['checksum'] - base['checksum']) > rtol*max(abs(base['checksum']), 1e-12):
+            problems.append(f"{name}: checksum {res['checksum']!r} differs from the baseline {base['checksum']!r}")
+    return problems
+
+def _print_table(results: dict):
+    print(f"{'benchmark':<30}{'first call, s':>15}{'steady, s':>12}{'paths/s':>12}{'peak RSS, MB':>15}")
+    for name, res in results.items():
+        print(f"{name:<30}{res['first_call_s']:>15.3f}{res['steady_s']:>12.4f}{res['paths_per_s']:>12.3g}{res['peak_rss_mb']:>15.1f}")
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--only', nargs='+', default=None, help='Run only the benchmarks whose names start with one of these prefixes.')
+    parser.add_argument('--n-simulations', type=int, default=25_000, help='Simulations per engine call (4x paths). Default: 25000.')
+    parser.add_argument('--N-T', type=int, default=100, help='Number of steps in time. Default: 100.')
+    parser.add_argument('--T', type=float, default=1., help='Maturity. Default: 1.')
+    parser.add_argument('--params', type=int, default=3, help='Heston parameter set, 1..5 as in run_grid.ipynb. Default: 3.')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of steady-state calls. Default: 5.')
+    parser.add_argument('--storage-dtype', choices=['float64', 'float32'], default='float64', help='Floating-point type the full-path engines store the paths in. Default: float64.')
+    parser.add_argument('--tg-tables', default=None, help='Directory of the stored TG tables. Default: small tables built in memory.')
+    parser.add_argument('--cold', action='store_true', help='Use an empty Numba cache, so the first call measures the full compilation.')
+    parser.add_argument('--precompile', action='store_true', help='Compile the engines and the payoffs into the Numba cache (deploy step) and exit.')
+    parser.add_argument('--cold-start', action='store_true', help='Measure the import and the first price of a new process instead of the benchmarks.')
+    parser.add_argument('--baseline', default=None, help='Baseline json to check the results against.')
+    parser.add_argument('--tolerance', type=float, default=0.15, help='Allowed relative throughput drop. Default: 0.15.')
+    parser.add_argument('--save-baseline', default=None, help='Store the results as the baseline json.')
+    args = parser.parse_args(argv)
+
+    if args.cold:
+        os.environ['NUMBA_CACHE_DIR'] = tempfile.mkdtemp(prefix='numba_cache_')
+
+    if args.precompile:
+        import hestonmc
+        st    = time.perf_counter()
+        count = hestonmc.precompile(storage_dtypes=(None, np.dtype(args.storage_dtype).type), verbose=True)
+        print(f"Compiled {count} specialisations in {time.perf_counter() - st:.1f} s")
+        return 0
+
+    if args.cold_start:
+        result = cold_start(args.n_simulations, args.N_T, args.T, args.params)
+        print(f"import: {result['import_s']:.3f} s, first price: {result['first_price_s']:.3f} s, "
+              f"process: {result['process_s']:.3f} s, price: {result['price']:.4f}")
+        if args.save_baseline is not None:
+            baseline = {}
+            if os.path.exists(args.save_baseline):
+                with open(args.save_baseline) as file:
+                    baseline = json.load(file)
+            baseline['cold_start'] = result
+            with open(args.save_baseline, 'w') as file:
+                json.dump(baseline, file, indent=4)
+        return 0
+
+    benchmarks = make_benchmarks(args.n_simulations, args.N_T, args.T, args.params, args.tg_tables, args.storage_dtype)
+    if args.only is not None:
+        benchmarks = {name: b for name, b in benchmarks.items() if any(name.startswith(prefix) for prefix in args.only)}
+
+    results = {}
+    for name, (func, n_paths) in benchmarks.items():
+        results[name] = run_benchmark(func, n_paths, args.repeat)
+    _print_table(results)
+
+    if args.save_baseline is not None:
+        import numba
+        meta = {'n_simulations': args.n_simulations, 'N_T': args.N_T, 'T': args.T, 'params': args.params, 'storage_dtype': args.storage_dtype,
+                'machine': platform.machine(), 'processor': platform.processor(), 'threads': numba.config.NUMBA_NUM_THREADS,
+                'numba': numba.__version__, 'numpy': np.__version__}
+        with open(args.save_baseline, 'w') as file:
+            json.dump({'meta': meta, 'results': results}, file, indent=4)
+
+    if args.baseline is not None:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        meta     = baseline['meta']
+        if ((meta['n_simulations'], meta['N_T'], meta['T'], meta['params'], meta.get('storage_dtype', 'float64'))
+                != (args.n_simulations, args.N_T, args.T, args.params, args.storage_dtype)):
+            print("The baseline was recorded with other settings, rerun with the same ones or store a new baseline.")
+            return 2
+        problems = compare(results, baseline['results'], args.tolerance)
+        for problem in problems:
+            print("REGRESSION", problem)
+        return 1 if problems else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
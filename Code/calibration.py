@@ -0,0 +1,234 @@
+import os
+import numpy as np
+
+from collections import namedtuple
+from multiprocessing import get_context
+from concurrent.futures import Executor, ProcessPoolExecutor
+
+from hestonmc import MarketState, HestonParameters
+from hestoncos import _char_func, _char_func_gradient, _cos_series, _cos_put_weights
+
+if __name__ == '__main__':
+    print("This is a module. Please import it.\n")
+    exit(-1)
+
+PARAMETER_NAMES = HestonParameters._fields   # kappa, gamma, rho, vbar, v0
+LOWER_BOUNDS    = np.array([1e-3, 1e-2, -0.999, 1e-4, 1e-4])
+UPPER_BOUNDS    = np.array([20.,  5.,    0.999, 1.,   1.])
+START_BOX       = (np.array([0.2, 0.1, -0.9, 0.01, 0.01]),   # multi-start points are drawn uniformly from this box
+                   np.array([5.,  1.5,  0.2, 0.2,  0.2]))
+
+CalibrationResult = namedtuple('CalibrationResult', ['heston_params', 'rmse', 'residuals', 'n_evaluations', 'success', 'starts'])
+
+def _option_flags(option_types, n):
+    """Boolean array of the calls from 'call'/'put' given once or per quote."""
+    types = np.broadcast_to(np.asarray(option_types), (n,))
+    if not np.all(np.isin(types, ('call', 'put'))):
+        raise ValueError("Unknown option type, expected 'call' or 'put'.")
+    return types == 'call'
+
+def _cos_grids(r, maturities, theta, N, L, tol):
+    """Truncation ranges [a, b] and numbers of terms of the COS method at the parameters theta (see _cos_series),
+       one triple (a, b, n) per unique maturity in ascending order."""
+    grids = []
+    for T in np.unique(maturities):
+        a, b, u, _ = _cos_series(lambda u: _char_func(u, T, r, *theta), N, L, tol)
+        grids.append((a, b, len(u)))
+    return grids
+
+def _surface(s0, r, strikes, maturities, is_call, grids):
+    """Precomputes the pricing of the quotes with the COS method, one block per maturity: the indices of its quotes,
+       the truncation range [a, b] and the frequencies of _cos_grids and the put weights of _cos_put_weights.
+       The weights do not depend on the parameters, so an evaluation of the prices and their gradients costs
+       one characteristic function and one matrix product per maturity.
+    """
+    blocks = []
+    for T, (a, b, n) in zip(np.unique(maturities), grids):
+        idx  = np.flatnonzero(maturities == T)
+        u    = np.arange(n)*np.pi/(b - a)
+        K    = strikes[idx]
+        DF   = np.exp(-r*T)
+        blocks.append({'idx':    idx,
+                       'T':      T,
+                       'a':      a,
+                       'b':      b,
+                       'u':      u,
+                       'shift':  np.exp(-1j*u*a),
+                       'W':      _cos_put_weights(a, b, u, np.log(s0/K)),
+                       'scale':  DF*K,
+                       'offset': np.where(is_call[idx], s0 - K*DF, 0.)})
+    return blocks
+
+def _surface_prices(theta, r, blocks, n_quotes):
+    """Prices of the quotes of _surface at the parameters theta and their Jacobian of shape (n_quotes, 5).
+       The truncation range is fixed, so the price is a smooth function of theta and the Jacobian follows from the derivatives
+       of the characteristic function in the cosine coefficients.
+    """
+    prices = np.empty(n_quotes)
+    jac    = np.empty((n_quotes, len(theta)))
+    for block in blocks:
+        phi, dphi = _char_func_gradient(block['u'], block['T'], r, *theta)
+        c         = 2./(block['b'] - block['a'])
+        A         = c*(phi*block['shift']).real
+        dA        = c*(dphi*block['shift']).real
+        A[0]     *= 0.5
+        dA[:, 0] *= 0.5
+
+        idx         = block['idx']
+        prices[idx] = block['scale']*(block['W'] @ A) + block['offset']
+        jac[idx]    = block['scale'][:, None]*(block['W'] @ dA.T)
+    return prices, jac
+
+def heston_prices_and_gradients(state:         MarketState,
+                                heston_params: HestonParameters,
+                                strikes:       np.ndarray,
+                                maturities:    np.ndarray,
+                                option_types:  str   = 'call',
+                                N:             int   = None,
+                                L:             float = 10.,
+                                tol:           float = 1e-4) -> tuple:
+    """Prices of a surface of European quotes with the COS method and their analytic gradients with respect to the parameters.
+    Args:
+        state (MarketState):                 Market state.
+        heston_params (HestonParameters):    Parameters of the Heston model.
+        strikes (np.ndarray):                Strikes of the quotes.
+        maturities (np.ndarray):             Maturities of the quotes, of the same length as strikes.
+        option_types (str, optional):        'call' or 'put', once or per quote. Defaults to 'call'.
+        N (int, optional):                   Number of terms of the cosine series. Defaults to None (chosen per maturity from tol
+                                             as in heston_cos_prices).
+        L (float, optional):                 Half-width of the truncation range in standard deviations. Defaults to 10..
+        tol (float, optional):               Threshold of the series truncation indicator if N is None. Defaults to 1e-4.
+    Raises:
+        ValueError: The strikes and the maturities differ in length or an option type is unknown.
+    Returns:
+        The prices of shape (n_quotes,) and the Jacobian of shape (n_quotes, 5), the columns in the order of PARAMETER_NAMES.
+    """
+    strikes, maturities = np.atleast_1d(np.asarray(strikes, dtype=np.float64)), np.atleast_1d(np.asarray(maturities, dtype=np.float64))
+    if strikes.shape != maturities.shape:
+        raise ValueError("The strikes and the maturities must have the same length.")
+    is_call = _option_flags(option_types, len(strikes))
+    theta   = np.array(heston_params, dtype=np.float64)
+    grids   = _cos_grids(state.interest_rate, maturities, theta, N, L, tol)
+    blocks  = _surface(state.stock_price, state.interest_rate, strikes, maturities, is_call, grids)
+    return _surface_prices(theta, state.interest_rate, blocks, len(strikes))
+
+def _calibrate_from(x0, s0, r, strikes, maturities, is_call, prices, weights, N, L, cos_tol, tol, max_nfev):
+    """Least-squares fit from one starting point. The truncation ranges and the numbers of terms are fixed during a run, so that
+       the objective and its Jacobian are exact; if the ones needed at the solution are not covered by the ones used, the run is
+       repeated from the solution with the widened grids. Returns the solution, the sum of the squared weighted residuals, the number of evaluations and the status.
+    """
+    from scipy.optimize import least_squares
+
+    x0     = np.clip(np.asarray(x0, dtype=np.float64), LOWER_BOUNDS, UPPER_BOUNDS)
+    grids  = _cos_grids(r, maturities, x0, N, L, cos_tol)
+    nfev   = 0
+    memo   = {}
+
+    def evaluate(theta):
+        key = theta.tobytes()
+        if key not in memo:
+            memo.clear()
+            model, jac = _surface_prices(theta, r, blocks, len(strikes))
+            memo[key]  = (weights*(model - prices), weights[:, None]*jac)
+        return memo[key]
+
+    for _ in range(3):
+        blocks = _surface(s0, r, strikes, maturities, is_call, grids)
+        memo.clear()
+        res    = least_squares(lambda theta: evaluate(theta)[0], x0, jac=lambda theta: evaluate(theta)[1],
+                               bounds=(LOWER_BOUNDS, UPPER_BOUNDS), method='trf', x_scale='jac',
+                               ftol=tol, xtol=tol, gtol=tol, max_nfev=max_nfev)
+        nfev  += res.nfev
+        x0     = res.x
+        new    = _cos_grids(r, maturities, x0, N, L, cos_tol)
+        if all(a_new >= a and b_new <= b and n_new <= n for (a_new, b_new, n_new), (a, b, n) in zip(new, grids)):
+            break
+        grids  = [(min(a_new, a), max(b_new, b), max(n_new, n)) for (a_new, b_new, n_new), (a, b, n) in zip(new, grids)]
+    return res.x, 2.*res.cost, nfev, res.success
+
+def calibrate_heston(state:        MarketState,
+                     strikes:      np.ndarray,
+                     maturities:   np.ndarray,
+                     prices:       np.ndarray,
+                     option_types: str              = 'call',
+                     weights:      np.ndarray       = None,
+                     initial:      HestonParameters = None,
+                     n_starts:     int              = None,
+                     n_workers:    int              = None,
+                     pool:         Executor         = None,
+                     start_method: str              = 'spawn',
+                     random_seed:  int              = None,
+                     N:            int              = None,
+                     L:            float            = 10.,
+                     cos_tol:      float            = 1e-4,
+                     tol:          float            = 1e-10,
+                     max_nfev:     int              = 200) -> CalibrationResult:
+    """Fits kappa, gamma, rho, vbar, v0 to a surface of European option quotes by weighted least squares of the price errors
+       (trust region reflective with bounds, scipy.optimize.least_squares). The model prices and their analytic Jacobian come from
+       the COS method (see heston_prices_and_gradients), with the payoff weights precomputed once per run.
+       The previous solution (e.g. the one of the previous day) is passed as initial and is the first starting point; the other
+       starting points are drawn from START_BOX and the runs are spread over worker processes.
+    Args:
+        state (MarketState):             Market state.
+        strikes (np.ndarray):            Strikes of the quotes.
+        maturities (np.ndarray):         Maturities of the quotes.
+        prices (np.ndarray):             Market prices of the quotes.
+        option_types (str, optional):    'call' or 'put', once or per quote. Defaults to 'call'.
+        weights (np.ndarray, optional):  Weights of the price errors, e.g. 1/vega to approximate the fit of the implied volatilities.
+                                         Defaults to None (equal weights).
+        initial (HestonParameters, optional): Warm start. Defaults to None.
+        n_starts (int, optional):        Number of starting points. Defaults to None (1 with a warm start, 8 without).
+        n_workers (int, optional):       Number of worker processes for the starts. Defaults to None (the number of CPUs).
+        pool (Executor, optional):       Executor to run the starts in, kept between the calls (e.g. intraday), so that the start
+                                         of the processes is paid once. Defaults to None (a new pool if there are several starts).
+        start_method (str, optional):    Start method of the processes of the new pool. 'fork' starts faster, but hangs at exit if this
+                                         process has already run parallel Numba code (see grid_runner.run_grid). Defaults to 'spawn'.
+        random_seed (int, optional):     Seed of the starting points. Defaults to None.
+        N (int, optional):               Number of terms of the cosine series. Defaults to None (chosen per maturity from cos_tol).
+        L (float, optional):             Half-width of the truncation range in standard deviations. Defaults to 10..
+        cos_tol (float, optional):       Threshold of the series truncation indicator if N is None (see heston_cos_prices). Defaults to 1e-4.
+        tol (float, optional):           Tolerances ftol, xtol and gtol of least_squares. Defaults to 1e-10.
+        max_nfev (int, optional):        Maximum number of evaluations per start. Defaults to 200.
+    Raises:
+        ValueError: The quotes differ in length, an option type is unknown or there are fewer quotes than parameters.
+    Returns:
+        CalibrationResult with the fitted HestonParameters, the root mean square of the weighted price errors,
+        the weighted price errors (model - market), the total number of evaluations, the status of the best run and
+        the (parameters, sum of the squared errors) of every start.
+    """
+    strikes    = np.atleast_1d(np.asarray(strikes, dtype=np.float64))
+    maturities = np.atleast_1d(np.asarray(maturities, dtype=np.float64))
+    prices     = np.atleast_1d(np.asarray(prices, dtype=np.float64))
+    if not strikes.shape == maturities.shape == prices.shape:
+        raise ValueError("The strikes, maturities and prices must have the same length.")
+    if len(prices) < len(PARAMETER_NAMES):
+        raise ValueError(f"At least {len(PARAMETER_NAMES)} quotes are needed to fit {len(PARAMETER_NAMES)} parameters.")
+    is_call = _option_flags(option_types, len(prices))
+    weights = np.ones_like(prices) if weights is None else np.broadcast_to(np.asarray(weights, dtype=np.float64), prices.shape)
+
+    if n_starts is None:
+        n_starts = 1 if initial is not None else 8
+    rng    = np.random.default_rng(random_seed)
+    starts = [np.array(initial, dtype=np.float64)] if initial is not None else []
+    starts += [START_BOX[0] + (START_BOX[1] - START_BOX[0])*rng.random(len(PARAMETER_NAMES)) for _ in range(n_starts - len(starts))]
+
+    args = (state.stock_price, state.interest_rate, strikes, maturities, is_call, prices, weights, N, L, cos_tol, tol, max_nfev)
+    if len(starts) == 1 or (pool is None and n_workers == 1):
+        runs = [_calibrate_from(x0, *args) for x0 in starts]
+    elif pool is not None:
+        runs = list(pool.map(_calibrate_from, starts, *[[arg]*len(starts) for arg in args]))
+    else:
+        n_workers = os.cpu_count() if n_workers is None else n_workers
+        with ProcessPoolExecutor(max_workers=min(n_workers, len(starts)), mp_context=get_context(start_method)) as executor:
+            runs = list(executor.map(_calibrate_from, starts, *[[arg]*len(starts) for arg in args]))
+
+    best          = min(runs, key=lambda run: run[1])
+    heston_params = HestonParameters(*best[0])
+    model, _      = heston_prices_and_gradients(state, heston_params, strikes, maturities, np.where(is_call, 'call', 'put'), N, L, cos_tol)
+    residuals     = weights*(model - prices)
+    return CalibrationResult(heston_params = heston_params,
+                             rmse          = float(np.sqrt(np.mean(residuals**2))),
+                             residuals     = residuals,
+                             n_evaluations = sum(run[2] for run in runs),
+                             success       = bool(best[3]),
+                             starts        = [(HestonParameters(*run[0]), run[1]) for run in runs])
@@ -6,70 +6,630 @@ if __name__ == '__main__':
     print("This is a module. Please import it.\n")
     exit(-1)
 
+# Every payoff family is one compiled kernel taking the contract terms (maturity, strike, interest rate, ...) as runtime arguments.
+# A factory returns a Payoff, a plain Python callable binding the terms, so a new strike or maturity reuses the cached kernel
+# and compiles nothing. Compiled code takes the kernel and the terms of a payoff instead, e.g. payoff.kernel(S, *payoff.terms).
+
+class Payoff:
+    """A contract of a payoff family, payoff(S) being kernel(S, *terms). Carries the description of the contract, so that its
+       closed-form price can be looked up when it is used as a control variate (see hestoncos.control_variate_mean).
+       The payoffs of the full paths and of the path summaries of the terminal engines that pay the same have the same name,
+       the strike families carry the array of strikes.
+    """
+    def __init__(self, kernel, terms, contract):
+        self.__name__ = kernel.__name__.lstrip('_')
+        self.kernel   = kernel
+        self.terms    = terms
+        self.contract = contract
+
+    def __call__(self, S):
+        return self.kernel(S, *self.terms)
+
+    def __repr__(self):
+        return f"{self.__name__}{self.terms}"
+
+def _contract(kernel:        callable,
+              terms:         tuple,
+              name:          str,
+              maturity:      float,
+              strike:        float,
+              interest_rate: float,
+              **extra) -> Payoff:
+    return Payoff(kernel, terms, {'name': name, 'maturity': maturity, 'strike': strike, 'interest_rate': interest_rate, **extra})
+
+@njit(parallel=True, cache=True)
+def _terminal_stock(S:             np.ndarray,
+                    maturity:      float,
+                    interest_rate: float):
+    DF = np.exp( - interest_rate * maturity)
+    return S[:, -1]*DF
+
+def terminal_stock_payoff(maturity: float,
+                          interest_rate: float = 0.):
+    maturity, interest_rate = float(maturity), float(interest_rate)
+    return _contract(_terminal_stock, (maturity, interest_rate),
+                     'terminal_stock', maturity, 0., interest_rate)
+
+@njit(parallel=True, cache=True)
+def _european_call(S:             np.ndarray,
+                   maturity:      float,
+                   strike:        float,
+                   interest_rate: float):
+    DF = np.exp( - interest_rate * maturity)
+    return np.maximum(S[:, -1] - strike, 0.)*DF
+
 def european_call_payoff(maturity: float,
                          strike: float,
                          interest_rate: float = 0.):
-    @njit(parallel=True, cache=True)
-    def european_call(S: np.ndarray):
-        DF = np.exp( - interest_rate * maturity)
-        return np.maximum(S[:, -1] - strike, 0.)*DF
+    maturity, strike, interest_rate = float(maturity), float(strike), float(interest_rate)
+    return _contract(_european_call, (maturity, strike, interest_rate),
+                     'european_call', maturity, strike, interest_rate)
 
-    return european_call
+@njit(parallel=True, cache=True)
+def _european_put(S:             np.ndarray,
+                  maturity:      float,
+                  strike:        float,
+                  interest_rate: float):
+    DF = np.exp( - interest_rate * maturity)
+    return np.maximum(strike - S[:, -1], 0.)*DF
 
 def european_put_payoff(maturity: float,
                         strike: float,
                         interest_rate: float = 0.):
-    @njit(parallel=True, cache=True)
-    def european_put(S: np.ndarray):
-        DF = np.exp( - interest_rate * maturity)
-        return np.maximum(strike - S[:, -1], 0.)*DF
+    maturity, strike, interest_rate = float(maturity), float(strike), float(interest_rate)
+    return _contract(_european_put, (maturity, strike, interest_rate),
+                     'european_put', maturity, strike, interest_rate)
 
-    return european_put
+@njit(parallel=True, cache=True)
+def _asian_call_AM(S:             np.ndarray,
+                   maturity:      float,
+                   strike:        float,
+                   interest_rate: float):
+    dt = maturity/np.shape(S)[1]
+    I = np.sum(S, axis=1) * dt
+    DF = np.exp( - interest_rate * maturity)
+    return np.maximum(I - strike, 0.)*DF
 
 def asian_call_AM_payoff(maturity: float,
                          strike: float,
                          interest_rate: float = 0.):
-    @njit(parallel=True, cache=True)
-    def asian_call_AM(S: np.ndarray):
-        dt = maturity/np.shape(S)[1]
-        I = np.sum(S, axis=1) * dt
-        DF = np.exp( - interest_rate * maturity)
-        return np.maximum(I - strike, 0.)*DF
+    maturity, strike, interest_rate = float(maturity), float(strike), float(interest_rate)
+    return _contract(_asian_call_AM, (maturity, strike, interest_rate),
+                     'asian_call_AM', maturity, strike, interest_rate)
 
-    return asian_call_AM
+@njit(parallel=True, cache=True)
+def _asian_put_AM(S:             np.ndarray,
+                  maturity:      float,
+                  strike:        float,
+                  interest_rate: float):
+    dt = maturity/np.shape(S)[1]
+    I = np.sum(S, axis=1) * dt
+    DF = np.exp( - interest_rate * maturity)
+    return np.maximum(strike - I, 0.)*DF
 
 def asian_put_AM_payoff(maturity: float,
                         strike: float,
                         interest_rate: float = 0.):
-    @njit(parallel=True, cache=True)
-    def asian_put_AM(S: np.ndarray):
-        dt = maturity/np.shape(S)[1]
-        I = np.sum(S, axis=1) * dt
-        DF = np.exp( - interest_rate * maturity)
-        return np.maximum(strike - I, 0.)*DF
+    maturity, strike, interest_rate = float(maturity), float(strike), float(interest_rate)
+    return _contract(_asian_put_AM, (maturity, strike, interest_rate),
+                     'asian_put_AM', maturity, strike, interest_rate)
 
-    return asian_put_AM
+@njit(parallel=True, cache=True)
+def _asian_call_GM(S:             np.ndarray,
+                   maturity:      float,
+                   strike:        float,
+                   interest_rate: float):
+    dt = maturity/np.shape(S)[1]
+    I = np.exp(np.sum(np.log(S), axis=1) * dt)
+    DF = np.exp( - interest_rate * maturity)
+    return np.maximum(I - strike, 0.)*DF
 
 def asian_call_GM_payoff(maturity: float,
                          strike: float,
                          interest_rate: float = 0.):
-    @njit(parallel=True, cache=True)
-    def asian_call_GM(S: np.ndarray):
-        dt = maturity/np.shape(S)[1]
-        I = np.exp(np.sum(np.log(S), axis=1) * dt)
-        DF = np.exp( - interest_rate * maturity)
-        return np.maximum(I - strike, 0.)*DF
+    maturity, strike, interest_rate = float(maturity), float(strike), float(interest_rate)
+    return _contract(_asian_call_GM, (maturity, strike, interest_rate),
+                     'asian_call_GM', maturity, strike, interest_rate)
 
-    return asian_call_GM
+@njit(parallel=True, cache=True)
+def _asian_put_GM(S:             np.ndarray,
+                  maturity:      float,
+                  strike:        float,
+                  interest_rate: float):
+    dt = maturity/np.shape(S)[1]
+    I = np.exp(np.sum(np.log(S), axis=1) * dt)
+    DF = np.exp( - interest_rate * maturity)
+    return np.maximum(strike - I, 0.)*DF
 
 def asian_put_GM_payoff(maturity: float,
                         strike: float,
                         interest_rate: float = 0.):
-    @njit(parallel=True, cache=True)
-    def asian_put_GM(S: np.ndarray):
-        dt = maturity/np.shape(S)[1]
-        I = np.exp(np.sum(np.log(S), axis=1) * dt)
-        DF = np.exp( - interest_rate * maturity)
-        return np.maximum(strike - I, 0.)*DF
-
-    return asian_put_GM
\ No newline at end of file
+    maturity, strike, interest_rate = float(maturity), float(strike), float(interest_rate)
+    return _contract(_asian_put_GM, (maturity, strike, interest_rate),
+                     'asian_put_GM', maturity, strike, interest_rate)
+
+# Payoffs evaluated on the path summary of the terminal engines (see the accumulators of hestonmc),
+# column is the position of the required accumulator in the accumulators array passed to the engine.
+
+@njit(parallel=True, cache=True)
+def _asian_call_AM_acc(S:             np.ndarray,
+                       maturity:      float,
+                       strike:        float,
+                       interest_rate: float,
+                       column:        int):
+    I = S[:, column] * maturity
+    DF = np.exp( - interest_rate * maturity)
+    return np.maximum(I - strike, 0.)*DF
+
+def asian_call_AM_acc_payoff(maturity: float,
+                             strike: float,
+                             interest_rate: float = 0.,
+                             column: int = 0):
+    maturity, strike, interest_rate, column = float(maturity), float(strike), float(interest_rate), int(column)
+    return _contract(_asian_call_AM_acc, (maturity, strike, interest_rate, column),
+                     'asian_call_AM', maturity, strike, interest_rate, column=column)
+
+@njit(parallel=True, cache=True)
+def _asian_put_AM_acc(S:             np.ndarray,
+                      maturity:      float,
+                      strike:        float,
+                      interest_rate: float,
+                      column:        int):
+    I = S[:, column] * maturity
+    DF = np.exp( - interest_rate * maturity)
+    return np.maximum(strike - I, 0.)*DF
+
+def asian_put_AM_acc_payoff(maturity: float,
+                            strike: float,
+                            interest_rate: float = 0.,
+                            column: int = 0):
+    maturity, strike, interest_rate, column = float(maturity), float(strike), float(interest_rate), int(column)
+    return _contract(_asian_put_AM_acc, (maturity, strike, interest_rate, column),
+                     'asian_put_AM', maturity, strike, interest_rate, column=column)
+
+@njit(parallel=True, cache=True)
+def _asian_call_GM_acc(S:             np.ndarray,
+                       maturity:      float,
+                       strike:        float,
+                       interest_rate: float,
+                       column:        int):
+    I = np.exp(S[:, column] * maturity)
+    DF = np.exp( - interest_rate * maturity)
+    return np.maximum(I - strike, 0.)*DF
+
+def asian_call_GM_acc_payoff(maturity: float,
+                             strike: float,
+                             interest_rate: float = 0.,
+                             column: int = 0):
+    maturity, strike, interest_rate, column = float(maturity), float(strike), float(interest_rate), int(column)
+    return _contract(_asian_call_GM_acc, (maturity, strike, interest_rate, column),
+                     'asian_call_GM', maturity, strike, interest_rate, column=column)
+
+@njit(parallel=True, cache=True)
+def _asian_put_GM_acc(S:             np.ndarray,
+                      maturity:      float,
+                      strike:        float,
+                      interest_rate: float,
+                      column:        int):
+    I = np.exp(S[:, column] * maturity)
+    DF = np.exp( - interest_rate * maturity)
+    return np.maximum(strike - I, 0.)*DF
+
+def asian_put_GM_acc_payoff(maturity: float,
+                            strike: float,
+                            interest_rate: float = 0.,
+                            column: int = 0):
+    maturity, strike, interest_rate, column = float(maturity), float(strike), float(interest_rate), int(column)
+    return _contract(_asian_put_GM_acc, (maturity, strike, interest_rate, column),
+                     'asian_put_GM', maturity, strike, interest_rate, column=column)
+
+@njit(parallel=True, cache=True)
+def _lookback_call_acc(S:             np.ndarray,
+                       maturity:      float,
+                       strike:        float,
+                       interest_rate: float,
+                       column:        int):
+    DF = np.exp( - interest_rate * maturity)
+    return np.maximum(S[:, column] - strike, 0.)*DF
+
+def lookback_call_acc_payoff(maturity: float,
+                             strike: float,
+                             interest_rate: float = 0.,
+                             column: int = 0):
+    maturity, strike, interest_rate, column = float(maturity), float(strike), float(interest_rate), int(column)
+    return _contract(_lookback_call_acc, (maturity, strike, interest_rate, column),
+                     'lookback_call', maturity, strike, interest_rate, column=column)
+
+@njit(parallel=True, cache=True)
+def _lookback_put_acc(S:             np.ndarray,
+                      maturity:      float,
+                      strike:        float,
+                      interest_rate: float,
+                      column:        int):
+    DF = np.exp( - interest_rate * maturity)
+    return np.maximum(strike - S[:, column], 0.)*DF
+
+def lookback_put_acc_payoff(maturity: float,
+                            strike: float,
+                            interest_rate: float = 0.,
+                            column: int = 0):
+    maturity, strike, interest_rate, column = float(maturity), float(strike), float(interest_rate), int(column)
+    return _contract(_lookback_put_acc, (maturity, strike, interest_rate, column),
+                     'lookback_put', maturity, strike, interest_rate, column=column)
+
+@njit(parallel=True, cache=True)
+def _barrier_out_call_acc(S:             np.ndarray,
+                          maturity:      float,
+                          strike:        float,
+                          interest_rate: float,
+                          column:        int):
+    DF = np.exp( - interest_rate * maturity)
+    return (1. - S[:, column])*np.maximum(S[:, -1] - strike, 0.)*DF
+
+def barrier_out_call_acc_payoff(maturity: float,
+                                strike: float,
+                                interest_rate: float = 0.,
+                                column: int = 0):
+    maturity, strike, interest_rate, column = float(maturity), float(strike), float(interest_rate), int(column)
+    return _contract(_barrier_out_call_acc, (maturity, strike, interest_rate, column),
+                     'barrier_out_call', maturity, strike, interest_rate, column=column)
+
+@njit(parallel=True, cache=True)
+def _barrier_out_put_acc(S:             np.ndarray,
+                         maturity:      float,
+                         strike:        float,
+                         interest_rate: float,
+                         column:        int):
+    DF = np.exp( - interest_rate * maturity)
+    return (1. - S[:, column])*np.maximum(strike - S[:, -1], 0.)*DF
+
+def barrier_out_put_acc_payoff(maturity: float,
+                               strike: float,
+                               interest_rate: float = 0.,
+                               column: int = 0):
+    maturity, strike, interest_rate, column = float(maturity), float(strike), float(interest_rate), int(column)
+    return _contract(_barrier_out_put_acc, (maturity, strike, interest_rate, column),
+                     'barrier_out_put', maturity, strike, interest_rate, column=column)
+
+
+# Payoff families evaluated for a whole vector of strikes at once (see mc_price_strikes of hestonmc),
+# the payoffs return the matrix of discounted payoffs of shape (n_paths, len(strikes)).
+
+@njit(parallel=True, cache=True)
+def _european_call_strikes(S:             np.ndarray,
+                           maturity:      float,
+                           strikes:       np.ndarray,
+                           interest_rate: float):
+    DF = np.exp( - interest_rate * maturity)
+    out = np.empty((S.shape[0], strikes.shape[0]))
+    for i in prange(S.shape[0]):
+        for k in range(strikes.shape[0]):
+            out[i, k] = max(S[i, -1] - strikes[k], 0.)*DF
+    return out
+
+def european_call_strikes_payoff(maturity: float,
+                                 strikes: np.ndarray,
+                                 interest_rate: float = 0.):
+    maturity, strikes, interest_rate = float(maturity), np.ascontiguousarray(strikes, dtype=np.float64), float(interest_rate)
+    return _contract(_european_call_strikes, (maturity, strikes, interest_rate),
+                     'european_call_strikes', maturity, strikes, interest_rate)
+
+@njit(parallel=True, cache=True)
+def _european_put_strikes(S:             np.ndarray,
+                          maturity:      float,
+                          strikes:       np.ndarray,
+                          interest_rate: float):
+    DF = np.exp( - interest_rate * maturity)
+    out = np.empty((S.shape[0], strikes.shape[0]))
+    for i in prange(S.shape[0]):
+        for k in range(strikes.shape[0]):
+            out[i, k] = max(strikes[k] - S[i, -1], 0.)*DF
+    return out
+
+def european_put_strikes_payoff(maturity: float,
+                                strikes: np.ndarray,
+                                interest_rate: float = 0.):
+    maturity, strikes, interest_rate = float(maturity), np.ascontiguousarray(strikes, dtype=np.float64), float(interest_rate)
+    return _contract(_european_put_strikes, (maturity, strikes, interest_rate),
+                     'european_put_strikes', maturity, strikes, interest_rate)
+
+@njit(parallel=True, cache=True)
+def _asian_call_AM_strikes(S:             np.ndarray,
+                           maturity:      float,
+                           strikes:       np.ndarray,
+                           interest_rate: float):
+    dt = maturity/np.shape(S)[1]
+    DF = np.exp( - interest_rate * maturity)
+    out = np.empty((S.shape[0], strikes.shape[0]))
+    for i in prange(S.shape[0]):
+        I = np.sum(S[i]) * dt
+        for k in range(strikes.shape[0]):
+            out[i, k] = max(I - strikes[k], 0.)*DF
+    return out
+
+def asian_call_AM_strikes_payoff(maturity: float,
+                                 strikes: np.ndarray,
+                                 interest_rate: float = 0.):
+    maturity, strikes, interest_rate = float(maturity), np.ascontiguousarray(strikes, dtype=np.float64), float(interest_rate)
+    return _contract(_asian_call_AM_strikes, (maturity, strikes, interest_rate),
+                     'asian_call_AM_strikes', maturity, strikes, interest_rate)
+
+@njit(parallel=True, cache=True)
+def _asian_put_AM_strikes(S:             np.ndarray,
+                          maturity:      float,
+                          strikes:       np.ndarray,
+                          interest_rate: float):
+    dt = maturity/np.shape(S)[1]
+    DF = np.exp( - interest_rate * maturity)
+    out = np.empty((S.shape[0], strikes.shape[0]))
+    for i in prange(S.shape[0]):
+        I = np.sum(S[i]) * dt
+        for k in range(strikes.shape[0]):
+            out[i, k] = max(strikes[k] - I, 0.)*DF
+    return out
+
+def asian_put_AM_strikes_payoff(maturity: float,
+                                strikes: np.ndarray,
+                                interest_rate: float = 0.):
+    maturity, strikes, interest_rate = float(maturity), np.ascontiguousarray(strikes, dtype=np.float64), float(interest_rate)
+    return _contract(_asian_put_AM_strikes, (maturity, strikes, interest_rate),
+                     'asian_put_AM_strikes', maturity, strikes, interest_rate)
+
+
+# Digital payoffs and the derivatives dpayoff/dS_T of the terminal payoffs used by the pathwise Greeks (see greeks.py),
+# the digitals are discontinuous, so their Greeks are computed with the likelihood-ratio weights instead.
+
+@njit(parallel=True, cache=True)
+def _digital_call(S:             np.ndarray,
+                  maturity:      float,
+                  strike:        float,
+                  interest_rate: float):
+    DF = np.exp( - interest_rate * maturity)
+    return np.where(S[:, -1] > strike, 1., 0.)*DF
+
+def digital_call_payoff(maturity: float,
+                        strike: float,
+                        interest_rate: float = 0.):
+    maturity, strike, interest_rate = float(maturity), float(strike), float(interest_rate)
+    return _contract(_digital_call, (maturity, strike, interest_rate),
+                     'digital_call', maturity, strike, interest_rate)
+
+@njit(parallel=True, cache=True)
+def _digital_put(S:             np.ndarray,
+                 maturity:      float,
+                 strike:        float,
+                 interest_rate: float):
+    DF = np.exp( - interest_rate * maturity)
+    return np.where(S[:, -1] < strike, 1., 0.)*DF
+
+def digital_put_payoff(maturity: float,
+                       strike: float,
+                       interest_rate: float = 0.):
+    maturity, strike, interest_rate = float(maturity), float(strike), float(interest_rate)
+    return _contract(_digital_put, (maturity, strike, interest_rate),
+                     'digital_put', maturity, strike, interest_rate)
+
+@njit(parallel=True, cache=True)
+def _european_call_pathwise(S:             np.ndarray,
+                            maturity:      float,
+                            strike:        float,
+                            interest_rate: float):
+    DF = np.exp( - interest_rate * maturity)
+    return np.where(S[:, -1] > strike, 1., 0.)*DF
+
+def european_call_pathwise_payoff(maturity: float,
+                                  strike: float,
+                                  interest_rate: float = 0.):
+    maturity, strike, interest_rate = float(maturity), float(strike), float(interest_rate)
+    return _contract(_european_call_pathwise, (maturity, strike, interest_rate),
+                     'european_call_pathwise', maturity, strike, interest_rate)
+
+@njit(parallel=True, cache=True)
+def _european_put_pathwise(S:             np.ndarray,
+                           maturity:      float,
+                           strike:        float,
+                           interest_rate: float):
+    DF = np.exp( - interest_rate * maturity)
+    return np.where(S[:, -1] < strike, -1., 0.)*DF
+
+def european_put_pathwise_payoff(maturity: float,
+                                 strike: float,
+                                 interest_rate: float = 0.):
+    maturity, strike, interest_rate = float(maturity), float(strike), float(interest_rate)
+    return _contract(_european_put_pathwise, (maturity, strike, interest_rate),
+                     'european_put_pathwise', maturity, strike, interest_rate)
+
+
+# Log-space payoffs evaluated on the log-prices logS returned by the full-path engines with log_prices (see mc_price of hestonmc),
+# they exponentiate only the prices they read, and the geometric averages are taken from the log-prices without any exponent.
+
+@njit(cache=True)
+def _price(logS: np.ndarray,
+           j:    int,
+           i:    int):
+    return np.exp(logS[j, i])
+
+@njit(cache=True)
+def _terminal(logS: np.ndarray):
+    return np.exp(logS[:, logS.shape[1] - 1])
+
+@njit(parallel=True, cache=True)
+def _terminal_stock_log(logS:          np.ndarray,
+                        maturity:      float,
+                        interest_rate: float):
+    DF = np.exp( - interest_rate * maturity)
+    return _terminal(logS)*DF
+
+def terminal_stock_log_payoff(maturity: float,
+                              interest_rate: float = 0.):
+    maturity, interest_rate = float(maturity), float(interest_rate)
+    return _contract(_terminal_stock_log, (maturity, interest_rate),
+                     'terminal_stock', maturity, 0., interest_rate)
+
+@njit(parallel=True, cache=True)
+def _european_call_log(logS:          np.ndarray,
+                       maturity:      float,
+                       strike:        float,
+                       interest_rate: float):
+    DF = np.exp( - interest_rate * maturity)
+    return np.maximum(_terminal(logS) - strike, 0.)*DF
+
+def european_call_log_payoff(maturity: float,
+                             strike: float,
+                             interest_rate: float = 0.):
+    maturity, strike, interest_rate = float(maturity), float(strike), float(interest_rate)
+    return _contract(_european_call_log, (maturity, strike, interest_rate),
+                     'european_call', maturity, strike, interest_rate)
+
+@njit(parallel=True, cache=True)
+def _european_put_log(logS:          np.ndarray,
+                      maturity:      float,
+                      strike:        float,
+                      interest_rate: float):
+    DF = np.exp( - interest_rate * maturity)
+    return np.maximum(strike - _terminal(logS), 0.)*DF
+
+def european_put_log_payoff(maturity: float,
+                            strike: float,
+                            interest_rate: float = 0.):
+    maturity, strike, interest_rate = float(maturity), float(strike), float(interest_rate)
+    return _contract(_european_put_log, (maturity, strike, interest_rate),
+                     'european_put', maturity, strike, interest_rate)
+
+@njit(parallel=True, cache=True)
+def _asian_call_AM_log(logS:          np.ndarray,
+                       maturity:      float,
+                       strike:        float,
+                       interest_rate: float):
+    dt = maturity/logS.shape[1]
+    DF = np.exp( - interest_rate * maturity)
+    out = np.empty(logS.shape[0])
+    for j in prange(logS.shape[0]):
+        I = 0.
+        for i in range(logS.shape[1]):
+            I += _price(logS, j, i)
+        out[j] = max(I*dt - strike, 0.)*DF
+    return out
+
+def asian_call_AM_log_payoff(maturity: float,
+                             strike: float,
+                             interest_rate: float = 0.):
+    maturity, strike, interest_rate = float(maturity), float(strike), float(interest_rate)
+    return _contract(_asian_call_AM_log, (maturity, strike, interest_rate),
+                     'asian_call_AM', maturity, strike, interest_rate)
+
+@njit(parallel=True, cache=True)
+def _asian_put_AM_log(logS:          np.ndarray,
+                      maturity:      float,
+                      strike:        float,
+                      interest_rate: float):
+    dt = maturity/logS.shape[1]
+    DF = np.exp( - interest_rate * maturity)
+    out = np.empty(logS.shape[0])
+    for j in prange(logS.shape[0]):
+        I = 0.
+        for i in range(logS.shape[1]):
+            I += _price(logS, j, i)
+        out[j] = max(strike - I*dt, 0.)*DF
+    return out
+
+def asian_put_AM_log_payoff(maturity: float,
+                            strike: float,
+                            interest_rate: float = 0.):
+    maturity, strike, interest_rate = float(maturity), float(strike), float(interest_rate)
+    return _contract(_asian_put_AM_log, (maturity, strike, interest_rate),
+                     'asian_put_AM', maturity, strike, interest_rate)
+
+@njit(parallel=True, cache=True)
+def _asian_call_GM_log(logS:          np.ndarray,
+                       maturity:      float,
+                       strike:        float,
+                       interest_rate: float):
+    dt = maturity/logS.shape[1]
+    I = np.exp(np.sum(logS, axis=1) * dt)
+    DF = np.exp( - interest_rate * maturity)
+    return np.maximum(I - strike, 0.)*DF
+
+def asian_call_GM_log_payoff(maturity: float,
+                             strike: float,
+                             interest_rate: float = 0.):
+    maturity, strike, interest_rate = float(maturity), float(strike), float(interest_rate)
+    return _contract(_asian_call_GM_log, (maturity, strike, interest_rate),
+                     'asian_call_GM', maturity, strike, interest_rate)
+
+@njit(parallel=True, cache=True)
+def _asian_put_GM_log(logS:          np.ndarray,
+                      maturity:      float,
+                      strike:        float,
+                      interest_rate: float):
+    dt = maturity/logS.shape[1]
+    I = np.exp(np.sum(logS, axis=1) * dt)
+    DF = np.exp( - interest_rate * maturity)
+    return np.maximum(strike - I, 0.)*DF
+
+def asian_put_GM_log_payoff(maturity: float,
+                            strike: float,
+                            interest_rate: float = 0.):
+    maturity, strike, interest_rate = float(maturity), float(strike), float(interest_rate)
+    return _contract(_asian_put_GM_log, (maturity, strike, interest_rate),
+                     'asian_put_GM', maturity, strike, interest_rate)
+
+
+# The payoff families with sample terms for warm_up_payoffs: the families of the price arrays of the engines (full paths,
+# path summaries of the terminal engines and strike ladders) and the log-space families of the log-prices. A new family is added here.
+
+PAYOFF_FAMILIES = ((terminal_stock_payoff,         (1., 0.)),
+                   (european_call_payoff,          (1., 1., 0.)),
+                   (european_put_payoff,           (1., 1., 0.)),
+                   (asian_call_AM_payoff,          (1., 1., 0.)),
+                   (asian_put_AM_payoff,           (1., 1., 0.)),
+                   (asian_call_GM_payoff,          (1., 1., 0.)),
+                   (asian_put_GM_payoff,           (1., 1., 0.)),
+                   (asian_call_AM_acc_payoff,      (1., 1., 0., 0)),
+                   (asian_put_AM_acc_payoff,       (1., 1., 0., 0)),
+                   (asian_call_GM_acc_payoff,      (1., 1., 0., 0)),
+                   (asian_put_GM_acc_payoff,       (1., 1., 0., 0)),
+                   (lookback_call_acc_payoff,      (1., 1., 0., 0)),
+                   (lookback_put_acc_payoff,       (1., 1., 0., 0)),
+                   (barrier_out_call_acc_payoff,   (1., 1., 0., 0)),
+                   (barrier_out_put_acc_payoff,    (1., 1., 0., 0)),
+                   (european_call_strikes_payoff,  (1., np.ones(1), 0.)),
+                   (european_put_strikes_payoff,   (1., np.ones(1), 0.)),
+                   (asian_call_AM_strikes_payoff,  (1., np.ones(1), 0.)),
+                   (asian_put_AM_strikes_payoff,   (1., np.ones(1), 0.)),
+                   (digital_call_payoff,           (1., 1., 0.)),
+                   (digital_put_payoff,            (1., 1., 0.)),
+                   (european_call_pathwise_payoff, (1., 1., 0.)),
+                   (european_put_pathwise_payoff,  (1., 1., 0.)))
+
+LOG_PAYOFF_FAMILIES = ((terminal_stock_log_payoff, (1., 0.)),
+                       (european_call_log_payoff,  (1., 1., 0.)),
+                       (european_put_log_payoff,   (1., 1., 0.)),
+                       (asian_call_AM_log_payoff,  (1., 1., 0.)),
+                       (asian_put_AM_log_payoff,   (1., 1., 0.)),
+                       (asian_call_GM_log_payoff,  (1., 1., 0.)),
+                       (asian_put_GM_log_payoff,   (1., 1., 0.)))
+
+def warm_up_payoffs(N_T:    int   = 2,
+                    dtypes: tuple = (np.float64,)) -> int:
+    """Compiles, or loads from the on-disk cache, the kernels of the payoff families of PAYOFF_FAMILIES and LOG_PAYOFF_FAMILIES,
+       e.g. at deploy time, so that no pricing call pays the compilation. The kernels take the contract terms at runtime,
+       so this covers every strike, maturity and interest rate.
+    Args:
+        N_T (int, optional):      Number of columns of the dummy paths, at least 2. Defaults to 2.
+        dtypes (tuple, optional): Floating-point types of the paths the payoffs will get (see the dtype of the engines),
+                                  the log-space payoffs always get float64 log-prices. Defaults to (np.float64,).
+    Returns:
+        The number of the compiled specialisations.
+    """
+    count = 0
+    for factory, terms in PAYOFF_FAMILIES:
+        payoff = factory(*terms)
+        for dtype in dtypes:
+            payoff.kernel(np.ones((4, N_T), dtype), *payoff.terms)
+            count += 1
+    for factory, terms in LOG_PAYOFF_FAMILIES:
+        payoff = factory(*terms)
+        payoff.kernel(np.zeros((4, N_T)), *payoff.terms)
+        count += 1
+    return count
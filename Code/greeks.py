@@ -0,0 +1,311 @@
+import numpy as np
+
+from math import sqrt, exp, log
+from copy import error
+from typing import Callable
+from numba import njit, prange
+
+from hestonmc import MarketState, HestonParameters, MCStatistics, Phi, _antithetic_signs, _standard_normals, _payoff_values
+
+if __name__ == '__main__':
+    print("This is a module. Please import it.\n")
+    exit(-1)
+
+GREEK_NAMES  = ('price', 'delta', 'gamma', 'dv0', 'dkappa', 'dvbar', 'dgamma', 'drho')
+GREEK_PARAMS = ('v0', 'kappa', 'vbar', 'gamma', 'rho')
+
+def _qe_constants(kappa:   float,
+                  gamma:   float,
+                  rho:     float,
+                  vbar:    float,
+                  r:       float,
+                  dt:      float,
+                  gamma_1: float):
+    """Constants of the QE step and their derivatives.
+    Returns:
+        The array (E, p1, p2, p3, rdtK0, K_1, K_2, K_3, K_4) as in simulate_heston_andersen_qe and the matrix of shape (9, 5)
+        of their derivatives with respect to GREEK_PARAMS.
+    """
+    gamma_2 = 1. - gamma_1
+    E       = exp(-kappa*dt)
+    dE_k    = -dt*E
+    p1      = (1. - E)*(gamma**2)*E/kappa
+    p2      = (vbar*gamma**2)/(2.0*kappa)*((1.-E)**2)
+    p3      = vbar*(1. - E)
+    K_0     = -(rho*kappa*vbar/gamma)*dt
+    K_1     = gamma_1 * dt * (rho*kappa/gamma - 0.5) - rho/gamma
+    K_2     = gamma_2 * dt * (rho*kappa/gamma - 0.5) + rho/gamma
+    K_3     = gamma_1 * dt * (1.0 - rho**2)
+    K_4     = gamma_2 * dt * (1.0 - rho**2)
+
+    c  = np.array([E, p1, p2, p3, r*dt + K_0, K_1, K_2, K_3, K_4])
+    dc = np.zeros((9, 5))     # rows follow c, columns follow GREEK_PARAMS; v0 enters through the initial variance only
+    K, VB, G, R = 1, 2, 3, 4
+    dc[0, K]  = dE_k
+    dc[1, K]  = (gamma**2)*dE_k*(1. - 2.*E)/kappa - p1/kappa
+    dc[1, G]  = 2.*p1/gamma
+    dc[2, K]  = -(vbar*gamma**2)/kappa*(1. - E)*dE_k - p2/kappa
+    dc[2, VB] = (gamma**2)/(2.0*kappa)*((1.-E)**2)
+    dc[2, G]  = 2.*p2/gamma
+    dc[3, K]  = -vbar*dE_k
+    dc[3, VB] = 1. - E
+    dc[4, K]  = -rho*vbar*dt/gamma
+    dc[4, VB] = -rho*kappa*dt/gamma
+    dc[4, G]  = rho*kappa*vbar*dt/gamma**2
+    dc[4, R]  = -kappa*vbar*dt/gamma
+    dc[5, K]  = gamma_1*dt*rho/gamma
+    dc[5, G]  = -gamma_1*dt*rho*kappa/gamma**2 + rho/gamma**2
+    dc[5, R]  = gamma_1*dt*kappa/gamma - 1./gamma
+    dc[6, K]  = gamma_2*dt*rho/gamma
+    dc[6, G]  = -gamma_2*dt*rho*kappa/gamma**2 - rho/gamma**2
+    dc[6, R]  = gamma_2*dt*kappa/gamma + 1./gamma
+    dc[7, R]  = -2.*gamma_1*dt*rho
+    dc[8, R]  = -2.*gamma_2*dt*rho
+    return c, dc
+
+@njit(parallel=True, cache=True, nogil=True)
+def _qe_tangent_paths(s0:            float,
+                      v0:            float,
+                      c:             np.ndarray,
+                      dc:            np.ndarray,
+                      N_T:           int,
+                      n_simulations: int,
+                      Psi_c:         float,
+                      seed:          int,
+                      path_offset:   int):
+    """QE paths with the tangents of the log-price and the likelihood-ratio weights.
+       Given the variance path, the QE log-price is Gaussian with the mean mu and the variance sigma^2 accumulated over the steps,
+       so the weights are the scores of this Gaussian, with the derivatives of mu and sigma^2 propagated pathwise along the variance.
+       The derivative of the switch between the quadratic and the exponential branches at Psi_c is neglected.
+    Returns:
+        The terminal log-prices of shape (4*n_simulations,), their derivatives with respect to GREEK_PARAMS of shape (4*n_simulations, 5)
+        and the weights of shape (4*n_simulations, 7): the first and the second order weights with respect to log(s0),
+        then the weights with respect to GREEK_PARAMS.
+    """
+    E, p1, p2, p3, rdtK0, K_1, K_2, K_3, K_4 = c[0], c[1], c[2], c[3], c[4], c[5], c[6], c[7], c[8]
+
+    Z       = _standard_normals(n_simulations, N_T, seed, path_offset)
+    logS    = np.empty(4*n_simulations)
+    dlogS   = np.zeros((4*n_simulations, 5))
+    weights = np.zeros((4*n_simulations, 7))
+
+    for n in prange(n_simulations):
+        dV    = np.empty(5)
+        dVn   = np.empty(5)
+        dx    = np.empty(5)
+        dmu   = np.empty(5)
+        dsig2 = np.empty(5)
+        for k in range(4):
+            a, b = _antithetic_signs(k)
+            j    = 4*n + k
+            x, V, sig2, W = log(s0), v0, 0., 0.
+            dV[:], dx[:], dmu[:], dsig2[:] = 0., 0., 0., 0.
+            dV[0] = 1.
+
+            for i in range(N_T - 1):
+                z_S, z_V = a*Z[0, n, i], b*Z[1, n, i]
+                m   = p3 + V*E
+                s_2 = V*p1 + p2
+                Psi = s_2/(m**2)
+
+                if Psi <= Psi_c:
+                    cc   = 2. / Psi
+                    root = sqrt(cc*(cc - 1.))
+                    b2   = cc - 1. + root
+                    A    = m/(1.+b2)
+                    sb   = sqrt(b2)
+                    Vn   = A*((sb+z_V)**2)
+                    for t in range(5):
+                        dm     = dc[3, t] + dV[t]*E + V*dc[0, t]
+                        ds_2   = dV[t]*p1 + V*dc[1, t] + dc[2, t]
+                        dPsi   = ds_2/(m**2) - 2.*s_2*dm/(m**3)
+                        dcc    = -2.*dPsi/(Psi**2)
+                        db2    = dcc + (2.*cc - 1.)*dcc/(2.*root)
+                        dA     = dm/(1.+b2) - m*db2/((1.+b2)**2)
+                        dVn[t] = dA*((sb+z_V)**2) + A*(sb+z_V)*db2/sb
+                else:
+                    p = (Psi - 1)/(Psi + 1)
+                    u = Phi(z_V)
+                    if u < p:
+                        Vn     = 0.
+                        dVn[:] = 0.
+                    else:
+                        L  = log((1.-p)/(1.-u))
+                        Vn = m*L/(1.-p)
+                        for t in range(5):
+                            dm     = dc[3, t] + dV[t]*E + V*dc[0, t]
+                            ds_2   = dV[t]*p1 + V*dc[1, t] + dc[2, t]
+                            dPsi   = ds_2/(m**2) - 2.*s_2*dm/(m**3)
+                            dp     = 2.*dPsi/((Psi + 1)**2)
+                            dVn[t] = dm*L/(1.-p) + m*dp*(L - 1.)/((1.-p)**2)
+
+                q  = K_3*V + K_4*Vn
+                sq = sqrt(q)
+                x += rdtK0 + K_1*V + K_2*Vn + sq*z_S
+                for t in range(5):
+                    dq        = dc[7, t]*V + K_3*dV[t] + dc[8, t]*Vn + K_4*dVn[t]
+                    dmu_t     = dc[4, t] + dc[5, t]*V + K_1*dV[t] + dc[6, t]*Vn + K_2*dVn[t]
+                    dmu[t]   += dmu_t
+                    dsig2[t] += dq
+                    dx[t]    += dmu_t + (0.5*dq/sq*z_S if sq > 0. else 0.)
+                    dV[t]     = dVn[t]
+                sig2 += q
+                W    += sq*z_S
+                V     = Vn
+
+            logS[j]  = x
+            dlogS[j] = dx
+            if sig2 > 0.:
+                w1            = W/sig2
+                weights[j, 0] = w1
+                weights[j, 1] = w1**2 - 1./sig2
+                for t in range(5):
+                    weights[j, 2 + t] = w1*dmu[t] + (W*w1 - 1.)*dsig2[t]/(2.*sig2)
+
+    return logS, dlogS, weights
+
+@njit(parallel=True, cache=True, nogil=True)
+def _euler_tangent_paths(s0:            float,
+                         r:             float,
+                         v0:            float,
+                         kappa:         float,
+                         vbar:          float,
+                         gamma:         float,
+                         rho:           float,
+                         T:             float,
+                         N_T:           int,
+                         n_simulations: int,
+                         seed:          int,
+                         path_offset:   int):
+    """Full-truncation Euler paths with the tangents of the log-price and the likelihood-ratio weights with respect to log(s0).
+       The weights are the scores of the Gaussian first step, the weights with respect to GREEK_PARAMS are not available (NaN).
+    Returns:
+        The same triple as _qe_tangent_paths.
+    """
+    dt         = T/float(N_T)
+    sqrt1_rho2 = sqrt(1-rho**2)
+
+    Z       = _standard_normals(n_simulations, N_T, seed, path_offset)
+    logS    = np.empty(4*n_simulations)
+    dlogS   = np.zeros((4*n_simulations, 5))
+    weights = np.full((4*n_simulations, 7), np.nan)
+
+    for n in prange(n_simulations):
+        dV = np.empty(5)
+        dx = np.empty(5)
+        for k in range(4):
+            a, b = _antithetic_signs(k)
+            j    = 4*n + k
+            x, V = log(s0), v0
+            dV[:], dx[:] = 0., 0.
+            dV[0] = 1.
+
+            sq0           = sqrt(max(v0, 0.)*dt)
+            w1            = (a*Z[0, n, 0] - rho*b*Z[1, n, 0]/sqrt1_rho2)/sq0
+            weights[j, 0] = w1
+            weights[j, 1] = w1**2 - 1./((1. - rho**2)*v0*dt)
+
+            for i in range(N_T - 1):
+                z_S, z_V = a*Z[0, n, i], b*Z[1, n, i]
+                vmax = max(V, 0)
+                sq   = sqrt(vmax*dt)
+                w    = rho*z_S + sqrt1_rho2*z_V
+                for t in range(5):
+                    dvmax  = dV[t] if V > 0 else 0.
+                    dsq    = 0.5*dvmax*dt/sq if sq > 0. else 0.
+                    dx[t] += -0.5*dvmax*dt + dsq*z_S
+                    dV[t] += kappa*(-dvmax)*dt + gamma*dsq*w
+                dV[1] += (vbar - vmax)*dt
+                dV[2] += kappa*dt
+                dV[3] += sq*w
+                dV[4] += gamma*sq*(z_S - rho*z_V/sqrt1_rho2)
+
+                x = x + (r - 0.5 * vmax) * dt + sq * z_S
+                V = V + kappa*(vbar - vmax)*dt + gamma*sq*w
+
+            logS[j]  = x
+            dlogS[j] = dx
+
+    return logS, dlogS, weights
+
+def mc_greeks(payoff:            Callable,
+              state:             MarketState,
+              heston_params:     HestonParameters,
+              T:                 float    = 1.,
+              N_T:               int      = 100,
+              n_simulations:     int      = 100_000,
+              payoff_derivative: Callable = None,
+              scheme:            str      = 'qe',
+              Psi_c:             float    = 1.5,
+              gamma_1:           float    = 0.0,
+              batch_size:        int      = 50_000,
+              seed:              int      = 42,
+              confidence_level:  float    = 0.05):
+    """Price and Greeks of a payoff of the terminal stock price from a single set of paths.
+       The tangents of the log-price with respect to the model parameters are propagated along the paths of the QE or
+       the Euler scheme (with the counter-based generator keyed by seed), so no bumped revaluations are needed.
+       If payoff_derivative is given, delta and the parameter sensitivities are pathwise and gamma is the mixed pathwise and
+       likelihood-ratio estimate. Otherwise (e.g. for digitals) all the Greeks use the likelihood-ratio weights; with the
+       Euler scheme they exist for delta and gamma only and the parameter sensitivities are NaN.
+       The Euler tangents go through sqrt(V) and get a heavy tail when the Feller condition 2*kappa*vbar >= gamma^2 is violated,
+       the QE scheme should be used then. The derivative of the QE switch at Psi_c is neglected, which is a small bias.
+    Args:
+        payoff (Callable):                       Discounted payoff reading the terminal price S[:, -1], e.g. from derivatives.
+        state (MarketState):                     Market state.
+        heston_params (HestonParameters):        Parameters of the Heston model.
+        T (float, optional):                     Contract termination time expressed as a number of years. Defaults to 1..
+        N_T (int, optional):                     Number of steps in time. Defaults to 100.
+        n_simulations (int, optional):           Number of simulations, 4*n_simulations paths are used. Defaults to 100_000.
+        payoff_derivative (Callable, optional):  Discounted derivative of the payoff with respect to S[:, -1],
+                                                 e.g. derivatives.european_call_pathwise_payoff. Defaults to None.
+        scheme (str, optional):                  'qe' or 'euler'. Defaults to 'qe'.
+        Psi_c (float, optional):                 Critical value of \psi of the QE scheme. Defaults to 1.5.
+        gamma_1 (float, optional):               Integration parameter of the QE scheme. Defaults to 0.0, as in simulate_heston_andersen_qe.
+        batch_size (int, optional):              Number of simulations per batch. Defaults to 50_000.
+        seed (int, optional):                    Key of the counter-based generator. Defaults to 42.
+        confidence_level (float, optional):      Confidence level of the intervals. Defaults to 0.05.
+    Raises:
+        error: Unknown scheme.
+        error: Contract termination time must be positive.
+    Returns:
+        A dict of the estimates keyed by GREEK_NAMES (price, delta, gamma and the derivatives of the price with respect to
+        v0, kappa, vbar, gamma, rho) and a dict of their confidence intervals (low, high).
+    """
+    if scheme not in ('qe', 'euler'):
+        raise error(f"Unknown scheme {scheme}, expected 'qe' or 'euler'.")
+    if T <= 0:
+        raise error("Contract termination time must be positive.")
+
+    r, s0 = state.interest_rate, state.stock_price
+    v0, rho, kappa, vbar, gamma = heston_params.v0, heston_params.rho, heston_params.kappa, heston_params.vbar, heston_params.gamma
+    c, dc = _qe_constants(kappa, gamma, rho, vbar, r, T/float(N_T), gamma_1)
+
+    stats = MCStatistics(len(GREEK_NAMES))
+    for offset in range(0, n_simulations, batch_size):
+        size = min(batch_size, n_simulations - offset)
+        if scheme == 'qe':
+            logS, dlogS, weights = _qe_tangent_paths(s0, v0, c, dc, N_T, size, Psi_c, seed, offset)
+        else:
+            logS, dlogS, weights = _euler_tangent_paths(s0, r, v0, kappa, vbar, gamma, rho, T, N_T, size, seed, offset)
+
+        S_T     = np.exp(logS)[:, None]
+        samples = np.empty((len(logS), len(GREEK_NAMES)))
+        f       = _payoff_values(payoff, S_T)
+        samples[:, 0] = f
+        if payoff_derivative is not None:
+            fS = _payoff_values(payoff_derivative, S_T)*S_T[:, 0]
+            samples[:, 1]  = fS/s0
+            samples[:, 2]  = fS*(weights[:, 0] - 1.)/s0**2
+            samples[:, 3:] = fS[:, None]*dlogS
+        else:
+            samples[:, 1]  = f*weights[:, 0]/s0
+            samples[:, 2]  = f*(weights[:, 1] - weights[:, 0])/s0**2
+            samples[:, 3:] = f[:, None]*weights[:, 2:]
+
+        # the four antithetic copies of a path are one sample
+        stats.update(samples.reshape(size, 4, len(GREEK_NAMES)).mean(axis=1))
+
+    low, high = stats.conf_interval(confidence_level)
+    greeks    = {name: float(stats.mean[i]) for i, name in enumerate(GREEK_NAMES)}
+    intervals = {name: (float(low[i]), float(high[i])) for i, name in enumerate(GREEK_NAMES)}
+    return greeks, intervals
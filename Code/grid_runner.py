@@ -0,0 +1,161 @@
+import os
+import time
+import numpy as np
+import pandas as pd
+
+from typing import Callable, Optional
+from itertools import product
+from multiprocessing import get_context
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import hestonmc
+from hestonmc import MarketState, HestonParameters, mc_price
+from derivatives import european_call_payoff
+
+if __name__ == '__main__':
+    print("This is a module. Please import it.\n")
+    exit(-1)
+
+GRID_COLUMNS = ['scheme', 'heston_params#', 'strike', 'T', 'N_T', 'batch_size', 'absolute error', 'true', 'MC_price', 'time']
+
+_worker = {}
+
+def _init_worker(scheme_kwargs: dict):
+    """Process pool initializer: gives every worker a single copy of the scheme arguments."""
+    _worker['scheme_kwargs'] = scheme_kwargs
+
+def _job_cost(job: dict) -> float:
+    """Expected cost of a job: number of steps times the batch size, scaled by the maturity (the variance of the payoff grows with T)."""
+    return job['N_T'] * job['batch_size'] * max(job['T'], 1e-8)
+
+def make_jobs(test_params: dict) -> list:
+    """Expands a test description into the list of jobs.
+    Args:
+        test_params (dict): Test description with the keys 'schemes', 'strikes', 'Ts', 'N_Ts', 'batch_sizes', 'heston_params_n',
+                            as in run_grid.ipynb.
+    Returns:
+        The list of jobs, one dict per grid point, numbered by 'index' in the order of the grid.
+    """
+    jobs = []
+    for scheme, strike, T, N_T, batch_size, heston_params_n in product(test_params['schemes'], test_params['strikes'], test_params['Ts'],
+                                                                       test_params['N_Ts'], test_params['batch_sizes'], test_params['heston_params_n']):
+        jobs.append({'index':           len(jobs),
+                     'scheme':          scheme if isinstance(scheme, str) else scheme.__name__,
+                     'strike':          float(strike),
+                     'T':               float(T),
+                     'N_T':             int(N_T),
+                     'batch_size':      int(batch_size),
+                     'heston_params_n': int(heston_params_n)})
+    return jobs
+
+def make_chunks(jobs:       list,
+                chunk_size: int) -> list:
+    """Groups the jobs by scheme (so that a worker reuses the JIT specialisations of one engine) and splits the groups into chunks.
+       The chunks are queued scheme by scheme, so that the workers move on to the next engine together instead of all compiling
+       every engine; within a scheme the jobs in a chunk and the chunks themselves are ordered by decreasing expected cost.
+    Args:
+        jobs (list):       Jobs made by make_jobs.
+        chunk_size (int):  Maximal number of jobs in a chunk.
+    Returns:
+        The list of chunks.
+    """
+    chunks = []
+    for scheme in dict.fromkeys(job['scheme'] for job in jobs):
+        group = sorted((job for job in jobs if job['scheme'] == scheme), key=_job_cost, reverse=True)
+        chunks += sorted((group[i:i+chunk_size] for i in range(0, len(group), chunk_size)),
+                         key=lambda chunk: sum(map(_job_cost, chunk)), reverse=True)
+    return chunks
+
+def _run_chunk(chunk:         list,
+               state:         tuple,
+               heston_params: list,
+               mc_params:     dict,
+               true_price:    Optional[Callable],
+               run_n_times:   int,
+               base_seed:     int) -> list:
+    """Runs a chunk of jobs in a worker and returns the pairs (job index, row of the results table).
+       The generator of a job is seeded with base_seed + its index, so its price does not depend on the worker it runs in."""
+    state = MarketState(*state)
+    rows  = []
+    for job in chunk:
+        simulate       = getattr(hestonmc, job['scheme'])
+        heston_params_ = HestonParameters(*heston_params[job['heston_params_n']-1])
+        ec_payoff      = european_call_payoff(job['T'], job['strike'], state.interest_rate)
+        kwargs         = _worker['scheme_kwargs'].get(job['scheme'], {})
+        params         = {'random_seed': base_seed + job['index'], 'counter_rng': True, **mc_params}
+
+        st = time.time()
+        for _ in range(run_n_times):
+            res = float(mc_price(payoff = ec_payoff, simulate = simulate, state = state, heston_params = heston_params_, T = job['T'],
+                                 N_T = job['N_T'], batch_size = job['batch_size'], **params, **kwargs))
+        et = time.time()
+
+        true = np.nan if true_price is None else true_price(state, heston_params_, job['T'], job['strike'])
+        rows.append((job['index'], (job['scheme'], job['heston_params_n'], job['strike'], job['T'], job['N_T'], job['batch_size'],
+                                  mc_params.get('absolute_error', 0.01), true, res, (et-st)/run_n_times)))
+    return rows
+
+def run_grid(test_params:         dict,
+             heston_params_array: list,
+             state:               MarketState,
+             mc_params:           dict               = None,
+             scheme_kwargs:       dict               = None,
+             true_price:          Optional[Callable] = None,
+             n_workers:           int                = None,
+             chunk_size:          int                = None,
+             base_seed:           int                = 42,
+             run_n_times:         int                = 1,
+             output_path:         str                = None,
+             verbose:             bool               = False,
+             start_method:        str                = 'spawn') -> pd.DataFrame:
+    """Runs a scheme-comparison sweep on a process pool.
+    Args:
+        test_params (dict):                   Test description with the keys 'schemes', 'strikes', 'Ts', 'N_Ts', 'batch_sizes', 'heston_params_n'.
+        heston_params_array (list):           Heston parameter sets, 'heston_params_n' indexes it starting from 1.
+        state (MarketState):                  Market state.
+        mc_params (dict, optional):           Additional arguments of mc_price, e.g. absolute_error. Defaults to None.
+        scheme_kwargs (dict, optional):       Additional engine arguments keyed by the scheme name, e.g. the tables of simulate_heston_andersen_tg.
+                                              They are sent to every worker once. Defaults to None.
+        true_price (Callable, optional):      Reference price as a picklable function of (state, heston_params, T, strike). Defaults to None.
+        n_workers (int, optional):            Number of worker processes. Defaults to None (the number of CPUs).
+        chunk_size (int, optional):           Number of jobs sent to a worker at once. Defaults to None (about four chunks per worker).
+        base_seed (int, optional):            The job i of make_jobs is priced with random_seed = base_seed + i and the counter-based generator
+                                              (unless mc_params sets them), so that a sweep is reproducible whatever the scheduling. Defaults to 42.
+        run_n_times (int, optional):          Number of runs of every job the time is averaged over. Defaults to 1.
+        output_path (str, optional):          If given, the table is written there as csv every time a chunk is finished. Defaults to None.
+        verbose (bool, optional):             Verbose flag. If true, the progress is printed. Defaults to False.
+        start_method (str, optional):         Start method of the worker processes. 'fork' starts faster and accepts a true_price defined
+                                              in a notebook, but hangs if this process has already run parallel Numba code with the default
+                                              workqueue threading layer. Defaults to 'spawn'.
+    Returns:
+        The results table with the columns of Data/evaluation/*.csv, in the order of the jobs.
+    """
+    mc_params     = {} if mc_params is None else dict(mc_params)
+    scheme_kwargs = {} if scheme_kwargs is None else scheme_kwargs
+    n_workers     = os.cpu_count() if n_workers is None else n_workers
+
+    jobs       = make_jobs(test_params)
+    chunk_size = max(1, len(jobs) // (4*n_workers)) if chunk_size is None else chunk_size
+    chunks     = make_chunks(jobs, chunk_size)
+
+    state_     = (state.stock_price, state.interest_rate)
+    params_    = [(p.kappa, p.gamma, p.rho, p.vbar, p.v0) for p in heston_params_array]
+
+    rows    = {}
+    df      = pd.DataFrame(columns=GRID_COLUMNS)
+    done    = 0
+
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=get_context(start_method), initializer=_init_worker,
+                             initargs=(scheme_kwargs,)) as pool:
+        futures = [pool.submit(_run_chunk, chunk, state_, params_, mc_params, true_price, run_n_times, base_seed) for chunk in chunks]
+        for future in as_completed(futures):
+            rows.update(future.result())
+            df    = pd.DataFrame([rows[index] for index in sorted(rows)], columns=GRID_COLUMNS)
+            done += 1
+
+            if output_path is not None:
+                df.to_csv(output_path)
+            if verbose:
+                print(f"Chunks done: {done}/{len(chunks)}, jobs done: {len(df)}/{len(jobs)}")
+
+    return df
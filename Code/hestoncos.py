@@ -0,0 +1,342 @@
+import numpy as np
+
+from functools import lru_cache
+
+from hestonmc import MarketState, HestonParameters
+
+if __name__ == '__main__':
+    print("This is a module. Please import it.\n")
+    exit(-1)
+
+MAX_COS_TERMS = 8192
+
+def heston_char_func(u:             np.ndarray,
+                     T:             float,
+                     interest_rate: float,
+                     heston_params: HestonParameters) -> np.ndarray:
+    """Characteristic function E[exp(iu log(S_T/S_0))] of the Heston model in the form of Albrecher et al. (2007),
+       which stays on the principal branch of the logarithm for long maturities.
+    Args:
+        u (np.ndarray):                   Arguments, real or complex, e.g. u - i(alpha + 1) of Carr-Madan or a shifted contour.
+        T (float):                        Maturity.
+        interest_rate (float):            Interest rate.
+        heston_params (HestonParameters): Parameters of the Heston model.
+    Returns:
+        The values of the characteristic function.
+    """
+    v0, rho, kappa, vbar, gamma = heston_params.v0, heston_params.rho, heston_params.kappa, heston_params.vbar, heston_params.gamma
+    return _char_func(np.asarray(u, dtype=np.complex128), T, interest_rate, kappa, gamma, rho, vbar, v0)
+
+def _char_func(u, T, r, kappa, gamma, rho, vbar, v0):
+    beta = kappa - rho*gamma*1j*u
+    d    = np.sqrt(beta**2 + gamma**2*(1j*u + u**2))
+    g    = (beta - d)/(beta + d)
+    edT  = np.exp(-d*T)
+    C    = r*1j*u*T + kappa*vbar/gamma**2*((beta - d)*T - 2.*np.log((1. - g*edT)/(1. - g)))
+    D    = (beta - d)/gamma**2*(1. - edT)/(1. - g*edT)
+    return np.exp(C + D*v0)
+
+def _char_func_gradient(u, T, r, kappa, gamma, rho, vbar, v0):
+    """The characteristic function of _char_func and its derivatives with respect to (kappa, gamma, rho, vbar, v0),
+       by the chain rule through the same expressions. Returns phi of shape u.shape and the derivatives of shape (5,) + u.shape.
+    """
+    iu   = 1j*u
+    one  = np.ones_like(iu)
+    zero = np.zeros_like(iu)
+    beta = kappa - rho*gamma*iu
+    d    = np.sqrt(beta**2 + gamma**2*(iu + u**2))
+    g    = (beta - d)/(beta + d)
+    edT  = np.exp(-d*T)
+    Q    = (1. - g*edT)/(1. - g)
+    G    = (1. - edT)/(1. - g*edT)
+    B    = (beta - d)*T - 2.*np.log(Q)
+    C    = r*iu*T + kappa*vbar/gamma**2*B
+    D    = (beta - d)/gamma**2*G
+
+    dbeta  = np.stack((one, -rho*iu, -gamma*iu, zero, zero))
+    dgamma = np.array([0., 1., 0., 0., 0.])[:, None]
+    dA     = np.array([vbar/gamma**2, -2.*kappa*vbar/gamma**3, 0., kappa/gamma**2, 0.])[:, None]
+    dinvg2 = np.array([0., -2./gamma**3, 0., 0., 0.])[:, None]
+    dv0    = np.array([0., 0., 0., 0., 1.])[:, None]
+
+    dd   = (beta*dbeta + gamma*dgamma*(iu + u**2))/d
+    dg   = 2.*(d*dbeta - beta*dd)/(beta + d)**2
+    de   = -T*dd*edT
+    dlnQ = -(dg*edT + g*de)/(1. - g*edT) + dg/(1. - g)
+    dG   = (-de*(1. - g*edT) + (1. - edT)*(dg*edT + g*de))/(1. - g*edT)**2
+    dC   = dA*B + kappa*vbar/gamma**2*((dbeta - dd)*T - 2.*dlnQ)
+    dD   = ((dbeta - dd)/gamma**2 + (beta - d)*dinvg2)*G + (beta - d)/gamma**2*dG
+
+    phi = np.exp(C + D*v0)
+    return phi, phi*(dC + dD*v0 + D*dv0)
+
+def _cumulants(char_func, h=1e-2):
+    """Cumulants c1, c2, c4 of a random variable from the central differences of its cumulant generating function log(char_func(u))."""
+    k      = np.log(char_func(h*np.arange(-2, 3)))
+    c1     = (k[3] - k[1]).imag/(2.*h)
+    c2     = -(k[3] - 2.*k[2] + k[1]).real/h**2
+    c4     = (k[4] - 4.*k[3] + 6.*k[2] - 4.*k[1] + k[0]).real/h**4
+    return c1, abs(c2), abs(c4)
+
+def _cos_range(char_func, L):
+    """Truncation range c1 +- L sqrt(c2 + sqrt(c4)) of the COS method from the cumulants of the random variable."""
+    c1, c2, c4 = _cumulants(char_func)
+    width      = L*np.sqrt(c2 + np.sqrt(c4))
+    return c1 - width, c1 + width
+
+def _cos_series(char_func, N, L, tol):
+    """Truncation range [a, b] of a random variable with the characteristic function char_func, the frequencies u_k = k*pi/(b - a)
+       and the cosine coefficients A_k = 2/(b - a) Re(phi(u_k) exp(-i u_k a)) of its density (the first one halved).
+       If N is None, the number of terms is doubled from 64 until sum |A_k|/u_k over the last half of the terms, which bounds
+       their contribution to the price of a unit strike, falls below tol.
+    """
+    a, b = _cos_range(char_func, L)
+
+    def coefficients(k):
+        u = k*np.pi/(b - a)
+        return u, 2./(b - a)*(char_func(u)*np.exp(-1j*u*a)).real
+
+    n    = 64 if N is None else N
+    u, A = coefficients(np.arange(n))
+    while N is None and n < MAX_COS_TERMS and np.sum(np.abs(A[n//2:])/u[n//2:]) > tol:
+        u_new, A_new = coefficients(np.arange(n, 2*n))
+        u, A, n      = np.concatenate((u, u_new)), np.concatenate((A, A_new)), 2*n
+    A[0] *= 0.5
+    return a, b, u, A
+
+@lru_cache(maxsize=4096)
+def _cos_coefficients(T:     float,
+                      r:     float,
+                      kappa: float,
+                      gamma: float,
+                      rho:   float,
+                      vbar:  float,
+                      v0:    float,
+                      N:     int,
+                      L:     float,
+                      tol:   float):
+    """The COS series (see _cos_series) of log(S_T/S_0). It depends on the maturity and the model only, so it is cached
+       and shared by all the strikes and all the calls with the same maturity.
+    """
+    return _cos_series(lambda u: _char_func(u, T, r, kappa, gamma, rho, vbar, v0), N, L, tol)
+
+def _cos_put_weights(a, b, u, x):
+    """Weights W of the put expectations E[(1 - exp(x + Z))^+] = W @ A for the log-moneyness x against the COS series A of the density of Z.
+       The put pays for Z < -x, the integrals of the cosines against 1 and exp(z) over [a, d] with d = -x are
+       psi_k = sin(u_k(d - a))/u_k and chi_k = (exp(d)(cos(u_k(d - a)) + u_k sin(u_k(d - a))) - exp(a))/(1 + u_k^2);
+       exp(i u_k (d - a)) = exp(i u_1 (d - a))^k is built by the cumulative product, which is faster than the sines and cosines.
+       The weights depend on the strikes and the range only, so they are shared by all the parameters with the same range.
+    """
+    d        = np.clip(-x, a, b)
+    z        = np.exp(1j*u[1]*(d - a))
+    E        = np.cumprod(np.broadcast_to(z[:, None], (len(x), len(u) - 1)), axis=1)
+    uk       = u[1:]
+    W        = np.empty((len(x), len(u)))
+    W[:, 0]  = (d - a) - np.exp(x)*(np.exp(d) - np.exp(a))
+    W[:, 1:] = E.imag/uk - np.exp(x)[:, None]*((np.exp(d)[:, None]*(E.real + E.imag*uk) - np.exp(a))/(1. + uk**2))
+    return W
+
+def _cos_put(a, b, u, A, x):
+    """Expectations E[(1 - exp(x + Z))^+] of the put payoff for the log-moneyness x against the COS series of the density of Z (see _cos_put_weights)."""
+    return np.maximum(_cos_put_weights(a, b, u, x) @ A, 0.)
+
+def heston_cos_prices(state:         MarketState,
+                      heston_params: HestonParameters,
+                      strikes:       np.ndarray,
+                      maturities:    np.ndarray,
+                      option_type:   str   = 'call',
+                      N:             int   = None,
+                      L:             float = 10.,
+                      tol:           float = 1e-4) -> np.ndarray:
+    """Prices of European options on a strike x maturity grid with the COS method (Fang and Oosterlee, 2008).
+       The density of log(S_T/S_0) is expanded in a cosine series on c1 +- L sqrt(c2 + sqrt(c4)), where c1, c2, c4 are its cumulants,
+       and the put payoff is integrated against the series in closed form; the calls follow from the put-call parity.
+       The series coefficients are computed once per maturity (and cached between the calls), a strike costs O(N) operations.
+    Args:
+        state (MarketState):                 Market state.
+        heston_params (HestonParameters):    Parameters of the Heston model.
+        strikes (np.ndarray):                Strikes.
+        maturities (np.ndarray):             Maturities.
+        option_type (str, optional):         'call' or 'put'. Defaults to 'call'.
+        N (int, optional):                   Number of terms of the cosine series. Defaults to None (chosen per maturity from tol,
+                                             64-256 for the usual parameters, up to MAX_COS_TERMS for heavy tails).
+        L (float, optional):                 Half-width of the truncation range in standard deviations. Defaults to 10..
+        tol (float, optional):               Threshold of the series truncation indicator if N is None, a loose bound of the error
+                                             per unit strike: the actual errors are about 1e-7 at the default. Defaults to 1e-4.
+    Raises:
+        ValueError: Unknown option type.
+    Returns:
+        The prices of shape (len(maturities), len(strikes)).
+    """
+    if option_type not in ('call', 'put'):
+        raise ValueError(f"Unknown option type {option_type}, expected 'call' or 'put'.")
+
+    r, s0 = state.interest_rate, state.stock_price
+    v0, rho, kappa, vbar, gamma = heston_params.v0, heston_params.rho, heston_params.kappa, heston_params.vbar, heston_params.gamma
+
+    strikes    = np.atleast_1d(np.asarray(strikes, dtype=np.float64))
+    maturities = np.atleast_1d(np.asarray(maturities, dtype=np.float64))
+    x          = np.log(s0/strikes)
+    prices     = np.empty((len(maturities), len(strikes)))
+
+    for i, T in enumerate(maturities):
+        a, b, u, A = _cos_coefficients(float(T), float(r), float(kappa), float(gamma), float(rho), float(vbar), float(v0),
+                                       None if N is None else int(N), float(L), float(tol))
+        DF  = np.exp(-r*T)
+        put = DF*strikes*_cos_put(a, b, u, A, x)
+        prices[i] = put if option_type == 'put' else put + s0 - strikes*DF
+
+    return prices
+
+def heston_call_price(state:         MarketState,
+                      heston_params: HestonParameters,
+                      T:             float,
+                      strike:        float) -> float:
+    """Price of a single European call with the COS method, e.g. the true_price of grid_runner.run_grid.
+    Args:
+        state (MarketState):              Market state.
+        heston_params (HestonParameters): Parameters of the Heston model.
+        T (float):                        Maturity.
+        strike (float):                   Strike.
+    Returns:
+        The price of the call.
+    """
+    return float(heston_cos_prices(state, heston_params, [strike], [T])[0, 0])
+
+def _geometric_asian_char_func(u, dt, weight, n_dates, r, kappa, gamma, rho, vbar, v0):
+    """Characteristic function of Y = weight * sum_j log(S_{j dt}/S_0), j = 0, ..., n_dates - 1.
+       E[exp(B log S_{t + dt} + D V_{t + dt}) | F_t] = exp(B log S_t + C + D' V_t) with the Heston Riccati solution started from D,
+       so the coefficients are carried back from the last date to the first one, adding i u weight to B at every date.
+    """
+    z = 1j*np.asarray(u)*weight
+    B = z.copy()
+    C = np.zeros_like(z)
+    D = np.zeros_like(z)
+    for _ in range(n_dates - 1):
+        beta         = kappa - rho*gamma*B
+        d            = np.sqrt(beta**2 - gamma**2*(B**2 - B))
+        psi_m, psi_p = (beta - d)/gamma**2, (beta + d)/gamma**2
+        g            = (D - psi_m)/(D - psi_p)
+        edt          = np.exp(-d*dt)
+        C            = C + r*B*dt + kappa*vbar*(psi_m*dt - 2./gamma**2*np.log((1. - g*edt)/(1. - g)))
+        D            = (psi_m - psi_p*g*edt)/(1. - g*edt)
+        B            = B + z
+    return np.exp(C + D*v0)
+
+@lru_cache(maxsize=1024)
+def _geometric_asian_coefficients(dt:      float,
+                                  weight:  float,
+                                  n_dates: int,
+                                  r:       float,
+                                  kappa:   float,
+                                  gamma:   float,
+                                  rho:     float,
+                                  vbar:    float,
+                                  v0:      float,
+                                  N:       int,
+                                  L:       float,
+                                  tol:     float):
+    """The COS series (see _cos_series) of weight * sum_j log(S_{j dt}/S_0) and its exponential moment E[exp(Y)]."""
+    def char_func(u):
+        return _geometric_asian_char_func(u, dt, weight, n_dates, r, kappa, gamma, rho, vbar, v0)
+    return _cos_series(char_func, N, L, tol), char_func(np.array([-1j]))[0].real
+
+def heston_geometric_asian_prices(state:         MarketState,
+                                  heston_params: HestonParameters,
+                                  strikes:       np.ndarray,
+                                  T:             float = 1.,
+                                  N_T:           int   = 100,
+                                  option_type:   str   = 'call',
+                                  N:             int   = None,
+                                  L:             float = 10.,
+                                  tol:           float = 1e-4) -> np.ndarray:
+    """Prices of the discretely monitored geometric Asian options asian_call_GM_payoff(T, K, r) and asian_put_GM_payoff(T, K, r)
+       of derivatives.py on the paths of the engines, i.e. of the payoff on I = exp(dt sum_j log S_{j dt}) with dt = T/N_T, j = 0, ..., N_T - 1.
+       The characteristic function of log(I) is exact for the Heston model (see _geometric_asian_char_func) and is priced with the COS method.
+    Args:
+        state (MarketState):              Market state.
+        heston_params (HestonParameters): Parameters of the Heston model.
+        strikes (np.ndarray):             Strikes.
+        T (float, optional):              Maturity. Defaults to 1..
+        N_T (int, optional):              Number of monitoring dates, the number of columns of the simulated paths. Defaults to 100.
+        option_type (str, optional):      'call' or 'put'. Defaults to 'call'.
+        N (int, optional):                Number of terms of the cosine series. Defaults to None (chosen from tol).
+        L (float, optional):              Half-width of the truncation range in standard deviations. Defaults to 10..
+        tol (float, optional):            Threshold of the series truncation indicator if N is None. Defaults to 1e-4.
+    Raises:
+        ValueError: Unknown option type.
+    Returns:
+        The prices, one per strike.
+    """
+    dt = T/N_T
+    return np.exp(-state.interest_rate*T)*_geometric_asian_expectations(state, heston_params, strikes, dt, dt, N_T, option_type, N, L, tol)
+
+def _geometric_asian_expectations(state, heston_params, strikes, dt, weight, n_dates, option_type, N=None, L=10., tol=1e-4):
+    """Undiscounted expectations of the geometric Asian payoffs on I = exp(weight sum_j log S_{j dt}), j = 0, ..., n_dates - 1."""
+    if option_type not in ('call', 'put'):
+        raise ValueError(f"Unknown option type {option_type}, expected 'call' or 'put'.")
+
+    r, s0 = state.interest_rate, state.stock_price
+    v0, rho, kappa, vbar, gamma = heston_params.v0, heston_params.rho, heston_params.kappa, heston_params.vbar, heston_params.gamma
+
+    strikes          = np.atleast_1d(np.asarray(strikes, dtype=np.float64))
+    (a, b, u, A), EY = _geometric_asian_coefficients(float(dt), float(weight), int(n_dates), float(r), float(kappa), float(gamma),
+                                                     float(rho), float(vbar), float(v0), None if N is None else int(N), float(L), float(tol))
+    log_I0 = n_dates*weight*np.log(s0)
+    put    = strikes*_cos_put(a, b, u, A, log_I0 - np.log(strikes))
+    return put if option_type == 'put' else put + np.exp(log_I0)*EY - strikes
+
+def _last_date(T:   float,
+               N_T: int) -> float:
+    """Time of the last column of the simulated paths: the engines store the N_T dates 0, dt, ..., (N_T - 1)dt with dt = T/N_T."""
+    return T*(N_T - 1)/N_T
+
+def _terminal_stock_mean(state, heston_params, T, N_T, contract):
+    t = _last_date(T, N_T)
+    return np.exp(state.interest_rate*t - contract['interest_rate']*contract['maturity'])*state.stock_price
+
+def _geometric_asian_mean(option_type):
+    def geometric_asian_mean(state, heston_params, T, N_T, contract):
+        DF = np.exp(-contract['interest_rate']*contract['maturity'])
+        return DF*_geometric_asian_expectations(state, heston_params, [contract['strike']], T/N_T, contract['maturity']/N_T, N_T, option_type)[0]
+    return geometric_asian_mean
+
+def _european_mean(option_type):
+    def european_mean(state, heston_params, T, N_T, contract):
+        t, K = _last_date(T, N_T), contract['strike']
+        DF   = np.exp(state.interest_rate*t - contract['interest_rate']*contract['maturity'])
+        if t <= 0.:
+            return DF*max(state.stock_price - K if option_type == 'call' else K - state.stock_price, 0.)
+        return DF*heston_cos_prices(state, heston_params, [K], [t], option_type)[0, 0]
+    return european_mean
+
+# closed forms of the expectations of the payoffs of derivatives.py keyed by the name of their contract,
+# a function of (state, heston_params, T, N_T, contract) with T and N_T of the simulation
+CONTROL_VARIATE_MEANS = {'terminal_stock': _terminal_stock_mean,
+                         'european_call':  _european_mean('call'),
+                         'european_put':   _european_mean('put'),
+                         'asian_call_GM':  _geometric_asian_mean('call'),
+                         'asian_put_GM':   _geometric_asian_mean('put')}
+
+def control_variate_mean(payoff:        callable,
+                         state:         MarketState,
+                         heston_params: HestonParameters,
+                         T:             float,
+                         N_T:           int) -> float:
+    """Exact expectation of a payoff of derivatives.py on the paths simulated by the engines, e.g. the mean of a control variate of mc_price.
+       The last column of the paths is at (N_T - 1)T/N_T, so the options are priced for this maturity and discounted as the payoff does.
+    Args:
+        payoff (callable):                Payoff with the contract description attached by derivatives.py.
+        state (MarketState):              Market state.
+        heston_params (HestonParameters): Parameters of the Heston model.
+        T (float):                        Maturity of the simulation.
+        N_T (int):                        Number of steps in time of the simulation.
+    Raises:
+        ValueError: The payoff has no closed-form expectation.
+    Returns:
+        The expectation of the payoff.
+    """
+    contract = getattr(payoff, 'contract', None)
+    if contract is None or contract['name'] not in CONTROL_VARIATE_MEANS:
+        raise ValueError(f"No closed-form expectation of the payoff {getattr(payoff, '__name__', payoff)}, pass its mean explicitly.")
+    return float(CONTROL_VARIATE_MEANS[contract['name']](state, heston_params, T, N_T, contract))
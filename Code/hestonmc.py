@@ -1,46 +1,260 @@
 import numpy as np
 
-from math import erf, sqrt, exp, log
-sqrt2 = 1/sqrt(2)
+import cmath
+import inspect
 
-from scipy.stats import norm
+from math import erf, erfc, sqrt, exp, log, cos, sin, pi, floor, ceil, lgamma
+sqrt2 = 1/sqrt(2)
 
 from typing import Union, Callable, Optional
 from copy import error
-from scipy.interpolate import RectBivariateSpline
-from scipy.optimize import newton, root_scalar
+from functools import lru_cache
+from collections import namedtuple
 
-from numba import jit, njit, prange, float64
+from numba import jit, njit, prange, float64, int64, config
 from numba.experimental import jitclass
-from numba_stats import norm, uniform
+
+# scipy is imported lazily where it is needed (the quasi-random normals, the Student quantiles of the scrambles and
+# the Python TG root finder): importing scipy.stats alone takes longer than the rest of the module,
+# and the short-lived pricing workers only need the engines.
 
 @njit
 def Phi(x):
     return (0.5 + 0.5 * erf(x * sqrt2))
 
+_PPF_A = (-3.969683028665376e+01, 2.209460984245205e+02, -2.759285104469687e+02,
+           1.383577518672690e+02, -3.066479806614716e+01, 2.506628277459239e+00)
+_PPF_B = (-5.447609879822406e+01, 1.615858368580409e+02, -1.556989798598866e+02,
+           6.680131188771802e+01, -1.328068155288572e+01)
+_PPF_C = (-7.784894002430293e-03, -3.223964580411365e-01, -2.400758277161838e+00,
+          -2.549732539343734e+00,  4.374664141464968e+00,  2.938163982698783e+00)
+_PPF_D = ( 7.784695709041462e-03,  3.224671290700398e-01,  2.445134137142996e+00,  3.754408661907416e+00)
+
+@njit(cache=True, nogil=True)
+def _norm_ppf(p: float):
+    """Quantile of the standard normal distribution: Acklam's rational approximation refined by one Halley step,
+       accurate to about 1e-15 on (0, 1). Replaces scipy.stats.norm.ppf, so that the module does not import scipy.stats.
+    """
+    if p <= 0.:
+        return -np.inf
+    if p >= 1.:
+        return np.inf
+    if p > 0.5:
+        # 1 - p is exact here, and the refinement is accurate only in the lower tail
+        return -_norm_ppf(1. - p)
+    a, b, c, d = _PPF_A, _PPF_B, _PPF_C, _PPF_D
+    if p < 0.02425:
+        q = sqrt(-2*log(p))
+        x = (((((c[0]*q + c[1])*q + c[2])*q + c[3])*q + c[4])*q + c[5]) / ((((d[0]*q + d[1])*q + d[2])*q + d[3])*q + 1.)
+    else:
+        q = p - 0.5
+        r = q*q
+        x = (((((a[0]*r + a[1])*r + a[2])*r + a[3])*r + a[4])*r + a[5])*q / (((((b[0]*r + b[1])*r + b[2])*r + b[3])*r + b[4])*r + 1.)
+    e = 0.5*erfc(-x*sqrt2) - p
+    u = e*sqrt(2*pi)*exp(0.5*x*x)
+    return x - u/(1. + 0.5*x*u)
+
 if __name__ == '__main__':
     print("This is a module. Please import it.\n")
     exit(-1)
 
-@jitclass([("kappa", float64),
-           ("gamma", float64),
-           ("rho", float64), 
-           ("vbar", float64),
-           ("v0", float64)])
-class HestonParameters:
-    def __init__(self, kappa, gamma, rho, vbar, v0):
-        self.kappa = kappa
-        self.gamma = gamma
-        self.rho = rho
-        self.vbar = vbar
-        self.v0 = v0
-        
-@jitclass([("stock_price", float64),
-           ("interest_rate", float64)])
-class MarketState:
-    def __init__(self, stock_price, interest_rate):
-        self.stock_price = stock_price
-        self.interest_rate = interest_rate
+# The parameters are named tuples of floats rather than jitclasses: the Numba type of a jitclass instance contains the id of
+# the class, which changes from process to process, so the engines taking them would never be loaded from the on-disk cache.
+# The fields are read as before (heston_params.kappa), but the instances are immutable (use _replace to change a field),
+# unpack and compare as tuples, and can be passed wherever a tuple is expected, e.g. HestonParameters(*params).
+class HestonParameters(namedtuple('HestonParameters', ['kappa', 'gamma', 'rho', 'vbar', 'v0'])):
+    __slots__ = ()
+
+    def __new__(cls, kappa, gamma, rho, vbar, v0):
+        return super().__new__(cls, float(kappa), float(gamma), float(rho), float(vbar), float(v0))
+
+class MarketState(namedtuple('MarketState', ['stock_price', 'interest_rate'])):
+    __slots__ = ()
+
+    def __new__(cls, stock_price, interest_rate):
+        return super().__new__(cls, float(stock_price), float(interest_rate))
+
+N_CHUNKS = config.NUMBA_NUM_THREADS
+
+@njit(parallel=True, cache=True, nogil=True)
+def _batch_moments(batch: np.ndarray):
+    """Count, mean and sum of squared deviations of every column of a batch in a single parallel pass.
+       Every thread runs Welford's recursion over its chunk of rows, the chunks are then merged with Chan's formula.
+    """
+    n_paths, n_outputs = batch.shape
+    n_chunks           = max(min(N_CHUNKS, n_paths), 1)
+    means              = np.zeros((n_chunks, n_outputs))
+    M2s                = np.zeros((n_chunks, n_outputs))
+
+    for c in prange(n_chunks):
+        start = c*n_paths//n_chunks
+        stop  = (c+1)*n_paths//n_chunks
+        for i in range(start, stop):
+            k = i - start + 1
+            for o in range(n_outputs):
+                delta        = batch[i, o] - means[c, o]
+                means[c, o] += delta/k
+                M2s[c, o]   += delta*(batch[i, o] - means[c, o])
+
+    n    = 0
+    mean = np.zeros(n_outputs)
+    M2   = np.zeros(n_outputs)
+    for c in range(n_chunks):
+        n_c = (c+1)*n_paths//n_chunks - c*n_paths//n_chunks
+        if n_c == 0:
+            continue
+        n_new = n + n_c
+        for o in range(n_outputs):
+            delta    = means[c, o] - mean[o]
+            mean[o] += delta*n_c/n_new
+            M2[o]   += M2s[c, o] + delta**2*n*n_c/n_new
+        n = n_new
+    return n, mean, M2
+
+@njit(parallel=True, cache=True, nogil=True)
+def _batch_comoments(batch: np.ndarray):
+    """Count, column means and co-moment matrix (sums of the products of the deviations from the means) of a batch
+       in a single parallel pass, the multivariate version of _batch_moments: Welford's update C += (x - mean_old)(x - mean_new)^T
+       over the chunks of rows, then Chan's merge of the chunks.
+    """
+    n_paths, n_outputs = batch.shape
+    n_chunks           = max(min(N_CHUNKS, n_paths), 1)
+    means              = np.zeros((n_chunks, n_outputs))
+    Cs                 = np.zeros((n_chunks, n_outputs, n_outputs))
+
+    for c in prange(n_chunks):
+        start = c*n_paths//n_chunks
+        stop  = (c+1)*n_paths//n_chunks
+        delta = np.empty(n_outputs)
+        for i in range(start, stop):
+            k = i - start + 1
+            for o in range(n_outputs):
+                delta[o]     = batch[i, o] - means[c, o]
+                means[c, o] += delta[o]/k
+            for o in range(n_outputs):
+                d = batch[i, o] - means[c, o]
+                for p in range(n_outputs):
+                    Cs[c, p, o] += delta[p]*d
+
+    n    = 0
+    mean = np.zeros(n_outputs)
+    C    = np.zeros((n_outputs, n_outputs))
+    for c in range(n_chunks):
+        n_c = (c+1)*n_paths//n_chunks - c*n_paths//n_chunks
+        if n_c == 0:
+            continue
+        n_new = n + n_c
+        delta = means[c] - mean
+        C    += Cs[c] + np.outer(delta, delta)*(n*n_c/n_new)
+        mean += delta*(n_c/n_new)
+        n     = n_new
+    return n, mean, C
+
+@njit(cache=True, nogil=True)
+def _merge_moments(n_a:    int,
+                   mean_a: np.ndarray,
+                   M2_a:   np.ndarray,
+                   n_b:    int,
+                   mean_b: np.ndarray,
+                   M2_b:   np.ndarray):
+    """Chan's merge of the (count, means, sums of squared deviations) of two samples, callable from compiled code."""
+    if n_b == 0:
+        return n_a, mean_a.copy(), M2_a.copy()
+    n_new = n_a + n_b
+    delta = mean_b - mean_a
+    return n_new, mean_a + delta*(n_b/n_new), M2_a + M2_b + delta**2*(n_a*n_b/n_new)
+
+class MCStatistics:
+    """Streaming mean/variance accumulator of the Monte-Carlo estimates (Welford's recursion with Chan's parallel merge).
+       Holds the statistics of n_outputs estimates at once (e.g. one per strike), merges across threads, batches and processes.
+       The moments of a batch are taken by the compiled _batch_moments in one parallel pass over the payoff values, after the payoff
+       kernel has produced them, and merged by the compiled _merge_moments; both can be used from compiled code on their own.
+    """
+    def __init__(self, n_outputs):
+        self.n    = 0
+        self.mean = np.zeros(n_outputs)
+        self.M2   = np.zeros(n_outputs)
+
+    def merge_moments(self, n, mean, M2):
+        self.n, self.mean, self.M2 = _merge_moments(self.n, self.mean, self.M2, n,
+                                                    np.asarray(mean, dtype=np.float64), np.asarray(M2, dtype=np.float64))
+
+    def merge(self, other):
+        self.merge_moments(other.n, other.mean, other.M2)
+
+    def update(self, batch):
+        n, mean, M2 = _batch_moments(batch)
+        self.merge_moments(n, mean, M2)
+
+    def variance(self):
+        return self.M2/max(self.n - 1, 1)
+
+    def std_error(self):
+        return np.sqrt(self.variance()/max(self.n, 1))
+
+    def conf_interval_length(self, confidence_level):
+        return -2*_norm_ppf(confidence_level*0.5)*self.std_error()
+
+    def conf_interval(self, confidence_level):
+        half = 0.5*self.conf_interval_length(confidence_level)
+        return self.mean - half, self.mean + half
+
+class MCRegressionStatistics:
+    """Streaming means and co-moment matrix of a payoff and its control variates for the regression (multiple control variates) estimator.
+       The columns of the batches are the payoff Y followed by the control variates X_1, ..., X_k. The coefficients of the least-squares
+       fit of Y on X are estimated on all the paths seen so far, so the pilot paths count towards the price as well.
+       The means and co-moments of a batch are taken by the compiled _batch_comoments in one parallel pass.
+    """
+    def __init__(self, n_controls):
+        self.n    = 0
+        self.mean = np.zeros(n_controls + 1)
+        self.C    = np.zeros((n_controls + 1, n_controls + 1))
+
+    def merge_moments(self, n, mean, C):
+        if n == 0:
+            return
+        n_new     = self.n + n
+        delta     = mean - self.mean
+        self.C    = self.C + C + np.outer(delta, delta)*(self.n*n/n_new)
+        self.mean = self.mean + delta*(n/n_new)
+        self.n    = n_new
+
+    def merge(self, other):
+        self.merge_moments(other.n, other.mean, other.C)
+
+    def update(self, batch):
+        """Adds the rows of the batch and returns their column means."""
+        n, mean, C = _batch_comoments(batch)
+        self.merge_moments(n, mean, C)
+        return mean
+
+    def coefficients(self):
+        return np.linalg.lstsq(np.ascontiguousarray(self.C[1:, 1:]), np.ascontiguousarray(self.C[1:, 0]))[0]
+
+    def estimate(self, mu):
+        """The estimate mean(Y) - beta (mean(X) - mu) of E[Y] given the exact means mu of the control variates and its standard error,
+           which accounts for the estimation of the coefficients beta."""
+        beta = self.coefficients()
+        d    = mu - self.mean[1:]
+        s2   = max(self.C[0, 0] - np.dot(beta, np.ascontiguousarray(self.C[1:, 0])), 0.)/max(self.n - len(beta) - 1, 1)
+        h    = np.dot(d, np.linalg.lstsq(np.ascontiguousarray(self.C[1:, 1:]), d)[0])
+        return self.mean[0] + np.dot(beta, d), np.sqrt(s2*(1./max(self.n, 1) + h))
+
+def statistics_from_moments(n:    int,
+                            mean: np.ndarray,
+                            M2:   np.ndarray) -> MCStatistics:
+    """Rebuilds MCStatistics from the (n, mean, M2) triple, e.g. after it was sent from a worker process.
+    Args:
+        n (int):          Number of paths.
+        mean (np.ndarray): Means of the estimates.
+        M2 (np.ndarray):   Sums of squared deviations of the estimates.
+    Returns:
+        The accumulator.
+    """
+    mean  = np.atleast_1d(np.asarray(mean, dtype=np.float64))
+    stats = MCStatistics(len(mean))
+    stats.merge_moments(n, mean, np.atleast_1d(np.asarray(M2, dtype=np.float64)))
+    return stats
 
 def get_len_conf_interval(data:             np.ndarray, 
                           confidence_level: float = 0.05):
@@ -52,12 +266,311 @@ def get_len_conf_interval(data:             np.ndarray,
     Returns:
         The confidence interval.
     """
-    return -2*norm.ppf(confidence_level*0.5) * sqrt(np.var(data) / len(data))
+    return -2*_norm_ppf(confidence_level*0.5) * sqrt(np.var(data) / len(data))
 
 @njit
 def set_seed(value):
     np.random.seed(value)
 
+@njit(cache=True, nogil=True)
+def _philox4x32(c0: np.uint64,
+                c1: np.uint64,
+                c2: np.uint64,
+                c3: np.uint64,
+                k0: np.uint64,
+                k1: np.uint64):
+    """Philox4x32-10 counter-based bijection (Salmon et al., 2011). The 32-bit words are carried in uint64 variables."""
+    mask = np.uint64(0xFFFFFFFF)
+    M0   = np.uint64(0xD2511F53)
+    M1   = np.uint64(0xCD9E8D57)
+    W0   = np.uint64(0x9E3779B9)
+    W1   = np.uint64(0xBB67AE85)
+    for _ in range(10):
+        p0 = M0 * c0
+        p1 = M1 * c2
+        c0, c1, c2, c3 = ((p1 >> np.uint64(32)) ^ c1 ^ k0), (p1 & mask), ((p0 >> np.uint64(32)) ^ c3 ^ k1), (p0 & mask)
+        k0 = (k0 + W0) & mask
+        k1 = (k1 + W1) & mask
+    return c0, c1, c2, c3
+
+@njit(cache=True, nogil=True)
+def _counter_uniform_pair(seed: int,
+                          path: int,
+                          step: int,
+                          sub:  int = 0):
+    """A pair of independent 53-bit uniforms in (0, 1) that depends only on (seed, path, step, sub).
+       The last Philox counter word sub numbers the draws of a path at a step for the samplers that need more than two."""
+    mask           = np.uint64(0xFFFFFFFF)
+    s, p           = np.uint64(seed), np.uint64(path)
+    x0, x1, x2, x3 = _philox4x32(p & mask, p >> np.uint64(32), np.uint64(step) & mask, np.uint64(sub) & mask,
+                                 s & mask, s >> np.uint64(32))
+    u1 = (float((x0 << np.uint64(21)) ^ (x1 >> np.uint64(11))) + 0.5) * 2.**-53
+    u2 = (float((x2 << np.uint64(21)) ^ (x3 >> np.uint64(11))) + 0.5) * 2.**-53
+    return u1, u2
+
+@njit(cache=True, nogil=True)
+def _counter_normal_pair(seed: int,
+                         path: int,
+                         step: int,
+                         sub:  int = 0):
+    """A pair of independent standard normals that depends only on (seed, path, step, sub).
+       The uniforms of _counter_uniform_pair are turned into normals by the Box-Muller transform."""
+    u1, u2 = _counter_uniform_pair(seed, path, step, sub)
+    R      = sqrt(-2.*log(u1))
+    return R*cos(2.*pi*u2), R*sin(2.*pi*u2)
+
+@njit(cache=True, nogil=True)
+def _counter_poisson(lam:  float,
+                     seed: int,
+                     path: int,
+                     step: int,
+                     sub:  int):
+    """Poisson variate of mean lam from the counter-based uniforms of (seed, path, step) starting at sub:
+       inversion for lam < 10, otherwise the transformed rejection PTRS of Hormann (1993).
+    Returns:
+        The variate and the next unused sub.
+    """
+    if lam < 10.:
+        u, _ = _counter_uniform_pair(seed, path, step, sub)
+        k    = 0
+        p    = exp(-lam)
+        F    = p
+        while u > F and k < 1000:
+            k += 1
+            p *= lam/k
+            F += p
+        return k, sub + 1
+
+    slam     = sqrt(lam)
+    loglam   = log(lam)
+    b        = 0.931 + 2.53*slam
+    a        = -0.059 + 0.02483*b
+    invalpha = 1.1239 + 1.1328/(b - 3.4)
+    vr       = 0.9277 - 3.6224/(b - 2.)
+    while True:
+        U, V = _counter_uniform_pair(seed, path, step, sub)
+        sub += 1
+        U   -= 0.5
+        us   = 0.5 - abs(U)
+        k    = int(floor((2.*a/us + b)*U + lam + 0.43))
+        if us >= 0.07 and V <= vr:
+            return k, sub
+        if k < 0 or (us < 0.013 and V > us):
+            continue
+        if log(V) + log(invalpha) - log(a/(us*us) + b) <= -lam + k*loglam - lgamma(k + 1.):
+            return k, sub
+
+@njit(cache=True, nogil=True)
+def _counter_gamma(shape: float,
+                   seed:  int,
+                   path:  int,
+                   step:  int,
+                   sub:   int):
+    """Gamma(shape, 1) variate from the counter-based uniforms of (seed, path, step) starting at sub by the method of
+       Marsaglia & Tsang (2000), a shape below 1 being sampled as Gamma(shape + 1) U^(1/shape).
+    Returns:
+        The variate and the next unused sub.
+    """
+    boost = 1.
+    if shape < 1.:
+        u, _   = _counter_uniform_pair(seed, path, step, sub)
+        sub   += 1
+        boost  = u**(1./shape)
+        shape += 1.
+
+    d = shape - 1./3.
+    c = 1./sqrt(9.*d)
+    while True:
+        x, _ = _counter_normal_pair(seed, path, step, sub)
+        u, _ = _counter_uniform_pair(seed, path, step, sub + 1)
+        sub += 2
+        v    = 1. + c*x
+        if v <= 0.:
+            continue
+        v = v*v*v
+        if u < 1. - 0.0331*x**4 or log(u) < 0.5*x*x + d*(1. - v + log(v)):
+            return boost*d*v, sub
+
+@njit(parallel=True, cache=True, nogil=True)
+def _standard_normals(n_simulations: int,
+                      N_T:           int,
+                      seed:          int = -1,
+                      path_offset:   int = 0,
+                      step_offset:   int = 0):
+    """Draws the normals Z of shape (2, n_simulations, N_T) consumed by the simulation engines.
+       For a negative seed the global Numba generator is used, otherwise Z[:, n, i] is the counter-based pair
+       keyed by (seed, path_offset + n, step_offset + i), so it does not depend on the batch layout or the number of threads.
+    """
+    if seed < 0:
+        return np.random.standard_normal(size=(2, n_simulations, N_T))
+
+    Z = np.empty((2, n_simulations, N_T))
+    _fill_standard_normals(Z, n_simulations, seed, path_offset, step_offset)
+    return Z
+
+@njit(parallel=True, cache=True, nogil=True)
+def _fill_standard_normals(Z:             np.ndarray,
+                           n_simulations: int,
+                           seed:          int = -1,
+                           path_offset:   int = 0,
+                           step_offset:   int = 0):
+    """Fills Z[:, :n_simulations] of a preallocated buffer of shape (2, n, N_T) with the normals of _standard_normals without allocating."""
+    N_T = Z.shape[2]
+    if seed < 0:
+        for d in range(2):
+            for n in range(n_simulations):
+                for i in range(N_T):
+                    Z[d, n, i] = np.random.standard_normal()
+        return
+
+    for n in prange(n_simulations):
+        for i in range(N_T):
+            Z[0, n, i], Z[1, n, i] = _counter_normal_pair(seed, path_offset + n, step_offset + i)
+
+SimulationWorkspace = namedtuple('SimulationWorkspace', ['Z', 'V', 'logS', 'S'])
+
+def make_workspace(n_simulations: int,
+                   N_T:           int,
+                   storage_dtype: type = np.float64) -> SimulationWorkspace:
+    """Preallocated buffers of the full-path engines (simulate_heston_euler, _andersen_qe, _em, _andersen_tg), so that
+       the batches of a Monte-Carlo run reuse the same memory instead of allocating and page-faulting four arrays per batch.
+    Args:
+        n_simulations (int):            Largest number of simulations per batch.
+        N_T (int):                      Number of steps in time.
+        storage_dtype (type, optional): Floating-point type of the paths, the same as the storage_dtype passed to the engine.
+                                        Defaults to np.float64.
+    Returns:
+        The namedtuple of the normals Z of shape (2, n_simulations, N_T) and of the paths V, logS, S of shape (4*n_simulations, N_T).
+    """
+    return SimulationWorkspace(np.empty((2, n_simulations, N_T)),
+                               np.empty((4*n_simulations, N_T), storage_dtype),
+                               np.empty((4*n_simulations, N_T), storage_dtype),
+                               np.empty((4*n_simulations, N_T), storage_dtype))
+
+def brownian_bridge_schedule(n_steps: int):
+    """Construction order of the Brownian bridge over the time points 1, ..., n_steps (W_0 = 0, unit steps):
+       the end point first, then the midpoints of the known intervals level by level.
+    Returns:
+        The arrays (index, left, right, w_left, w_right, sigma): the k-th normal sets
+        W[index[k]] = w_left[k]*W[left[k]] + w_right[k]*W[right[k]] + sigma[k]*z_k.
+    """
+    index, left, right = [n_steps], [0], [0]
+    w_left, w_right    = [0.], [0.]
+    sigma              = [sqrt(n_steps)]
+
+    intervals = [(0, n_steps)]
+    while intervals:
+        next_level = []
+        for l, r in intervals:
+            if r - l < 2:
+                continue
+            mid = (l + r)//2
+            index.append(mid)
+            left.append(l)
+            right.append(r)
+            w_left.append((r - mid)/(r - l))
+            w_right.append((mid - l)/(r - l))
+            sigma.append(sqrt((mid - l)*(r - mid)/(r - l)))
+            next_level += [(l, mid), (mid, r)]
+        intervals = next_level
+
+    return (np.array(index), np.array(left), np.array(right),
+            np.array(w_left), np.array(w_right), np.array(sigma))
+
+@njit(parallel=True, cache=True, nogil=True)
+def _brownian_bridge_increments(z:       np.ndarray,
+                                index:   np.ndarray,
+                                left:    np.ndarray,
+                                right:   np.ndarray,
+                                w_left:  np.ndarray,
+                                w_right: np.ndarray,
+                                sigma:   np.ndarray):
+    """Builds the Brownian paths from the normals z of shape (n_simulations, n_steps) in the bridge order and
+       returns their increments, i.e. standard normals of the same shape in the time order."""
+    n, m = z.shape
+    out  = np.empty((n, m))
+    for p in prange(n):
+        W    = np.zeros(m + 1)
+        for k in range(m):
+            W[index[k]] = w_left[k]*W[left[k]] + w_right[k]*W[right[k]] + sigma[k]*z[p, k]
+        for i in range(m):
+            out[p, i] = W[i+1] - W[i]
+    return out
+
+def sobol_normals(n_simulations: int,
+                  N_T:           int,
+                  rng:           Union[int, np.random.Generator] = None,
+                  bridge:        bool = True) -> np.ndarray:
+    """Randomised quasi-Monte Carlo normals for the engines: one scrambled Sobol point of dimension 2*(N_T - 1) per path,
+       mapped to normals by the inverse normal distribution function.
+       With bridge the dimensions are allocated by the Brownian bridge, the first (best distributed) ones to the end point
+       and the coarse midpoints of both Brownian motions, which concentrates the variance of smooth payoffs in the first dimensions.
+       Every call is an independent scramble, so the estimates of different calls are i.i.d. and unbiased.
+    Args:
+        n_simulations (int):                               Number of points, a power of 2 keeps the balance properties of the Sobol sequence.
+        N_T (int):                                         Number of time points of the engine.
+        rng (Union[int, np.random.Generator], optional):   Seed or generator of the scrambling. Defaults to None.
+        bridge (bool, optional):                           Use the Brownian bridge ordering. Defaults to True.
+    Returns:
+        The normals of shape (2, n_simulations, N_T) to be passed to the engines as normals. The last time point is not used by the engines and is 0.
+    """
+    from scipy.stats import qmc
+    from scipy.special import ndtri
+
+    m = N_T - 1
+    Z = np.zeros((2, n_simulations, N_T))
+    if m < 1:
+        return Z
+
+    u = qmc.Sobol(d=2*m, scramble=True, seed=rng).random(n_simulations)
+    z = ndtri(np.clip(u, 1e-16, 1. - 1e-16))
+
+    if bridge:
+        schedule = brownian_bridge_schedule(m)
+        for d in range(2):
+            Z[d, :, :m] = _brownian_bridge_increments(np.ascontiguousarray(z[:, d::2]), *schedule)
+    else:
+        for d in range(2):
+            Z[d, :, :m] = z[:, d::2]
+    return Z
+
+PLAN_SAFETY = 1.05
+
+def _payoff_values(payoff: Callable,
+                   S:      np.ndarray) -> np.ndarray:
+    """payoff(S), called through the cached kernel and the bound terms of the Payoff of derivatives.py without the extra
+       Python call of the Payoff. Any other callable is called as is."""
+    kernel = getattr(payoff, 'kernel', None)
+    return payoff(S) if kernel is None else kernel(S, *payoff.terms)
+
+def _add_engine_buffers(simulate: Callable,
+                        args:     dict,
+                        n_max:    int):
+    """Adds to the arguments of the engine the buffers reused by all the batches, unless they are given: the workspace of
+       the full-path engines for n_max simulations and the memoised characteristic function cache of simulate_heston_broadie_kaya."""
+    parameters = inspect.signature(getattr(simulate, 'py_func', simulate)).parameters
+    if 'workspace' in parameters and 'workspace' not in args:
+        args['workspace'] = make_workspace(n_max, args['N_T'], args.get('storage_dtype', np.float64))
+    if 'bk_cache' in parameters and 'bk_cache' not in args:
+        args['bk_cache']  = broadie_kaya_cache(args['heston_params'], args['T'], args['N_T'],
+                                               args.get('n_levels', parameters['n_levels'].default),
+                                               args.get('max_terms', parameters['max_terms'].default))
+
+def _planned_batch_size(n_paths:              int,
+                        std_error:            float,
+                        absolute_error:       float,
+                        C:                    float,
+                        paths_per_simulation: float,
+                        max_batch_size:       int) -> int:
+    """Number of simulations of the next batch in the planned mode of mc_price. The standard deviation estimated so far gives
+       the total number of paths (C sigma/absolute_error)^2 needed for the confidence interval, increased by PLAN_SAFETY so that
+       a correction is rarely needed, and the remaining paths are split into the fewest equal batches of at most max_batch_size simulations.
+    """
+    sigma     = std_error*sqrt(n_paths)
+    remaining = max(PLAN_SAFETY*(C*sigma/absolute_error)**2 - n_paths, 1.)/paths_per_simulation
+    n_batches = ceil(remaining/max_batch_size)
+    return int(ceil(remaining/n_batches))
+
 def mc_price(payoff:                 Callable,
              simulate:               Callable,
              state:                  MarketState,
@@ -73,6 +586,12 @@ def mc_price(payoff:                 Callable,
              mu:                     float    = None,
              verbose:                bool     = False,
              random_seed:            int      = None,
+             counter_rng:            bool     = False,
+             return_statistics:      bool     = False,
+             qmc_scrambles:          int      = 0,
+             plan_batches:           bool     = False,
+             max_batch_size:         int      = None,
+             log_prices:             bool     = False,
              **kwargs):
     """A function that performs a Monte-Carlo based pricing of a derivative with a given payoff (possibly path-dependent) under the Heston model.
     Args:
@@ -86,13 +605,37 @@ def mc_price(payoff:                 Callable,
         confidence_level (float, optional):          Confidence level for the price. Defaults to 0.05.
         batch_size (int, optional):                  Path-batch size. Defaults to 10_000.
         MAX_ITER (int, optional):                    Maximum number of iterations. Defaults to 100_000.  
-        control_variate_payoff (Callable, optional): Control variate payoff. Defaults to None.
-        control_variate_iter (int, optional):        Number of iterations for the control variate. Defaults to 1_000.
+        control_variate_payoff (Callable, optional): Control variate payoff or a list of them, e.g. terminal_stock_payoff, european_call_payoff and
+                                                     asian_call_GM_payoff of derivatives.py. The price is estimated by the regression of the payoff
+                                                     on the control variates, with the coefficients fitted on all the simulated paths. Defaults to None.
+        control_variate_iter (int, optional):        Number of pilot simulations run before the first check of the confidence interval, so that
+                                                     the coefficients are stable. The pilot paths count towards the price. Defaults to 1_000.
+        mu (float, optional):                        Exact means of the control variates, a number or a list aligned with control_variate_payoff.
+                                                     The missing ones (None) are computed with hestoncos.control_variate_mean from the closed forms
+                                                     on the simulated time grid. Defaults to None.
         verbose (bool, optional):                    Verbose flag. If true, the technical information is printed. Defaults to False.
         random_seed (int, optional):                 Random seed. Defaults to None.
+        counter_rng (bool, optional):                Use the counter-based generator of the engines keyed by random_seed, so that the price
+                                                     does not depend on the batch size or the number of threads. Defaults to False.
+        return_statistics (bool, optional):          Return the MCStatistics of the estimate (path count, standard error, CI) along with the price. Defaults to False.
+        qmc_scrambles (int, optional):               If positive, randomised quasi-Monte Carlo is used: every batch is an independent scramble of
+                                                     batch_size Sobol points with the Brownian bridge (see sobol_normals) fed to the engine as normals,
+                                                     the batch means are the i.i.d. samples of the estimate and the confidence interval uses Student's
+                                                     quantile. At least qmc_scrambles (>= 2) batches are run, batch_size should be a power of 2 and
+                                                     the engine must accept normals. The scrambling is seeded by random_seed. Defaults to 0.
+        plan_batches (bool, optional):               If true, the first batch of batch_size simulations is a pilot: the number of paths needed for
+                                                     the confidence interval is estimated from its variance and simulated in the fewest batches of
+                                                     at most max_batch_size simulations. If the interval is still too long, the plan is corrected with
+                                                     the updated variance until it is met (or MAX_ITER). Defaults to False.
+        max_batch_size (int, optional):              Largest number of simulations per call of the engine in the planned mode, which bounds
+                                                     the memory. Defaults to None (10 * batch_size).
+        log_prices (bool, optional):                 If true, the engine returns the log-prices and the payoffs get them as a float64 array,
+                                                     so the payoffs (and the control variates) must be the log-space ones of derivatives.py.
+                                                     Only the full-path engines support it. Defaults to False.
         **kwargs:                                    Additional arguments for the simulation engine.
     Returns:    
-        The price(-s) of the derivative(-s).    
+        The price(-s) of the derivative(-s), and the MCStatistics of the estimate if return_statistics is set.
+        With qmc_scrambles the statistics are those of the batch means.
     """
 
     arg = {'state':         state,
@@ -105,67 +648,587 @@ def mc_price(payoff:                 Callable,
     iter_count = 0   
 
     length_conf_interval = 1.
-    n                    = 0
-    C                    = -2*norm.ppf(confidence_level*0.5, loc = 0., scale = 1.)
-    # print(confidence_level*0.5, -2*norm.ppf(confidence_level*0.5, loc = 0., scale = 1.))
-    sigma_n              = 0.
-    batch_new            = np.zeros(batch_size, dtype=np.float64)
-    current_Pt_sum       = 0.        
-
-    if random_seed is not None:
+    C                    = -2*_norm_ppf(confidence_level*0.5)
+    stats                = MCStatistics(1)
+
+    if counter_rng:
+        if random_seed is None:
+            raise error("The counter-based generator requires a random seed.")
+        args['seed']        = random_seed
+        args['path_offset'] = 0
+    elif random_seed is not None:
         set_seed(random_seed)
 
+    if qmc_scrambles:
+        if qmc_scrambles < 2:
+            raise error("At least 2 scrambles are needed for the confidence interval.")
+        if counter_rng:
+            raise error("The quasi-random normals cannot be combined with the counter-based generator.")
+        from scipy.stats import t as student_t
+        rng = np.random.default_rng(random_seed)
+
+    if plan_batches:
+        if qmc_scrambles:
+            raise error("The planned batches cannot be combined with the quasi-random normals.")
+        if max_batch_size is None:
+            max_batch_size = 10*batch_size
+
+    if log_prices:
+        args['log_prices'] = True
+
+    def sample(args):
+        S = simulate(**args)[0]
+        return np.ascontiguousarray(S, dtype=np.float64) if log_prices else S
+
+    _add_engine_buffers(simulate, args, max(batch_size, max_batch_size if plan_batches else 0,
+                                            control_variate_iter if control_variate_payoff is not None else 0))
+
     if control_variate_payoff is None:
-        while length_conf_interval > absolute_error and iter_count < MAX_ITER:
-            temp  = simulate(**args)[0]
-            batch_new = payoff(temp)
+        while (length_conf_interval > absolute_error or iter_count < qmc_scrambles) and iter_count < MAX_ITER:
+            if qmc_scrambles:
+                args['normals'] = sobol_normals(batch_size, N_T, rng)
+            temp  = sample(args)
+            if counter_rng:
+                args['path_offset'] += args['n_simulations']
+            batch_new = _payoff_values(payoff, temp)
 
             iter_count+=1
 
-            sigma_n = (sigma_n*(n-1.) + np.var(batch_new)*(4.*batch_size - 1.))/(n + 4.*batch_size - 1.)
-            current_Pt_sum = current_Pt_sum + np.sum(batch_new) 
-
-            n+=4*batch_size
-            length_conf_interval = C * sqrt(sigma_n / n)
-            # print(sigma_n, length_conf_interval, n, C, sigma_n / n)
+            if qmc_scrambles:
+                stats.update(np.full((1, 1), np.mean(batch_new)))
+                length_conf_interval = -2*student_t.ppf(confidence_level*0.5, max(stats.n - 1, 1)) * stats.std_error()[0]
+            else:
+                stats.update(batch_new.reshape(-1, 1))
+                length_conf_interval = C * stats.std_error()[0]
+                if plan_batches and length_conf_interval > absolute_error:
+                    args['n_simulations'] = _planned_batch_size(stats.n, stats.std_error()[0], absolute_error, C,
+                                                                len(batch_new)/args['n_simulations'], max_batch_size)
     else:
-        if mu == None:
-            return "NaN"
-
-        S = simulate(state = state, heston_params = heston_params, T = T, N_T = N_T, n_simulations = control_variate_iter, **kwargs)[0]
-        s1 = payoff(S)
-        s2 = control_variate_payoff(S)
-        c = np.cov(s1, s2)
-        theta = c[0, 1] / c[1, 1]
-        while length_conf_interval > absolute_error and iter_count < MAX_ITER:
-            temp  = simulate(**args)[0]
-            batch_new = payoff(temp) - theta * (control_variate_payoff(temp) - mu)
+        controls = list(control_variate_payoff) if isinstance(control_variate_payoff, (list, tuple)) else [control_variate_payoff]
+        mu       = list(mu) if isinstance(mu, (list, tuple, np.ndarray)) else [mu]*len(controls)
+        if len(mu) != len(controls):
+            raise error("The number of the control variate means does not match the number of the control variates.")
+        if any(m is None for m in mu):
+            from hestoncos import control_variate_mean
+            mu = [control_variate_mean(cv, state, heston_params, T, N_T) if m is None else m for cv, m in zip(controls, mu)]
+        mu = np.array(mu, dtype=np.float64)
+
+        def evaluate(S):
+            return np.ascontiguousarray(np.column_stack([_payoff_values(payoff, S)] + [_payoff_values(cv, S) for cv in controls]), dtype=np.float64)
+
+        regression = MCRegressionStatistics(len(controls))
+        if control_variate_iter > 0:
+            regression.update(evaluate(sample({**args, 'n_simulations': control_variate_iter})))
+            if counter_rng:
+                args['path_offset'] += control_variate_iter
+
+        batch_means = []
+        while (length_conf_interval > absolute_error or iter_count < qmc_scrambles) and iter_count < MAX_ITER:
+            if qmc_scrambles:
+                args['normals'] = sobol_normals(batch_size, N_T, rng)
+            temp  = sample(args)
+            if counter_rng:
+                args['path_offset'] += args['n_simulations']
+            batch_new = evaluate(temp)
             iter_count+=1
 
-            sigma_n = (sigma_n*(n-1.) + np.var(batch_new)*(4*batch_size - 1.))/(n + 4*batch_size - 1.)
-            current_Pt_sum = current_Pt_sum + np.sum(batch_new) 
+            batch_mean = regression.update(batch_new)
+            if qmc_scrambles:
+                # the scrambles are the i.i.d. samples, adjusted with the coefficients fitted on all the paths
+                batch_means.append(batch_mean)
+                means = np.array(batch_means)
+                stats = MCStatistics(1)
+                stats.update((means[:, 0] + (mu - means[:, 1:]) @ regression.coefficients()).reshape(-1, 1))
+                length_conf_interval = -2*student_t.ppf(confidence_level*0.5, max(stats.n - 1, 1)) * stats.std_error()[0]
+            else:
+                price, std_error     = regression.estimate(mu)
+                length_conf_interval = C * std_error
+                if plan_batches and length_conf_interval > absolute_error:
+                    args['n_simulations'] = _planned_batch_size(regression.n, std_error, absolute_error, C,
+                                                                len(batch_new)/args['n_simulations'], max_batch_size)
 
-            n+=4*batch_size
-            length_conf_interval = C * np.sqrt(sigma_n / n)
+        if not qmc_scrambles:
+            price, std_error = regression.estimate(mu)
+            stats            = statistics_from_moments(regression.n, price, std_error**2*regression.n*max(regression.n - 1, 1))
 
     if verbose:
         if random_seed is not None:
             print(f"Random seed:                {random_seed}")
 
         if control_variate_payoff is not None:
-            print(f"Control variate payoff:     {control_variate_payoff.__name__}")
+            print(f"Control variate payoffs:    {', '.join(cv.__name__ for cv in controls)}")
+            print(f"Control variate means:      {mu}")
+            print(f"Control variate coeffs:     {regression.coefficients()}")
             print(f"Control variate iterations: {control_variate_iter}")
         
-        print(f"Number of simulate calls:   {iter_count}\nMAX_ITER:                   {MAX_ITER}\nNumber of paths:            {n}\nAbsolute error:             {absolute_error}\nLength of the conf intl:    {length_conf_interval}\nConfidence level:           {confidence_level}\n")
+        if qmc_scrambles:
+            print(f"Number of scrambles:        {stats.n}")
+
+        print(f"Number of simulate calls:   {iter_count}\nMAX_ITER:                   {MAX_ITER}\nNumber of paths:            {iter_count*len(batch_new) if qmc_scrambles else stats.n}\nAbsolute error:             {absolute_error}\nLength of the conf intl:    {length_conf_interval}\nConfidence level:           {confidence_level}\n")
+
+    if return_statistics:
+        return stats.mean[0], stats
+    return stats.mean[0]
+
+def mc_price_strikes(payoff_family:     Callable,
+                     strikes:           np.ndarray,
+                     simulate:          Callable,
+                     state:             MarketState,
+                     heston_params:     HestonParameters,
+                     T:                 float = 1.,
+                     N_T:               int   = 100,
+                     absolute_error:    float = 0.01,
+                     confidence_level:  float = 0.05,
+                     batch_size:        int   = 10_000,
+                     MAX_ITER:          int   = 100_000,
+                     verbose:           bool  = False,
+                     random_seed:       int   = None,
+                     counter_rng:       bool  = False,
+                     return_statistics: bool  = False,
+                     **kwargs):
+    """Monte-Carlo pricing of a whole strike ladder of a payoff family on the same simulated paths.
+       Every batch is simulated once and evaluated for all the strikes, the simulation goes on until the
+       confidence interval of every strike is shorter than absolute_error.
+    Args:
+        payoff_family (Callable):           Payoff family, i.e. a function of (maturity, strikes, interest_rate) returning a payoff
+                                            that maps the simulated prices to the matrix of discounted payoffs of shape (n_paths, len(strikes)),
+                                            e.g. european_call_strikes_payoff.
+        strikes (np.ndarray):               Strikes of the ladder.
+        simulate (Callable):                Simulation engine
+        state (MarketState):                Market state
+        heston_params (HestonParameters):   Heston parameters
+        T (float, optional):                Contract expiration T. Defaults to 1..
+        N_T (int, optional):                Number of steps in time. Defaults to 100.
+        absolute_error (float, optional):   Absolute error of every price. Defaults to 0.01 (corresponds to 1 cent).
+        confidence_level (float, optional): Confidence level for the prices. Defaults to 0.05.
+        batch_size (int, optional):         Path-batch size. Defaults to 10_000.
+        MAX_ITER (int, optional):           Maximum number of iterations. Defaults to 100_000.
+        verbose (bool, optional):           Verbose flag. If true, the technical information is printed. Defaults to False.
+        random_seed (int, optional):        Random seed. Defaults to None.
+        counter_rng (bool, optional):       Use the counter-based generator of the engines keyed by random_seed. Defaults to False.
+        return_statistics (bool, optional): Also return the MCStatistics of the estimates. Defaults to False.
+        **kwargs:                           Additional arguments for the simulation engine.
+    Returns:
+        A tuple of the arrays of prices and of confidence interval lengths, one entry per strike,
+        followed by the MCStatistics of the estimates if return_statistics is set.
+    """
+    strikes = np.asarray(strikes, dtype=np.float64)
+    payoff  = payoff_family(T, strikes, state.interest_rate)
+
+    args    = {'state':         state,
+               'heston_params': heston_params,
+               'T':             T,
+               'N_T':           N_T,
+               'n_simulations': batch_size,
+               **kwargs}
+
+    iter_count           = 0
+    C                    = -2*_norm_ppf(confidence_level*0.5)
+    stats                = MCStatistics(len(strikes))
+    length_conf_interval = np.ones(len(strikes))
+
+    if counter_rng:
+        if random_seed is None:
+            raise error("The counter-based generator requires a random seed.")
+        args['seed']        = random_seed
+        args['path_offset'] = 0
+    elif random_seed is not None:
+        set_seed(random_seed)
+
+    _add_engine_buffers(simulate, args, batch_size)
+
+    while np.max(length_conf_interval) > absolute_error and iter_count < MAX_ITER:
+        batch_new = _payoff_values(payoff, simulate(**args)[0])
+        if counter_rng:
+            args['path_offset'] += batch_size
+
+        iter_count += 1
 
-    return current_Pt_sum/n
+        stats.update(batch_new)
+        length_conf_interval = C * stats.std_error()
+
+    if verbose:
+        if random_seed is not None:
+            print(f"Random seed:                {random_seed}")
+
+        print(f"Number of strikes:          {len(strikes)}\nNumber of simulate calls:   {iter_count}\nMAX_ITER:                   {MAX_ITER}\nNumber of paths:            {stats.n}\nAbsolute error:             {absolute_error}\nMax length of conf intl:    {np.max(length_conf_interval)}\nConfidence level:           {confidence_level}\n")
+
+    if return_statistics:
+        return stats.mean.copy(), length_conf_interval, stats
+    return stats.mean.copy(), length_conf_interval
+
+def mc_price_portfolio(payoffs:           list,
+                       simulate:          Callable,
+                       state:             MarketState,
+                       heston_params:     HestonParameters,
+                       T:                 float = 1.,
+                       N_T:               int   = 100,
+                       weights:           np.ndarray = None,
+                       absolute_error:    float = 0.01,
+                       confidence_level:  float = 0.05,
+                       batch_size:        int   = 10_000,
+                       MAX_ITER:          int   = 100_000,
+                       verbose:           bool  = False,
+                       random_seed:       int   = None,
+                       counter_rng:       bool  = False,
+                       return_statistics: bool  = False,
+                       **kwargs):
+    """Monte-Carlo pricing of a portfolio of contracts on the same underlying in a single simulation pass.
+       Every batch is simulated once and evaluated for all the payoffs, the statistics of the contracts and of the portfolio
+       value are accumulated jointly, and the simulation goes on until the confidence interval of every contract is shorter than its tolerance.
+    Args:
+        payoffs (list):                     Payoffs of the contracts, e.g. of derivatives.py. A payoff returns either one value per path or
+                                            a matrix of shape (n_paths, n_contracts) like the strike families, whose columns are separate contracts.
+        simulate (Callable):                Simulation engine, its output must be accepted by all the payoffs.
+        state (MarketState):                Market state
+        heston_params (HestonParameters):   Heston parameters
+        T (float, optional):                Contract expiration T. Defaults to 1..
+        N_T (int, optional):                Number of steps in time. Defaults to 100.
+        weights (np.ndarray, optional):     Positions in the contracts, the portfolio value is their weighted sum. Defaults to None (ones).
+        absolute_error (float, optional):   Absolute error of the price of every contract, a number or an array with one entry per contract.
+                                            Defaults to 0.01 (corresponds to 1 cent).
+        confidence_level (float, optional): Confidence level for the prices. Defaults to 0.05.
+        batch_size (int, optional):         Path-batch size. Defaults to 10_000.
+        MAX_ITER (int, optional):           Maximum number of iterations. Defaults to 100_000.
+        verbose (bool, optional):           Verbose flag. If true, the technical information is printed. Defaults to False.
+        random_seed (int, optional):        Random seed. Defaults to None.
+        counter_rng (bool, optional):       Use the counter-based generator of the engines keyed by random_seed. Defaults to False.
+        return_statistics (bool, optional): Also return the MCStatistics of the estimates. Defaults to False.
+        **kwargs:                           Additional arguments for the simulation engine.
+    Returns:
+        A tuple of the arrays of prices and of confidence interval lengths with one entry per contract followed by the portfolio value,
+        and the MCStatistics of the estimates (in the same order) if return_statistics is set.
+    """
+    args = {'state':         state,
+            'heston_params': heston_params,
+            'T':             T,
+            'N_T':           N_T,
+            'n_simulations': batch_size,
+            **kwargs}
+
+    if counter_rng:
+        if random_seed is None:
+            raise error("The counter-based generator requires a random seed.")
+        args['seed']        = random_seed
+        args['path_offset'] = 0
+    elif random_seed is not None:
+        set_seed(random_seed)
+
+    _add_engine_buffers(simulate, args, batch_size)
+
+    S           = simulate(**args)[0]
+    if counter_rng:
+        args['path_offset'] += batch_size
+    values      = [np.asarray(_payoff_values(payoff, S)).reshape(S.shape[0], -1) for payoff in payoffs]
+    n_contracts = sum(value.shape[1] for value in values)
+
+    weights   = np.ones(n_contracts) if weights is None else np.asarray(weights, dtype=np.float64)
+    tolerance = np.broadcast_to(np.asarray(absolute_error, dtype=np.float64), (n_contracts,))
+    if len(weights) != n_contracts:
+        raise error(f"Got {len(weights)} weights for {n_contracts} contracts.")
+
+    iter_count = 0
+    C          = -2*_norm_ppf(confidence_level*0.5)
+    stats      = MCStatistics(n_contracts + 1)
+
+    while True:
+        batch_new = np.empty((S.shape[0], n_contracts + 1))
+        batch_new[:, :n_contracts] = np.hstack(values)
+        batch_new[:, n_contracts]  = batch_new[:, :n_contracts] @ weights
+        iter_count += 1
+
+        stats.update(batch_new)
+        length_conf_interval = C * stats.std_error()
+        if np.all(length_conf_interval[:n_contracts] <= tolerance) or iter_count >= MAX_ITER:
+            break
+
+        S = simulate(**args)[0]
+        if counter_rng:
+            args['path_offset'] += batch_size
+        values = [np.asarray(_payoff_values(payoff, S)).reshape(S.shape[0], -1) for payoff in payoffs]
+
+    if verbose:
+        if random_seed is not None:
+            print(f"Random seed:                {random_seed}")
+
+        print(f"Number of contracts:        {n_contracts}\nNumber of simulate calls:   {iter_count}\nMAX_ITER:                   {MAX_ITER}\nNumber of paths:            {stats.n}\nMax length of conf intl:    {np.max(length_conf_interval[:n_contracts])}\nPortfolio conf intl:        {length_conf_interval[n_contracts]}\nConfidence level:           {confidence_level}\n")
+
+    if return_statistics:
+        return stats.mean.copy(), length_conf_interval, stats
+    return stats.mean.copy(), length_conf_interval
+
+def precompile(engines:        tuple = None,
+               counter_rng:    tuple = (False, True),
+               log_prices:     tuple = (False, True),
+               storage_dtypes: tuple = (None,),
+               tg_tables:      dict  = None,
+               payoffs:        bool  = True,
+               verbose:        bool  = False) -> int:
+    """Compiles, or loads from the on-disk Numba cache, the engines with the argument types mc_price, mc_price_strikes and
+       mc_price_portfolio call them with, and the payoffs of derivatives.warm_up_payoffs. Meant to be run once at deploy time
+       (python benchmark.py --precompile), after which a new process loads the machine code from the cache instead of compiling it.
+       The specialisations depend only on the types of the arguments, so tiny batches are enough. The log-space payoffs take
+       the plain array of the log-prices, so they are cached like the other payoffs.
+    Args:
+        engines (tuple, optional):        Engines to compile. Defaults to None (the full-path and the terminal Euler, QE, TG and E+M engines).
+        counter_rng (tuple, optional):    Values of counter_rng of mc_price to cover. Defaults to (False, True).
+        log_prices (tuple, optional):     Values of log_prices of mc_price to cover for the full-path engines. Defaults to (False, True).
+        storage_dtypes (tuple, optional): Values of storage_dtype passed to the full-path engines, None leaves it at the default, which is
+                                          a different specialisation from passing np.float64. Defaults to (None,).
+        tg_tables (dict, optional):       The tables the TG engines will get. Memory-mapped tables of open_tg_tables are read-only arrays,
+                                          another specialisation than in-memory ones. Defaults to None (small in-memory tables).
+        payoffs (bool, optional):         Also compile the payoffs of derivatives. Defaults to True.
+        verbose (bool, optional):         Print the time of every engine. Defaults to False.
+    Returns:
+        The number of the compiled (or loaded) specialisations.
+    """
+    import time
+    import derivatives
+
+    tg_engines = (simulate_heston_andersen_tg, simulate_heston_andersen_tg_terminal)
+    if engines is None:
+        engines = (simulate_heston_euler, simulate_heston_andersen_qe, simulate_heston_andersen_tg, simulate_heston_em,
+                   simulate_heston_euler_terminal, simulate_heston_andersen_qe_terminal, simulate_heston_andersen_tg_terminal,
+                   simulate_heston_em_terminal)
+    if tg_tables is None and any(simulate in tg_engines for simulate in engines):
+        from tg_tables import build_tg_tables
+        tg_tables = build_tg_tables(N=1_000)
+
+    state         = MarketState(1., 0.)
+    heston_params = HestonParameters(1., 0.5, -0.5, 0.04, 0.04)
+    payoff        = derivatives.terminal_stock_payoff(1.)
+    log_payoff    = derivatives.terminal_stock_log_payoff(1.)
+
+    count = 0
+    for simulate in engines:
+        st         = time.perf_counter()
+        parameters = inspect.signature(getattr(simulate, 'py_func', simulate)).parameters
+        kwargs     = tg_tables if simulate in tg_engines else {}
+        for counter in counter_rng:
+            if counter and 'seed' not in parameters:
+                continue
+            for log in log_prices:
+                if log and 'log_prices' not in parameters:
+                    continue
+                for dtype in storage_dtypes:
+                    if dtype is not None and 'storage_dtype' not in parameters:
+                        continue
+                    mc_price(payoff = log_payoff if log else payoff, simulate = simulate, state = state, heston_params = heston_params,
+                             T = 1., N_T = 2, absolute_error = 0., batch_size = 1, MAX_ITER = 1, random_seed = 0, counter_rng = counter,
+                             log_prices = log, **kwargs, **({} if dtype is None else {'storage_dtype': dtype}))
+                    count += 1
+        if verbose:
+            print(f"{simulate.__name__:<40}{time.perf_counter() - st:>8.2f} s")
+
+    if payoffs:
+        count += derivatives.warm_up_payoffs(dtypes = tuple(dict.fromkeys(np.float64 if dtype is None else dtype for dtype in storage_dtypes)))
+    return count
+
+@njit(cache=True, nogil=True)
+def _antithetic_signs(k: int):
+    """Signs applied to the pair of normals (Z_S, Z_V) for the k-th of the four antithetic copies of a path."""
+    a = 1. if k % 2 == 0 else -1.
+    b = a if k < 2 else -a
+    return a, b
+
+ACC_MEAN     = 0
+ACC_LOG_MEAN = 1
+ACC_MAX      = 2
+ACC_MIN      = 3
+ACC_UP_HIT   = 4
+ACC_DOWN_HIT = 5
+
+@njit(cache=True, nogil=True)
+def _update_accumulators(out:      np.ndarray,
+                         j:        int,
+                         codes:    np.ndarray,
+                         barriers: np.ndarray,
+                         logS:     float,
+                         N_T:      int,
+                         first:    bool):
+    """Updates the online path accumulators of the j-th path with the log-price of a new monitoring date.
+       The accumulators are stored in out[j, :len(codes)], the monitoring dates are the N_T columns of the full path matrix.
+
+    Args:
+        out (np.ndarray):      Output matrix of the terminal engine.
+        j (int):               Index of the path.
+        codes (np.ndarray):    Accumulator codes (ACC_MEAN, ACC_LOG_MEAN, ACC_MAX, ACC_MIN, ACC_UP_HIT, ACC_DOWN_HIT).
+        barriers (np.ndarray): Barrier levels for the ACC_UP_HIT and ACC_DOWN_HIT accumulators, ignored for the others.
+        logS (float):          Log-price at the monitoring date.
+        N_T (int):             Number of monitoring dates.
+        first (bool):          Whether this is the first monitoring date, i.e. the accumulators have to be initialised.
+    """
+    S = exp(logS)
+    for c in range(codes.shape[0]):
+        code = codes[c]
+        if code == ACC_MEAN:
+            out[j, c] = S/N_T if first else out[j, c] + S/N_T
+        elif code == ACC_LOG_MEAN:
+            out[j, c] = logS/N_T if first else out[j, c] + logS/N_T
+        elif code == ACC_MAX:
+            out[j, c] = S if first else max(out[j, c], S)
+        elif code == ACC_MIN:
+            out[j, c] = S if first else min(out[j, c], S)
+        elif code == ACC_UP_HIT:
+            hit       = 1. if S >= barriers[c] else 0.
+            out[j, c] = hit if first else max(out[j, c], hit)
+        elif code == ACC_DOWN_HIT:
+            hit       = 1. if S <= barriers[c] else 0.
+            out[j, c] = hit if first else max(out[j, c], hit)
+
+@njit(cache=True, nogil=True)
+def _update_antithetic_accumulators(out:      np.ndarray,
+                                    j:        int,
+                                    codes:    np.ndarray,
+                                    barriers: np.ndarray,
+                                    x0:       float,
+                                    x1:       float,
+                                    x2:       float,
+                                    x3:       float,
+                                    N_T:      int,
+                                    first:    bool):
+    """_update_accumulators of the four antithetic copies j, ..., j+3 of a path with their log-prices x0, ..., x3."""
+    _update_accumulators(out, j,     codes, barriers, x0, N_T, first)
+    _update_accumulators(out, j + 1, codes, barriers, x1, N_T, first)
+    _update_accumulators(out, j + 2, codes, barriers, x2, N_T, first)
+    _update_accumulators(out, j + 3, codes, barriers, x3, N_T, first)
+
+@njit(cache=True, nogil=True)
+def _step_normals(normals:     np.ndarray,
+                  seed:        int,
+                  path_offset: int,
+                  n:           int,
+                  i:           int):
+    """The pair of normals (Z_S, Z_V) of the n-th path of a batch at the i-th step for the terminal engines: the external normals
+       if given, otherwise the counter-based pair keyed by (seed, path_offset + n, i) that the full-path engines draw for it."""
+    if normals is None:
+        return _counter_normal_pair(seed, path_offset + n, i)
+    return normals[0, n, i], normals[1, n, i]
+
+@njit(cache=True, nogil=True)
+def _euler_step(logS:       float,
+                V:          float,
+                z_S:        float,
+                z_V:        float,
+                r:          float,
+                kappa:      float,
+                vbar:       float,
+                gamma:      float,
+                rho:        float,
+                sqrt1_rho2: float,
+                dt:         float):
+    """One full-truncation Euler step of a single path. Returns the pair (logS, V) at the next time point."""
+    vmax       = max(V, 0)
+    sqrtvmaxdt = sqrt(vmax*dt)
+    logS_next  = logS + (r - 0.5 * vmax) * dt + sqrtvmaxdt * z_S
+    V_next     = V + kappa*(vbar - vmax)*dt + gamma*sqrtvmaxdt*(rho*z_S + sqrt1_rho2*z_V)
+    return logS_next, V_next
+
+@njit(cache=True, nogil=True)
+def _andersen_qe_step(logS:  float,
+                      V:     float,
+                      z_S:   float,
+                      z_V:   float,
+                      E:     float,
+                      p1:    float,
+                      p2:    float,
+                      p3:    float,
+                      rdtK0: float,
+                      K_1:   float,
+                      K_2:   float,
+                      K_3:   float,
+                      K_4:   float,
+                      Psi_c: float):
+    """One Quadratic-Exponential step of a single path. Returns the pair (logS, V) at the next time point."""
+    m   = p3 + V*E
+    s_2 = V*p1 + p2
+    Psi = s_2/(m**2)
+
+    if Psi <= Psi_c:
+        c      = 2. / Psi
+        b      = c - 1. + sqrt(c*(c - 1.))
+        a      = m/(1.+b)
+        b      = sqrt(b)
+        V_next = a*((b+z_V)**2)
+    else:
+        p      = (Psi - 1)/(Psi + 1)
+        beta   = (1.0 - p)/m
+        u      = Phi(z_V)
+        V_next = 0. if u < p else log((1.-p)/(1.-u))/beta
+
+    logS_next = logS + rdtK0 + K_1*V + K_2*V_next + sqrt(K_3*V+K_4*V_next) * z_S
+    return logS_next, V_next
+
+@njit(cache=True, nogil=True)
+def _andersen_tg_step(logS:         float,
+                      V:            float,
+                      z_S:          float,
+                      z_V:          float,
+                      E:            float,
+                      p1:           float,
+                      p2:           float,
+                      p3:           float,
+                      rdtK0:        float,
+                      K_1:          float,
+                      K_2:          float,
+                      K_3:          float,
+                      K_4:          float,
+                      x_grid:       np.ndarray,
+                      f_nu_grid:    np.ndarray,
+                      f_sigma_grid: np.ndarray,
+                      dx:           float):
+    """One Truncated Gaussian step of a single path. Returns the pair (logS, V) at the next time point."""
+    m   = p3 + V*E
+    s_2 = V*p1 + p2
+    Psi = s_2/(m**2)
+
+    if Psi > x_grid[-1]:
+        inx = x_grid.shape[0] -1
+    else:
+        inx = int(Psi/dx)
+
+    nu        = m*f_nu_grid[inx]
+    sigma     = sqrt(s_2)*f_sigma_grid[inx]
+
+    V_next    = max(nu + sigma*z_V, 0)
+    logS_next = logS + rdtK0 + K_1*V + K_2*V_next + sqrt(K_3*V+K_4*V_next) * z_S
+    return logS_next, V_next
+
+@njit(cache=True, nogil=True)
+def _em_step(logS:       float,
+             V:          float,
+             z_S:        float,
+             z_V:        float,
+             kappa:      float,
+             vbar:       float,
+             gamma:      float,
+             dt:         float,
+             rdtK0:      float,
+             K_1:        float,
+             K_2:        float,
+             K_3:        float,
+             K_4:        float):
+    """One E+M step of a single path: the full-truncation Milstein step of the variance and the exact log-price
+       given the variance with the integrated variance approximated as in the Andersen schemes.
+       Returns the pair (logS, V) at the next time point."""
+    vmax      = max(V, 0)
+    V_next    = V + kappa*(vbar - vmax)*dt + gamma*sqrt(vmax*dt)*z_V + 0.25*gamma**2*dt*(z_V**2 - 1.)
+    vmax_next = max(V_next, 0)
+    logS_next = logS + rdtK0 + K_1*vmax + K_2*vmax_next + sqrt(K_3*vmax + K_4*vmax_next) * z_S
+    return logS_next, V_next
 
 @njit(parallel=True, cache=True, nogil=True)
 def simulate_heston_euler(state:           MarketState,
                           heston_params:   HestonParameters,
                           T:               float = 1.,
                           N_T:             int   = 100,
-                          n_simulations:   int   = 10_000
+                          n_simulations:   int   = 10_000,
+                          seed:            int   = -1,
+                          path_offset:     int   = 0,
+                          normals:         np.ndarray = None,
+                          storage_dtype               = np.float64,
+                          workspace                   = None,
+                          log_prices                  = False
                           ) -> np.ndarray:
     """Simulation engine for the Heston model using the Euler scheme.
     Args:
@@ -174,54 +1237,155 @@ def simulate_heston_euler(state:           MarketState,
         T (float, optional):              Contract termination time expressed as a number of years. Defaults to 1..
         N_T (int, optional):              Number of steps in time. Defaults to 100.
         n_simulations (int, optional):    Number of simulations. Defaults to 10_000.
+        seed (int, optional):             Key of the counter-based generator, a negative value means the global one. Defaults to -1.
+        path_offset (int, optional):      Global index of the first path of the batch for the counter-based generator. Defaults to 0.
+        normals (np.ndarray, optional):   External standard normals of shape (2, n_simulations, N_T), e.g. from sobol_normals,
+                                          used instead of the generator. Defaults to None.
+        storage_dtype (type, optional):   Floating-point type the paths are stored in, np.float64 or np.float32. A storage option only:
+                                          every path is integrated in double precision and only the stored values are rounded, so the error
+                                          does not grow with N_T. np.float32 halves the memory of the paths, not the arithmetic.
+                                          Defaults to np.float64.
+        workspace (optional):             Preallocated buffers from make_workspace with the same N_T and storage_dtype and room for at least n_simulations,
+                                          used instead of allocating Z, V, logS and the prices. The returned arrays are views of the buffers and
+                                          are overwritten by the next call with the same workspace. Defaults to None.
+        log_prices (bool, optional):      Return the log-prices logS instead of exp(logS), e.g. for the log-space payoffs of
+                                          derivatives.py, which exponentiate only what they read. Defaults to False.
     Raises:
         error: Contract termination time must be positive.
     Returns:
         A tuple containing the simulated stock price and the simulated stochastic variance.
         The number of paths is doubled to account for the antithetic variates.
-    """    
+    """
     if T <= 0:
         raise error("Contract termination time must be positive.")
-    
+
     r, s0 = state.interest_rate, state.stock_price
     v0, rho, kappa, vbar, gamma = heston_params.v0, heston_params.rho, heston_params.kappa, heston_params.vbar, heston_params.gamma
-    
+
     dt         = T/float(N_T)
-    
-    Z          = np.random.standard_normal(size=(2, n_simulations, N_T))
-    V          = np.empty((4*n_simulations, N_T))
+    log_s0     = log(s0)
+
+    if workspace is None:
+        V      = np.empty((4*n_simulations, N_T), storage_dtype)
+        logS   = np.empty((4*n_simulations, N_T), storage_dtype)
+    else:
+        if workspace.V.shape[0] < 4*n_simulations or workspace.V.shape[1] != N_T:
+            raise error("The workspace does not fit the batch.")
+        V      = workspace.V[:4*n_simulations]
+        logS   = workspace.logS[:4*n_simulations]
     V[:, 0]    = v0
-    
-    logS       = np.empty((4*n_simulations, N_T))
-    logS[:, 0] = np.log(s0)
+    logS[:, 0] = log_s0
+
+    if normals is not None:
+        Z      = normals
+    elif workspace is None:
+        Z      = _standard_normals(n_simulations, N_T, seed, path_offset)
+    else:
+        Z      = workspace.Z
+        _fill_standard_normals(Z, n_simulations, seed, path_offset)
 
     sqrt1_rho2 = sqrt(1-rho**2)
 
     for n in prange(n_simulations):
-        for i in range(0,  N_T-1):
-            vmax             = max(V[4*n, i],0)
-            sqrtvmaxdt       = sqrt(vmax*dt)
-            logS[4*n, i+1]   = logS[4*n, i] + (r - 0.5 * vmax) * dt + sqrtvmaxdt * Z[0, n, i]
-            V[4*n, i+1]      = V[4*n, i] + kappa*(vbar - vmax)*dt + gamma*sqrtvmaxdt*(rho*Z[0, n, i]+sqrt1_rho2*Z[1, n, i])
+        for k in range(4):
+            a, b = _antithetic_signs(k)
+            j    = 4*n + k
+            x, v = log_s0, v0
+            for i in range(0,  N_T-1):
+                x, v = _euler_step(x, v, a*Z[0, n, i], b*Z[1, n, i],
+                                   r, kappa, vbar, gamma, rho, sqrt1_rho2, dt)
+                logS[j, i+1], V[j, i+1] = x, v
+
+    if log_prices:
+        return [logS, V]
+    if workspace is None:
+        return [np.exp(logS), V]
+    S = workspace.S[:4*n_simulations]
+    np.exp(logS, S)
+    return [S, V]
+
+@njit(parallel=True, cache=True, nogil=True)
+def simulate_heston_euler_terminal(state:         MarketState,
+                                   heston_params: HestonParameters,
+                                   T:             float = 1.,
+                                   N_T:           int   = 100,
+                                   n_simulations: int   = 10_000,
+                                   accumulators:  np.ndarray = None,
+                                   barriers:      np.ndarray = None,
+                                   seed:          int   = -1,
+                                   path_offset:   int   = 0,
+                                   normals:       np.ndarray = None
+                                   ) -> np.ndarray:
+    """Terminal-state-only version of simulate_heston_euler.
+       Only the running (logS, V) of every path is kept, so the memory footprint is O(n_simulations) instead of O(n_simulations * N_T).
+       Path-dependent quantities (averages, extrema, barrier hits) can be collected on the fly with the accumulators.
+
+    Args:
+        state (MarketState):                  Market state.
+        heston_params (HestonParameters):     Parameters of the Heston model.
+        T (float, optional):                  Contract termination time expressed as a number of years. Defaults to 1..
+        N_T (int, optional):                  Number of steps in time. Defaults to 100.
+        n_simulations (int, optional):        Number of simulations. Defaults to 10_000.
+        accumulators (np.ndarray, optional):  Codes of the online path accumulators (ACC_MEAN, ACC_LOG_MEAN, ACC_MAX, ACC_MIN,
+                                              ACC_UP_HIT, ACC_DOWN_HIT) updated at every monitoring date. Defaults to None.
+        barriers (np.ndarray, optional):      Barrier levels for the ACC_UP_HIT and ACC_DOWN_HIT accumulators, aligned with accumulators. Defaults to None.
+        seed (int, optional):                 Key of the counter-based generator, a negative value draws the key from the global one. Defaults to -1.
+        path_offset (int, optional):          Global index of the first path of the batch for the counter-based generator. Defaults to 0.
+        normals (np.ndarray, optional):       External standard normals of shape (2, n_simulations, N_T), e.g. from sobol_normals,
+                                              used instead of the generator. Defaults to None.
+    Raises:
+        error: Contract termination time must be positive.
+    Returns:
+        A tuple containing the path summary S of shape (4*n_simulations, len(accumulators) + 1) and the stochastic variance
+        at the last time point of shape (4*n_simulations, 1). The first columns of S hold the accumulators in the order they
+        were requested, the last one holds the stock price at the last time point, so that the payoffs reading S[:, -1] can be used as is.
+    """
+    if T <= 0:
+        raise error("Contract termination time must be positive.")
 
-            vmax             = max(V[4*n+1, i],0)
-            sqrtvmaxdt       = sqrt(vmax*dt)
-            logS[4*n+1, i+1] = logS[4*n+1, i] + (r - 0.5 * vmax) * dt - sqrtvmaxdt * Z[0, n, i]
-            V[4*n+1, i+1]    = V[4*n+1, i] + kappa*(vbar - vmax)*dt - gamma*sqrtvmaxdt*(rho*Z[0, n, i]+sqrt1_rho2*Z[1, n, i])
+    r, s0 = state.interest_rate, state.stock_price
+    v0, rho, kappa, vbar, gamma = heston_params.v0, heston_params.rho, heston_params.kappa, heston_params.vbar, heston_params.gamma
 
-            vmax             = max(V[4*n+2, i],0)
-            sqrtvmaxdt       = sqrt(vmax*dt)
-            logS[4*n+2, i+1] = logS[4*n+2, i] + (r - 0.5 * vmax) * dt + sqrtvmaxdt * Z[0, n, i]
-            V[4*n+2, i+1]    = V[4*n+2, i] + kappa*(vbar - vmax)*dt + gamma*sqrtvmaxdt*(rho*Z[0, n, i]-sqrt1_rho2*Z[1, n, i])
+    dt         = T/float(N_T)
+    sqrt1_rho2 = sqrt(1-rho**2)
 
-            vmax             = max(V[4*n+3, i],0)
-            sqrtvmaxdt       = sqrt(vmax*dt)
-            logS[4*n+3, i+1] = logS[4*n+3, i] + (r - 0.5 * vmax) * dt - sqrtvmaxdt * Z[0, n, i]
-            V[4*n+3, i+1]    = V[4*n+3, i] + kappa*(vbar - vmax)*dt + gamma*sqrtvmaxdt*(-rho*Z[0, n, i] + sqrt1_rho2*Z[1, n, i])
+    if accumulators is None:
+        codes  = np.empty(0, dtype=np.int64)
+    else:
+        codes  = accumulators
+    if barriers is None:
+        levels = np.zeros(codes.shape[0])
+    else:
+        levels = barriers
+    n_acc      = codes.shape[0]
 
+    V          = np.empty((4*n_simulations, 1))
+    S          = np.empty((4*n_simulations, n_acc + 1))
+    log_s0     = log(s0)
 
+    # the global generator only draws the key of the counter-based one, the normals are drawn in the loop over the paths
+    if normals is None and seed < 0:
+        seed   = np.random.randint(0, 2**62)
 
-    return [np.exp(logS), V]
+    # the four antithetic copies of a path are stepped together in the locals x (log-price) and w (variance)
+    for n in prange(n_simulations):
+        j              = 4*n
+        x0, x1, x2, x3 = log_s0, log_s0, log_s0, log_s0
+        w0, w1, w2, w3 = v0, v0, v0, v0
+        if n_acc > 0:
+            _update_antithetic_accumulators(S, j, codes, levels, x0, x1, x2, x3, N_T, True)
+        for i in range(N_T - 1):
+            z_S, z_V = _step_normals(normals, seed, path_offset, n, i)
+            x0, w0   = _euler_step(x0, w0,  z_S,  z_V, r, kappa, vbar, gamma, rho, sqrt1_rho2, dt)
+            x1, w1   = _euler_step(x1, w1, -z_S, -z_V, r, kappa, vbar, gamma, rho, sqrt1_rho2, dt)
+            x2, w2   = _euler_step(x2, w2,  z_S, -z_V, r, kappa, vbar, gamma, rho, sqrt1_rho2, dt)
+            x3, w3   = _euler_step(x3, w3, -z_S,  z_V, r, kappa, vbar, gamma, rho, sqrt1_rho2, dt)
+            if n_acc > 0:
+                _update_antithetic_accumulators(S, j, codes, levels, x0, x1, x2, x3, N_T, False)
+        S[j, n_acc], S[j + 1, n_acc], S[j + 2, n_acc], S[j + 3, n_acc] = exp(x0), exp(x1), exp(x2), exp(x3)
+        V[j, 0], V[j + 1, 0], V[j + 2, 0], V[j + 3, 0]                 = w0, w1, w2, w3
+
+    return [S, V]
 
 @njit(parallel=True, cache=True, nogil=True)
 def simulate_heston_andersen_qe(state:         MarketState,
@@ -230,8 +1394,14 @@ def simulate_heston_andersen_qe(state:         MarketState,
                                 N_T:           int   = 100,
                                 n_simulations: int   = 10_000,
                                 Psi_c:         float = 1.5,
-                                gamma_1:       float = 0.0     
-                                ) -> np.ndarray: 
+                                gamma_1:       float = 0.0,
+                                seed:          int   = -1,
+                                path_offset:   int   = 0,
+                                normals:       np.ndarray = None,
+                                storage_dtype             = np.float64,
+                                workspace                 = None,
+                                log_prices                = False
+                                ) -> np.ndarray:
     """Simulation engine for the Heston model using the Quadratic-Exponential Andersen scheme.
 
     Args:
@@ -242,6 +1412,19 @@ def simulate_heston_andersen_qe(state:         MarketState,
         n_simulations (int, optional):    Number of simulations. Defaults to 10_000.
         Psi_c (float, optional):          Critical value of \psi, i.e. the moment of the scheme switching. Defaults to 1.5.
         gamma_1 (float, optional):        Integration parameter. Defaults to 0.5.
+        seed (int, optional):             Key of the counter-based generator, a negative value means the global one. Defaults to -1.
+        path_offset (int, optional):      Global index of the first path of the batch for the counter-based generator. Defaults to 0.
+        normals (np.ndarray, optional):   External standard normals of shape (2, n_simulations, N_T), e.g. from sobol_normals,
+                                          used instead of the generator. Defaults to None.
+        storage_dtype (type, optional):   Floating-point type the paths are stored in, np.float64 or np.float32. A storage option only:
+                                          every path is integrated in double precision and only the stored values are rounded, so the error
+                                          does not grow with N_T. np.float32 halves the memory of the paths, not the arithmetic.
+                                          Defaults to np.float64.
+        workspace (optional):             Preallocated buffers from make_workspace with the same N_T and storage_dtype and room for at least n_simulations,
+                                          used instead of allocating Z, V, logS and the prices. The returned arrays are views of the buffers and
+                                          are overwritten by the next call with the same workspace. Defaults to None.
+        log_prices (bool, optional):      Return the log-prices logS instead of exp(logS), e.g. for the log-space payoffs of
+                                          derivatives.py, which exponentiate only what they read. Defaults to False.
 
     Raises:
         Error: The critical value \psi_c must be in the interval [1,2]
@@ -250,123 +1433,383 @@ def simulate_heston_andersen_qe(state:         MarketState,
     Returns:
         A tuple containing the simulated stock price and the simulated stochastic variance.
         The number of paths is doubled to account for the antithetic variates.
-    """    
-    
+    """
+
     if Psi_c>2 or Psi_c<1:
         raise error('The critical value \psi_c must be in the interval [1,2]')
     if gamma_1 >1 or gamma_1<0:
         raise error('The parameter \gamma_1 must be in the interval [0,1]')
     if T <= 0:
         raise error("Contract termination time must be positive.")
-        
+
     gamma_2 = 1.0 - gamma_1
-    
+
     r, s0 = state.interest_rate, state.stock_price
     v0, rho, kappa, vbar, gamma = heston_params.v0, heston_params.rho, heston_params.kappa, heston_params.vbar, heston_params.gamma
-    
+
     dt         = T/float(N_T)
+    log_s0     = log(s0)
     E          = exp(-kappa*dt)
     K_0        = -(rho*kappa*vbar/gamma)*dt
     K_1        = gamma_1 * dt * (rho*kappa/gamma - 0.5) - rho/gamma
     K_2        = gamma_2 * dt * (rho*kappa/gamma - 0.5) + rho/gamma
     K_3        = gamma_1 * dt * (1.0 - rho**2)
     K_4        = gamma_2 * dt * (1.0 - rho**2)
-        
-    V          = np.empty((4*n_simulations, N_T))
+
+    if workspace is None:
+        V      = np.empty((4*n_simulations, N_T), storage_dtype)
+        logS   = np.empty((4*n_simulations, N_T), storage_dtype)
+    else:
+        if workspace.V.shape[0] < 4*n_simulations or workspace.V.shape[1] != N_T:
+            raise error("The workspace does not fit the batch.")
+        V      = workspace.V[:4*n_simulations]
+        logS   = workspace.logS[:4*n_simulations]
     V[:, 0]    = v0
+    logS[:, 0] = log_s0
 
-    logS       = np.empty((4*n_simulations, N_T))
-    logS[:, 0] = np.log(s0)
+    if normals is not None:
+        Z      = normals
+    elif workspace is None:
+        Z      = _standard_normals(n_simulations, N_T, seed, path_offset)
+    else:
+        Z      = workspace.Z
+        _fill_standard_normals(Z, n_simulations, seed, path_offset)
+    p1         = (1. - E)*(gamma**2)*E/kappa
+    p2         = (vbar*gamma**2)/(2.0*kappa)*((1.-E)**2)
+    p3         = vbar * (1.- E)
+    rdtK0      = r*dt + K_0
+
+    for n in prange(n_simulations):
+        for k in range(4):
+            a, b = _antithetic_signs(k)
+            j    = 4*n + k
+            x, v = log_s0, v0
+            for i in range(N_T - 1):
+                x, v = _andersen_qe_step(x, v, a*Z[0, n, i], b*Z[1, n, i],
+                                         E, p1, p2, p3, rdtK0, K_1, K_2, K_3, K_4, Psi_c)
+                logS[j, i+1], V[j, i+1] = x, v
+
+    if log_prices:
+        return [logS, V]
+    if workspace is None:
+        return [np.exp(logS), V]
+    S = workspace.S[:4*n_simulations]
+    np.exp(logS, S)
+    return [S, V]
+
+@njit(parallel=True, cache=True, nogil=True)
+def simulate_heston_andersen_qe_terminal(state:         MarketState,
+                                         heston_params: HestonParameters,
+                                         T:             float = 1.,
+                                         N_T:           int   = 100,
+                                         n_simulations: int   = 10_000,
+                                         Psi_c:         float = 1.5,
+                                         gamma_1:       float = 0.0,
+                                         accumulators:  np.ndarray = None,
+                                         barriers:      np.ndarray = None,
+                                         seed:          int   = -1,
+                                         path_offset:   int   = 0,
+                                         normals:       np.ndarray = None
+                                         ) -> np.ndarray:
+    """Terminal-state-only version of simulate_heston_andersen_qe.
+       Only the running (logS, V) of every path is kept, so the memory footprint is O(n_simulations) instead of O(n_simulations * N_T).
+       Path-dependent quantities (averages, extrema, barrier hits) can be collected on the fly with the accumulators.
+
+    Args:
+        state (MarketState):                  Market state.
+        heston_params (HestonParameters):     Parameters of the Heston model.
+        T (float, optional):                  Contract termination time expressed as a non-integer amount of years. Defaults to 1..
+        N_T (int, optional):                  Number of steps in time. Defaults to 100.
+        n_simulations (int, optional):        Number of simulations. Defaults to 10_000.
+        Psi_c (float, optional):              Critical value of \psi, i.e. the moment of the scheme switching. Defaults to 1.5.
+        gamma_1 (float, optional):            Integration parameter. Defaults to 0.0.
+        accumulators (np.ndarray, optional):  Codes of the online path accumulators (ACC_MEAN, ACC_LOG_MEAN, ACC_MAX, ACC_MIN,
+                                              ACC_UP_HIT, ACC_DOWN_HIT) updated at every monitoring date. Defaults to None.
+        barriers (np.ndarray, optional):      Barrier levels for the ACC_UP_HIT and ACC_DOWN_HIT accumulators, aligned with accumulators. Defaults to None.
+        seed (int, optional):                 Key of the counter-based generator, a negative value draws the key from the global one. Defaults to -1.
+        path_offset (int, optional):          Global index of the first path of the batch for the counter-based generator. Defaults to 0.
+        normals (np.ndarray, optional):       External standard normals of shape (2, n_simulations, N_T), e.g. from sobol_normals,
+                                              used instead of the generator. Defaults to None.
+
+    Raises:
+        Error: The critical value \psi_c must be in the interval [1,2]
+        Error: The parameter \gamma_1 must be in the interval [0,1]
+
+    Returns:
+        A tuple containing the path summary S of shape (4*n_simulations, len(accumulators) + 1) and the stochastic variance
+        at the last time point of shape (4*n_simulations, 1). The first columns of S hold the accumulators in the order they
+        were requested, the last one holds the stock price at the last time point, so that the payoffs reading S[:, -1] can be used as is.
+    """
+    if Psi_c>2 or Psi_c<1:
+        raise error('The critical value \psi_c must be in the interval [1,2]')
+    if gamma_1 >1 or gamma_1<0:
+        raise error('The parameter \gamma_1 must be in the interval [0,1]')
+    if T <= 0:
+        raise error("Contract termination time must be positive.")
+
+    gamma_2 = 1.0 - gamma_1
+
+    r, s0 = state.interest_rate, state.stock_price
+    v0, rho, kappa, vbar, gamma = heston_params.v0, heston_params.rho, heston_params.kappa, heston_params.vbar, heston_params.gamma
+
+    dt         = T/float(N_T)
+    E          = exp(-kappa*dt)
+    K_0        = -(rho*kappa*vbar/gamma)*dt
+    K_1        = gamma_1 * dt * (rho*kappa/gamma - 0.5) - rho/gamma
+    K_2        = gamma_2 * dt * (rho*kappa/gamma - 0.5) + rho/gamma
+    K_3        = gamma_1 * dt * (1.0 - rho**2)
+    K_4        = gamma_2 * dt * (1.0 - rho**2)
+
+    if accumulators is None:
+        codes  = np.empty(0, dtype=np.int64)
+    else:
+        codes  = accumulators
+    if barriers is None:
+        levels = np.zeros(codes.shape[0])
+    else:
+        levels = barriers
+    n_acc      = codes.shape[0]
+
+    V          = np.empty((4*n_simulations, 1))
+    S          = np.empty((4*n_simulations, n_acc + 1))
+    log_s0     = log(s0)
+
+    # the global generator only draws the key of the counter-based one, the normals are drawn in the loop over the paths
+    if normals is None and seed < 0:
+        seed   = np.random.randint(0, 2**62)
 
-    Z          = np.random.standard_normal(size=(2, n_simulations, N_T))
     p1         = (1. - E)*(gamma**2)*E/kappa
     p2         = (vbar*gamma**2)/(2.0*kappa)*((1.-E)**2)
     p3         = vbar * (1.- E)
     rdtK0      = r*dt + K_0
 
-    u = 0.
+    # the four antithetic copies of a path are stepped together in the locals x (log-price) and w (variance)
+    for n in prange(n_simulations):
+        j              = 4*n
+        x0, x1, x2, x3 = log_s0, log_s0, log_s0, log_s0
+        w0, w1, w2, w3 = v0, v0, v0, v0
+        if n_acc > 0:
+            _update_antithetic_accumulators(S, j, codes, levels, x0, x1, x2, x3, N_T, True)
+        for i in range(N_T - 1):
+            z_S, z_V = _step_normals(normals, seed, path_offset, n, i)
+            x0, w0   = _andersen_qe_step(x0, w0,  z_S,  z_V, E, p1, p2, p3, rdtK0, K_1, K_2, K_3, K_4, Psi_c)
+            x1, w1   = _andersen_qe_step(x1, w1, -z_S, -z_V, E, p1, p2, p3, rdtK0, K_1, K_2, K_3, K_4, Psi_c)
+            x2, w2   = _andersen_qe_step(x2, w2,  z_S, -z_V, E, p1, p2, p3, rdtK0, K_1, K_2, K_3, K_4, Psi_c)
+            x3, w3   = _andersen_qe_step(x3, w3, -z_S,  z_V, E, p1, p2, p3, rdtK0, K_1, K_2, K_3, K_4, Psi_c)
+            if n_acc > 0:
+                _update_antithetic_accumulators(S, j, codes, levels, x0, x1, x2, x3, N_T, False)
+        S[j, n_acc], S[j + 1, n_acc], S[j + 2, n_acc], S[j + 3, n_acc] = exp(x0), exp(x1), exp(x2), exp(x3)
+        V[j, 0], V[j + 1, 0], V[j + 2, 0], V[j + 3, 0]                 = w0, w1, w2, w3
+
+    return [S, V]
+
+@njit(parallel=True, cache=True, nogil=True)
+def simulate_heston_em(state:         MarketState,
+                       heston_params: HestonParameters,
+                       T:             float = 1.,
+                       N_T:           int   = 100,
+                       n_simulations: int   = 10_000,
+                       gamma_1:       float = 0.5,
+                       seed:          int   = -1,
+                       path_offset:   int   = 0,
+                       normals:       np.ndarray = None,
+                       storage_dtype             = np.float64,
+                       workspace                 = None,
+                       log_prices                = False
+                       ) -> np.ndarray:
+    """Simulation engine for the Heston model using the E+M scheme of Mrazek and Pospisil (2017):
+       the Milstein scheme for the variance combined with the exact (Broadie-Kaya) representation of the log-price,
+       where the integrated variance is approximated by gamma_1*V_t + gamma_2*V_{t+dt}. Negative values of the variance
+       are handled by full truncation. No switching between approximations is needed, so the step is cheaper than the QE one.
+
+    Args:
+        state (MarketState):              Market state.
+        heston_params (HestonParameters): Parameters of the Heston model.
+        T (float, optional):              Contract termination time expressed as a non-integer amount of years. Defaults to 1..
+        N_T (int, optional):              Number of steps in time. Defaults to 100.
+        n_simulations (int, optional):    Number of simulations. Defaults to 10_000.
+        gamma_1 (float, optional):        Integration parameter. Defaults to 0.5.
+        seed (int, optional):             Key of the counter-based generator, a negative value means the global one. Defaults to -1.
+        path_offset (int, optional):      Global index of the first path of the batch for the counter-based generator. Defaults to 0.
+        normals (np.ndarray, optional):   External standard normals of shape (2, n_simulations, N_T), e.g. from sobol_normals,
+                                          used instead of the generator. Defaults to None.
+        storage_dtype (type, optional):   Floating-point type the paths are stored in, np.float64 or np.float32. A storage option only:
+                                          every path is integrated in double precision and only the stored values are rounded, so the error
+                                          does not grow with N_T. np.float32 halves the memory of the paths, not the arithmetic.
+                                          Defaults to np.float64.
+        workspace (optional):             Preallocated buffers from make_workspace with the same N_T and storage_dtype and room for at least n_simulations,
+                                          used instead of allocating Z, V, logS and the prices. The returned arrays are views of the buffers and
+                                          are overwritten by the next call with the same workspace. Defaults to None.
+        log_prices (bool, optional):      Return the log-prices logS instead of exp(logS), e.g. for the log-space payoffs of
+                                          derivatives.py, which exponentiate only what they read. Defaults to False.
+
+    Raises:
+        error: The parameter \gamma_1 must be in the interval [0,1].
+        error: Contract termination time must be positive.
+
+    Returns:
+        A tuple containing the simulated stock price and the simulated stochastic variance.
+        The number of paths is doubled to account for the antithetic variates.
+    """
+    if gamma_1 >1 or gamma_1<0:
+        raise error('The parameter \gamma_1 must be in the interval [0,1]')
+    if T <= 0:
+        raise error("Contract termination time must be positive.")
+
+    r, s0 = state.interest_rate, state.stock_price
+    v0, rho, kappa, vbar, gamma = heston_params.v0, heston_params.rho, heston_params.kappa, heston_params.vbar, heston_params.gamma
+
+    gamma_2    = 1. - gamma_1
+    dt         = T/float(N_T)
+    log_s0     = log(s0)
+    K_0        = -(rho*kappa*vbar/gamma)*dt
+    K_1        = gamma_1 * dt * (rho*kappa/gamma - 0.5) - rho/gamma
+    K_2        = gamma_2 * dt * (rho*kappa/gamma - 0.5) + rho/gamma
+    K_3        = gamma_1 * dt * (1.0 - rho**2)
+    K_4        = gamma_2 * dt * (1.0 - rho**2)
+    rdtK0      = r*dt + K_0
+
+    if workspace is None:
+        V      = np.empty((4*n_simulations, N_T), storage_dtype)
+        logS   = np.empty((4*n_simulations, N_T), storage_dtype)
+    else:
+        if workspace.V.shape[0] < 4*n_simulations or workspace.V.shape[1] != N_T:
+            raise error("The workspace does not fit the batch.")
+        V      = workspace.V[:4*n_simulations]
+        logS   = workspace.logS[:4*n_simulations]
+    V[:, 0]    = v0
+    logS[:, 0] = log_s0
+
+    if normals is not None:
+        Z      = normals
+    elif workspace is None:
+        Z      = _standard_normals(n_simulations, N_T, seed, path_offset)
+    else:
+        Z      = workspace.Z
+        _fill_standard_normals(Z, n_simulations, seed, path_offset)
 
     for n in prange(n_simulations):
+        for k in range(4):
+            a, b = _antithetic_signs(k)
+            j    = 4*n + k
+            x, v = log_s0, v0
+            for i in range(N_T - 1):
+                x, v = _em_step(x, v, a*Z[0, n, i], b*Z[1, n, i],
+                                kappa, vbar, gamma, dt, rdtK0, K_1, K_2, K_3, K_4)
+                logS[j, i+1], V[j, i+1] = x, v
+
+    if log_prices:
+        return [logS, V]
+    if workspace is None:
+        return [np.exp(logS), V]
+    S = workspace.S[:4*n_simulations]
+    np.exp(logS, S)
+    return [S, V]
+
+@njit(parallel=True, cache=True, nogil=True)
+def simulate_heston_em_terminal(state:         MarketState,
+                                heston_params: HestonParameters,
+                                T:             float = 1.,
+                                N_T:           int   = 100,
+                                n_simulations: int   = 10_000,
+                                gamma_1:       float = 0.5,
+                                accumulators:  np.ndarray = None,
+                                barriers:      np.ndarray = None,
+                                seed:          int   = -1,
+                                path_offset:   int   = 0,
+                                normals:       np.ndarray = None
+                                ) -> np.ndarray:
+    """Terminal-state-only version of simulate_heston_em.
+       Only the running (logS, V) of every path is kept, so the memory footprint is O(n_simulations) instead of O(n_simulations * N_T).
+       Path-dependent quantities (averages, extrema, barrier hits) can be collected on the fly with the accumulators.
+
+    Args:
+        state (MarketState):                  Market state.
+        heston_params (HestonParameters):     Parameters of the Heston model.
+        T (float, optional):                  Contract termination time expressed as a non-integer amount of years. Defaults to 1..
+        N_T (int, optional):                  Number of steps in time. Defaults to 100.
+        n_simulations (int, optional):        Number of simulations. Defaults to 10_000.
+        gamma_1 (float, optional):            Integration parameter. Defaults to 0.5.
+        accumulators (np.ndarray, optional):  Codes of the online path accumulators (ACC_MEAN, ACC_LOG_MEAN, ACC_MAX, ACC_MIN,
+                                              ACC_UP_HIT, ACC_DOWN_HIT) updated at every monitoring date. Defaults to None.
+        barriers (np.ndarray, optional):      Barrier levels for the ACC_UP_HIT and ACC_DOWN_HIT accumulators, aligned with accumulators. Defaults to None.
+        seed (int, optional):                 Key of the counter-based generator, a negative value draws the key from the global one. Defaults to -1.
+        path_offset (int, optional):          Global index of the first path of the batch for the counter-based generator. Defaults to 0.
+        normals (np.ndarray, optional):       External standard normals of shape (2, n_simulations, N_T), e.g. from sobol_normals,
+                                              used instead of the generator. Defaults to None.
+
+    Raises:
+        error: The parameter \gamma_1 must be in the interval [0,1].
+        error: Contract termination time must be positive.
+
+    Returns:
+        A tuple containing the path summary S of shape (4*n_simulations, len(accumulators) + 1) and the stochastic variance
+        at the last time point of shape (4*n_simulations, 1). The first columns of S hold the accumulators in the order they
+        were requested, the last one holds the stock price at the last time point, so that the payoffs reading S[:, -1] can be used as is.
+    """
+    if gamma_1 >1 or gamma_1<0:
+        raise error('The parameter \gamma_1 must be in the interval [0,1]')
+    if T <= 0:
+        raise error("Contract termination time must be positive.")
+
+    r, s0 = state.interest_rate, state.stock_price
+    v0, rho, kappa, vbar, gamma = heston_params.v0, heston_params.rho, heston_params.kappa, heston_params.vbar, heston_params.gamma
+
+    gamma_2    = 1. - gamma_1
+    dt         = T/float(N_T)
+    K_0        = -(rho*kappa*vbar/gamma)*dt
+    K_1        = gamma_1 * dt * (rho*kappa/gamma - 0.5) - rho/gamma
+    K_2        = gamma_2 * dt * (rho*kappa/gamma - 0.5) + rho/gamma
+    K_3        = gamma_1 * dt * (1.0 - rho**2)
+    K_4        = gamma_2 * dt * (1.0 - rho**2)
+    rdtK0      = r*dt + K_0
+
+    if accumulators is None:
+        codes  = np.empty(0, dtype=np.int64)
+    else:
+        codes  = accumulators
+    if barriers is None:
+        levels = np.zeros(codes.shape[0])
+    else:
+        levels = barriers
+    n_acc      = codes.shape[0]
+
+    V          = np.empty((4*n_simulations, 1))
+    S          = np.empty((4*n_simulations, n_acc + 1))
+    log_s0     = log(s0)
+
+    # the global generator only draws the key of the counter-based one, the normals are drawn in the loop over the paths
+    if normals is None and seed < 0:
+        seed   = np.random.randint(0, 2**62)
+
+    # the four antithetic copies of a path are stepped together in the locals x (log-price) and w (variance)
+    for n in prange(n_simulations):
+        j              = 4*n
+        x0, x1, x2, x3 = log_s0, log_s0, log_s0, log_s0
+        w0, w1, w2, w3 = v0, v0, v0, v0
+        if n_acc > 0:
+            _update_antithetic_accumulators(S, j, codes, levels, x0, x1, x2, x3, N_T, True)
         for i in range(N_T - 1):
-            m   = p3 + V[4*n, i]*E
-            s_2 = V[4*n, i]*p1 + p2
-            Psi = s_2/(m**2) 
-
-            if Psi <= Psi_c:
-                c           = 2. / Psi
-                b           = c - 1. + sqrt(c*(c - 1.))
-                a           = m/(1.+b)
-                b           = sqrt(b)
-                V[4*n, i+1] = a*((b+Z[1, n, i])**2)
-            else:
-                p           = (Psi - 1)/(Psi + 1)
-                beta        = (1.0 - p)/m
-                u           = Phi(Z[1, n, i])
-                V[4*n,i+1]  = 0. if u < p else log((1-p)/(1-u))/beta
-
-            logS[4*n,i+1] = logS[4*n,i] + rdtK0 + K_1*V[4*n,i] + K_2*V[4*n,i+1] + sqrt(K_3*V[4*n,i]+K_4*V[4*n,i+1]) * Z[0,n,i]
-
-            m   = p3 + V[4*n+1, i]*E
-            s_2 = V[4*n+1, i]*p1 + p2
-            Psi = s_2/(m**2) 
-
-            if Psi <= Psi_c:
-                c             = 2. / Psi
-                b             = c - 1. + sqrt(c*(c - 1.))
-                a             = m/(1.+b)
-                b             = sqrt(b)
-                V[4*n+1, i+1] = a*((b-Z[1,n, i])**2)
-            else:
-                p             = (Psi - 1)/(Psi + 1)
-                beta          = (1.0 - p)/m
-                u             = Phi(- Z[1, n, i])
-                V[4*n+1,i+1]  = 0. if u < p else log((1.-p)/(1.-u))/beta
-
-            logS[4*n+1,i+1] = logS[4*n+1,i] + rdtK0 + K_1*V[4*n+1,i] + K_2*V[4*n+1,i+1] - sqrt(K_3*V[4*n+1,i]+K_4*V[4*n+1,i+1]) * Z[0,n,i]
-
-            m   = p3 + V[4*n+2, i]*E
-            s_2 = V[4*n+2, i]*p1 + p2
-            Psi = s_2/(m**2)
-
-            if Psi <= Psi_c:
-                c             = 2. / Psi
-                b             = c - 1. + sqrt(c*(c - 1.))
-                a             = m/(1.+b)
-                b             = sqrt(b)
-                V[4*n+2, i+1] = a*((b-Z[1,n, i])**2)
-            else:
-                p             = (Psi - 1)/(Psi + 1)
-                beta          = (1.0 - p)/m
-                u             = Phi(- Z[1, n, i])
-                V[4*n+2,i+1]  = 0. if u < p else log((1.-p)/(1.-u))/beta
-
-            logS[4*n+2,i+1] = logS[4*n+2,i] + rdtK0 + K_1*V[4*n+2,i] + K_2*V[4*n+2,i+1] + sqrt(K_3*V[4*n+2,i]+K_4*V[4*n+2,i+1]) * Z[0,n,i]
-
-            m   = p3 + V[4*n+3, i]*E
-            s_2 = V[4*n+3, i]*p1 + p2
-            Psi = s_2/(m**2)
-
-            if Psi <= Psi_c:
-                c             = 2. / Psi
-                b             = c - 1. + sqrt(c*(c - 1.))
-                a             = m/(1.+b)
-                b             = sqrt(b)
-                V[4*n+3, i+1] = a*((b+Z[1,n, i])**2)
-            else:
-                p             = (Psi - 1)/(Psi + 1)
-                beta          = (1.0 - p)/m
-                u             = Phi(Z[1, n, i])
-                V[4*n+3,i+1]  = 0. if u < p else log((1.-p)/(1.-u))/beta
+            z_S, z_V = _step_normals(normals, seed, path_offset, n, i)
+            x0, w0   = _em_step(x0, w0,  z_S,  z_V, kappa, vbar, gamma, dt, rdtK0, K_1, K_2, K_3, K_4)
+            x1, w1   = _em_step(x1, w1, -z_S, -z_V, kappa, vbar, gamma, dt, rdtK0, K_1, K_2, K_3, K_4)
+            x2, w2   = _em_step(x2, w2,  z_S, -z_V, kappa, vbar, gamma, dt, rdtK0, K_1, K_2, K_3, K_4)
+            x3, w3   = _em_step(x3, w3, -z_S,  z_V, kappa, vbar, gamma, dt, rdtK0, K_1, K_2, K_3, K_4)
+            if n_acc > 0:
+                _update_antithetic_accumulators(S, j, codes, levels, x0, x1, x2, x3, N_T, False)
+        S[j, n_acc], S[j + 1, n_acc], S[j + 2, n_acc], S[j + 3, n_acc] = exp(x0), exp(x1), exp(x2), exp(x3)
+        V[j, 0], V[j + 1, 0], V[j + 2, 0], V[j + 3, 0]                 = w0, w1, w2, w3
 
-            logS[4*n+3,i+1] = logS[4*n+3,i] + rdtK0 + K_1*V[4*n+3,i] + K_2*V[4*n+3,i+1] - sqrt(K_3*V[4*n+3,i]+K_4*V[4*n+3,i+1]) * Z[0,n,i]
-           
-    return [np.exp(logS), V]
+    return [S, V]
 
 
 def calculate_r_for_andersen_tg(x_:      float,
                                 maxiter: int = 2500, 
                                 tol:     float = 1e-5
                                 ):
+    from scipy.stats import norm
+    from scipy.optimize import newton
+
     def foo(x: float):
         return x*norm.pdf(x) + norm.cdf(x)*(1+x**2) - (1+x_)*(norm.pdf(x) + x*norm.cdf(x))**2
 
@@ -382,6 +1825,82 @@ def calculate_r_for_andersen_tg(x_:      float,
 
     return newton(foo,  x0 = 1/x_,fprime = foo_dif, fprime2 = foo_dif2, maxiter = maxiter , tol= tol )
 
+@njit(cache=True, nogil=True)
+def _tg_moment_equation(r:   float,
+                        psi: float):
+    """Moment-matching equation of the Truncated Gaussian scheme for X = max(r + Z, 0) scaled by E[X]^2,
+       G(r) = E[X^2]/E[X]^2 - 1 - psi, its derivative G'(r) and E[X] = phi(r) + r Phi(r).
+       G is decreasing in r, unlike E[X^2] - (1 + psi) E[X]^2 it does not vanish as r goes to -inf."""
+    pdf = exp(-0.5*r*r)/sqrt(2*pi)
+    cdf = 0.5*erfc(-r*sqrt2)
+    g   = pdf + r*cdf
+    h   = r*pdf + cdf*(1. + r*r)
+    F   = h - (1. + psi)*g*g
+    dF  = 2.*g*(1. - (1. + psi)*cdf)
+    return F/(g*g), dF/(g*g) - 2.*F*cdf/(g*g*g), g
+
+@njit(cache=True, nogil=True)
+def _solve_r_for_andersen_tg(psi:     float,
+                             r0:      float,
+                             tol:     float,
+                             maxiter: int):
+    """Newton's method for r(psi) started from r0 and safeguarded by bisection.
+       G(r) is positive to the left of the root and negative to the right of it, the root lies in [-8, 2/sqrt(psi) + 5]
+       for all psi up to about 1e15."""
+    lo, hi = -8., 2./sqrt(psi) + 5.
+    r      = min(max(r0, lo), hi)
+    for _ in range(maxiter):
+        G, dG, _ = _tg_moment_equation(r, psi)
+        if G > 0:
+            lo = r
+        else:
+            hi = r
+        r_new = r - G/dG if dG != 0 else 0.5*(lo + hi)
+        if not lo < r_new < hi:
+            r_new = 0.5*(lo + hi)
+        if abs(r_new - r) <= tol*(1. + abs(r)):
+            return r_new
+        r = r_new
+    return r
+
+@njit(parallel=True, cache=True, nogil=True)
+def calculate_tg_tables(x_grid:  np.ndarray,
+                        tol:     float = 1e-12,
+                        maxiter: int   = 100):
+    """Compiled parallel builder of the tables of simulate_heston_andersen_tg.
+       The grid is split into chunks solved in parallel, inside a chunk every root is warm-started from its neighbour's root.
+
+    Args:
+        x_grid (np.ndarray):      Grid of \psi values, increasing.
+        tol (float, optional):    Relative tolerance of the roots. Defaults to 1e-12.
+        maxiter (int, optional):  Maximum number of iterations per root. Defaults to 100.
+
+    Returns:
+        A tuple of the arrays r, f_nu and f_sigma on x_grid. At \psi = 0 the limits r = inf, f_nu = f_sigma = 1 are used.
+    """
+    N        = x_grid.shape[0]
+    r        = np.empty(N)
+    f_nu     = np.empty(N)
+    f_sigma  = np.empty(N)
+    n_chunks = max(min(4*N_CHUNKS, N), 1)
+
+    for c in prange(n_chunks):
+        r_prev = np.inf
+        for i in range(c*N//n_chunks, (c+1)*N//n_chunks):
+            psi = x_grid[i]
+            if psi <= 0:
+                r[i], f_nu[i], f_sigma[i] = np.inf, 1., 1.
+                continue
+
+            r0         = 1./sqrt(psi) if r_prev == np.inf else r_prev
+            r[i]       = _solve_r_for_andersen_tg(psi, r0, tol, maxiter)
+            _, _, g    = _tg_moment_equation(r[i], psi)
+            f_nu[i]    = r[i]/g
+            f_sigma[i] = 1./(sqrt(psi)*g)
+            r_prev     = r[i]
+
+    return r, f_nu, f_sigma
+
 @njit(parallel=True, cache=True, nogil=True)
 def simulate_heston_andersen_tg(state:         MarketState,
                                 heston_params: HestonParameters,
@@ -391,8 +1910,14 @@ def simulate_heston_andersen_tg(state:         MarketState,
                                 T:             float = 1.,
                                 N_T:           int   = 100,
                                 n_simulations: int   = 10_000,
-                                gamma_1:       float = 0.0
-                                ) -> np.ndarray: 
+                                gamma_1:       float = 0.0,
+                                seed:          int   = -1,
+                                path_offset:   int   = 0,
+                                normals:       np.ndarray = None,
+                                storage_dtype             = np.float64,
+                                workspace                 = None,
+                                log_prices                = False
+                                ) -> np.ndarray:
     """ Simulation engine for the Heston model using the Truncated Gaussian Andersen scheme.
 
     Args:
@@ -405,6 +1930,19 @@ def simulate_heston_andersen_tg(state:         MarketState,
         dt (float, optional):             Time step. Defaults to 1e-2.
         n_simulations (int, optional):    number of the simulations. Defaults to 10_000.
         gamma_1 (float, optional):        _description_. Defaults to 0.0.
+        seed (int, optional):             Key of the counter-based generator, a negative value means the global one. Defaults to -1.
+        path_offset (int, optional):      Global index of the first path of the batch for the counter-based generator. Defaults to 0.
+        normals (np.ndarray, optional):   External standard normals of shape (2, n_simulations, N_T), e.g. from sobol_normals,
+                                          used instead of the generator. Defaults to None.
+        storage_dtype (type, optional):   Floating-point type the paths are stored in, np.float64 or np.float32. A storage option only:
+                                          every path is integrated in double precision and only the stored values are rounded, so the error
+                                          does not grow with N_T. np.float32 halves the memory of the paths, not the arithmetic.
+                                          Defaults to np.float64.
+        workspace (optional):             Preallocated buffers from make_workspace with the same N_T and storage_dtype and room for at least n_simulations,
+                                          used instead of allocating Z, V, logS and the prices. The returned arrays are views of the buffers and
+                                          are overwritten by the next call with the same workspace. Defaults to None.
+        log_prices (bool, optional):      Return the log-prices logS instead of exp(logS), e.g. for the log-space payoffs of
+                                          derivatives.py, which exponentiate only what they read. Defaults to False.
 
     Raises:
         error: The parameter \gamma_1 must be in the interval [0,1].
@@ -413,218 +1951,489 @@ def simulate_heston_andersen_tg(state:         MarketState,
     Returns:
         A tuple containing the simulated stock price and the simulated stochastic variance.
         The number of paths is doubled to account for the antithetic variates.
-    """    
+    """
     if gamma_1 >1 or gamma_1<0:
         raise error('The parameter \gamma_1 must be in the interval [0,1]')
     if T <= 0:
         raise error("Contract termination time must be positive.")
-            
+
     r, s0 = state.interest_rate, state.stock_price
     v0, rho, kappa, vbar, gamma = heston_params.v0, heston_params.rho, heston_params.kappa, heston_params.vbar, heston_params.gamma
-    
+
     gamma_2    = 1. - gamma_1
     dt         = T/float(N_T)
+    log_s0     = log(s0)
     E          = exp(-kappa*dt)
     K_0        = -(rho*kappa*vbar/gamma)*dt
     K_1        = gamma_1 * dt * (rho*kappa/gamma - 0.5) - rho/gamma
     K_2        = gamma_2 * dt * (rho*kappa/gamma - 0.5) + rho/gamma
     K_3        = gamma_1 * dt * (1.0 - rho**2)
     K_4        = gamma_2 * dt * (1.0 - rho**2)
-        
-    V          = np.empty((4*n_simulations, N_T))
+
+    if workspace is None:
+        V      = np.empty((4*n_simulations, N_T), storage_dtype)
+        logS   = np.empty((4*n_simulations, N_T), storage_dtype)
+    else:
+        if workspace.V.shape[0] < 4*n_simulations or workspace.V.shape[1] != N_T:
+            raise error("The workspace does not fit the batch.")
+        V      = workspace.V[:4*n_simulations]
+        logS   = workspace.logS[:4*n_simulations]
     V[:, 0]    = v0
-    logS       = np.empty((4*n_simulations, N_T))
-    logS[:, 0] = np.log(s0)
+    logS[:, 0] = log_s0
 
-    Z          = np.random.standard_normal(size=(2, n_simulations, N_T))
-    #Z_V        = np.random.standard_normal(size=(n_simulations, N_T))    #do we need this?  
+    if normals is not None:
+        Z      = normals
+    elif workspace is None:
+        Z      = _standard_normals(n_simulations, N_T, seed, path_offset)
+    else:
+        Z      = workspace.Z
+        _fill_standard_normals(Z, n_simulations, seed, path_offset)
+    #Z_V        = np.random.standard_normal(size=(n_simulations, N_T))    #do we need this?
     p1         = (1. - E)*(gamma**2)*E/kappa
     p2         = (vbar*gamma**2)/(2.0*kappa)*((1.-E)**2)
     p3         = vbar * (1.- E)
     rdtK0      = r*dt + K_0
     dx         = x_grid[1] - x_grid[0]
-    
-    for n in prange(n_simulations):
-        for i in range(N_T - 1):
-            m               = p3 + V[4*n, i]*E
-            s_2             = V[4*n, i]*p1 + p2
-            Psi             = s_2/(m**2) 
-
-
-            if Psi > x_grid[-1]:
-                inx         = x_grid.shape[0] -1
-            else:
-                inx         = int(Psi/dx)
-        
-            nu              = m*f_nu_grid[inx]
-            sigma           = sqrt(s_2)*f_sigma_grid[inx]
-
-            V[4*n, i+1]     = max(nu + sigma*Z[1, n, i], 0)
-            logS[4*n,i+1]   = logS[4*n,i] + rdtK0 + K_1*V[4*n,i] + K_2*V[4*n,i+1] + sqrt(K_3*V[4*n,i]+K_4*V[4*n,i+1]) * Z[0, n,i]
-
-            m               = p3 + V[4*n+1, i]*E
-            s_2             = V[4*n+1, i]*p1 + p2
-            Psi             = s_2/(m**2) 
-
-            if Psi > x_grid[-1]:
-                inx         = x_grid.shape[0] -1
-            else:
-                inx         = int(Psi/dx)
-        
-            nu              = m * f_nu_grid[inx]
-            sigma           = np.sqrt(s_2)*f_sigma_grid[inx]
-
-            V[4*n+1,i+1]    = max(nu - sigma*Z[1, n, i], 0)
-            logS[4*n+1,i+1] = logS[4*n+1,i] + rdtK0 + K_1*V[4*n+1,i] + K_2*V[4*n+1,i+1] - sqrt(K_3*V[4*n+1,i]+K_4*V[4*n+1,i+1]) * Z[0,n,i]
-            
-            if Psi > x_grid[-1]:
-                inx         = x_grid.shape[0] -1
-            else:
-                inx             = int(Psi/dx)
-        
-            nu              = m * f_nu_grid[inx]
-            sigma           = np.sqrt(s_2)*f_sigma_grid[inx]
-
-            V[4*n+2,i+1]    = max(nu - sigma*Z[1, n, i], 0)
-            logS[4*n+2,i+1] = logS[4*n+2,i] + rdtK0 + K_1*V[4*n+2,i] + K_2*V[4*n+2,i+1] + sqrt(K_3*V[4*n+2,i]+K_4*V[4*n+2,i+1]) * Z[0,n,i]
-            
-            if Psi > x_grid[-1]:
-                inx         = x_grid.shape[0] -1
-            else:
-                inx             = int(Psi/dx)
-        
-            nu              = m * f_nu_grid[inx]
-            sigma           = np.sqrt(s_2)*f_sigma_grid[inx]
-
-            V[4*n+3,i+1]    = max(nu + sigma*Z[1, n, i], 0)
-            logS[4*n+3,i+1] = logS[4*n+3,i] + rdtK0 + K_1*V[4*n+3,i] + K_2*V[4*n+3,i+1] - sqrt(K_3*V[4*n+3,i]+K_4*V[4*n+3,i+1]) * Z[0,n,i]
-            
-
-    return [np.exp(logS), V]
-
-
-
-
-
-
-
-
-
-
 
+    for n in prange(n_simulations):
+        for k in range(4):
+            a, b = _antithetic_signs(k)
+            j    = 4*n + k
+            x, v = log_s0, v0
+            for i in range(N_T - 1):
+                x, v = _andersen_tg_step(x, v, a*Z[0, n, i], b*Z[1, n, i],
+                                         E, p1, p2, p3, rdtK0, K_1, K_2, K_3, K_4,
+                                         x_grid, f_nu_grid, f_sigma_grid, dx)
+                logS[j, i+1], V[j, i+1] = x, v
+
+    if log_prices:
+        return [logS, V]
+    if workspace is None:
+        return [np.exp(logS), V]
+    S = workspace.S[:4*n_simulations]
+    np.exp(logS, S)
+    return [S, V]
 
+@njit(parallel=True, cache=True, nogil=True)
+def simulate_heston_andersen_tg_terminal(state:         MarketState,
+                                         heston_params: HestonParameters,
+                                         x_grid:        np.ndarray,
+                                         f_nu_grid:     np.ndarray,
+                                         f_sigma_grid:  np.ndarray,
+                                         T:             float = 1.,
+                                         N_T:           int   = 100,
+                                         n_simulations: int   = 10_000,
+                                         gamma_1:       float = 0.0,
+                                         accumulators:  np.ndarray = None,
+                                         barriers:      np.ndarray = None,
+                                         seed:          int   = -1,
+                                         path_offset:   int   = 0,
+                                         normals:       np.ndarray = None
+                                         ) -> np.ndarray:
+    """Terminal-state-only version of simulate_heston_andersen_tg.
+       Only the running (logS, V) of every path is kept, so the memory footprint is O(n_simulations) instead of O(n_simulations * N_T).
+       Path-dependent quantities (averages, extrema, barrier hits) can be collected on the fly with the accumulators.
 
+    Args:
+        state (MarketState):                  Market state.
+        heston_params (HestonParameters):     Parameters of the Heston model.
+        x_grid (np.ndarray):                  Grid of \psi values the tables are tabulated on.
+        f_nu_grid (np.ndarray):               Values of f_\nu on x_grid.
+        f_sigma_grid (np.ndarray):            Values of f_\sigma on x_grid.
+        T (float, optional):                  Contract termination time expressed as a non-integer amount of years. Defaults to 1..
+        N_T (int, optional):                  Number of steps in time. Defaults to 100.
+        n_simulations (int, optional):        Number of simulations. Defaults to 10_000.
+        gamma_1 (float, optional):            Integration parameter. Defaults to 0.0.
+        accumulators (np.ndarray, optional):  Codes of the online path accumulators (ACC_MEAN, ACC_LOG_MEAN, ACC_MAX, ACC_MIN,
+                                              ACC_UP_HIT, ACC_DOWN_HIT) updated at every monitoring date. Defaults to None.
+        barriers (np.ndarray, optional):      Barrier levels for the ACC_UP_HIT and ACC_DOWN_HIT accumulators, aligned with accumulators. Defaults to None.
+        seed (int, optional):                 Key of the counter-based generator, a negative value draws the key from the global one. Defaults to -1.
+        path_offset (int, optional):          Global index of the first path of the batch for the counter-based generator. Defaults to 0.
+        normals (np.ndarray, optional):       External standard normals of shape (2, n_simulations, N_T), e.g. from sobol_normals,
+                                              used instead of the generator. Defaults to None.
 
+    Raises:
+        error: The parameter \gamma_1 must be in the interval [0,1].
+        error: Contract termination time must be positive.
 
+    Returns:
+        A tuple containing the path summary S of shape (4*n_simulations, len(accumulators) + 1) and the stochastic variance
+        at the last time point of shape (4*n_simulations, 1). The first columns of S hold the accumulators in the order they
+        were requested, the last one holds the stock price at the last time point, so that the payoffs reading S[:, -1] can be used as is.
+    """
+    if gamma_1 >1 or gamma_1<0:
+        raise error('The parameter \gamma_1 must be in the interval [0,1]')
+    if T <= 0:
+        raise error("Contract termination time must be positive.")
 
+    r, s0 = state.interest_rate, state.stock_price
+    v0, rho, kappa, vbar, gamma = heston_params.v0, heston_params.rho, heston_params.kappa, heston_params.vbar, heston_params.gamma
 
+    gamma_2    = 1. - gamma_1
+    dt         = T/float(N_T)
+    E          = exp(-kappa*dt)
+    K_0        = -(rho*kappa*vbar/gamma)*dt
+    K_1        = gamma_1 * dt * (rho*kappa/gamma - 0.5) - rho/gamma
+    K_2        = gamma_2 * dt * (rho*kappa/gamma - 0.5) + rho/gamma
+    K_3        = gamma_1 * dt * (1.0 - rho**2)
+    K_4        = gamma_2 * dt * (1.0 - rho**2)
 
+    if accumulators is None:
+        codes  = np.empty(0, dtype=np.int64)
+    else:
+        codes  = accumulators
+    if barriers is None:
+        levels = np.zeros(codes.shape[0])
+    else:
+        levels = barriers
+    n_acc      = codes.shape[0]
 
+    V          = np.empty((4*n_simulations, 1))
+    S          = np.empty((4*n_simulations, n_acc + 1))
+    log_s0     = log(s0)
 
+    # the global generator only draws the key of the counter-based one, the normals are drawn in the loop over the paths
+    if normals is None and seed < 0:
+        seed   = np.random.randint(0, 2**62)
 
+    p1         = (1. - E)*(gamma**2)*E/kappa
+    p2         = (vbar*gamma**2)/(2.0*kappa)*((1.-E)**2)
+    p3         = vbar * (1.- E)
+    rdtK0      = r*dt + K_0
+    dx         = x_grid[1] - x_grid[0]
 
+    # the four antithetic copies of a path are stepped together in the locals x (log-price) and w (variance)
+    for n in prange(n_simulations):
+        j              = 4*n
+        x0, x1, x2, x3 = log_s0, log_s0, log_s0, log_s0
+        w0, w1, w2, w3 = v0, v0, v0, v0
+        if n_acc > 0:
+            _update_antithetic_accumulators(S, j, codes, levels, x0, x1, x2, x3, N_T, True)
+        for i in range(N_T - 1):
+            z_S, z_V = _step_normals(normals, seed, path_offset, n, i)
+            x0, w0   = _andersen_tg_step(x0, w0,  z_S,  z_V, E, p1, p2, p3, rdtK0, K_1, K_2, K_3, K_4, x_grid, f_nu_grid, f_sigma_grid, dx)
+            x1, w1   = _andersen_tg_step(x1, w1, -z_S, -z_V, E, p1, p2, p3, rdtK0, K_1, K_2, K_3, K_4, x_grid, f_nu_grid, f_sigma_grid, dx)
+            x2, w2   = _andersen_tg_step(x2, w2,  z_S, -z_V, E, p1, p2, p3, rdtK0, K_1, K_2, K_3, K_4, x_grid, f_nu_grid, f_sigma_grid, dx)
+            x3, w3   = _andersen_tg_step(x3, w3, -z_S,  z_V, E, p1, p2, p3, rdtK0, K_1, K_2, K_3, K_4, x_grid, f_nu_grid, f_sigma_grid, dx)
+            if n_acc > 0:
+                _update_antithetic_accumulators(S, j, codes, levels, x0, x1, x2, x3, N_T, False)
+        S[j, n_acc], S[j + 1, n_acc], S[j + 2, n_acc], S[j + 3, n_acc] = exp(x0), exp(x1), exp(x2), exp(x3)
+        V[j, 0], V[j + 1, 0], V[j + 2, 0], V[j + 3, 0]                 = w0, w1, w2, w3
+
+    return [S, V]
+
+@njit(cache=True, nogil=True)
+def _log_bessel_iv(nu:   float,
+                   logz: complex):
+    """log I_nu(z) of the modified Bessel function of the first kind for nu > -1 and complex z = exp(logz).
+       The branch of z^nu is the one given by logz, so a continuous logz gives a continuous I_nu along a path in z.
+       The power series is used for |z| <= 30, otherwise logz is rotated by multiples of i*pi into |arg z| <= pi/2
+       (I_nu(z e^{i pi m}) = e^{i pi m nu} I_nu(z)) and the two-sided Hankel expansion is used."""
+    z  = cmath.exp(logz)
+    az = abs(z)
+    if az <= 30.:
+        q = 0.25*z*z
+        t = 1. + 0j
+        s = 1. + 0j
+        k = 0
+        while k < 500:
+            k += 1
+            t *= q/(k*(k + nu))
+            s += t
+            if k > az and abs(t) <= 1e-17*abs(s):
+                break
+        return nu*(logz - log(2.)) - lgamma(nu + 1.) + cmath.log(s)
+
+    m     = round(logz.imag/pi)
+    logz  = logz - 1j*pi*m
+    z     = cmath.exp(logz)
+    mu    = 4.*nu*nu
+    t     = 1. + 0j
+    s1    = 1. + 0j
+    s2    = 1. + 0j
+    for k in range(1, 30):
+        t  *= (mu - (2*k - 1)**2)/(8.*k*z)
+        s1 += t if k % 2 == 0 else -t
+        s2 += t
+        if abs(t) < 1e-17:
+            break
+    sgn = 1. if z.imag >= 0 else -1.
+    s   = s1 + sgn*1j*cmath.exp(sgn*1j*pi*nu - 2.*z)*s2
+    return 1j*pi*nu*m + z - 0.5*(log(2.*pi) + logz) + cmath.log(s)
+
+@njit(cache=True, nogil=True)
+def _bk_char_terms(xi:    float,
+                   kappa: float,
+                   gamma: float,
+                   dt:    float):
+    """Terms of the characteristic function of the integrated variance over a step of length dt that do not depend on
+       the end points (v_t, v_u) (Broadie & Kaya, 2006, eq. 13): log of the first factor, the coefficient of (v_t + v_u)
+       in the exponent and log of the argument of the Bessel function per unit of sqrt(v_t v_u). The logs are on
+       the continuous branches, so no phase unwrapping is needed."""
+    g    = cmath.sqrt(kappa*kappa - 2j*gamma*gamma*xi)
+    E1   = exp(-kappa*dt)
+    E2   = cmath.exp(-g*dt)
+    logP = cmath.log(g*(1. - E1)/(kappa*(1. - E2))) - 0.5*(g - kappa)*dt
+    C    = (kappa*(1. + E1)/(1. - E1) - g*(1. + E2)/(1. - E2))/(gamma*gamma)
+    logz = cmath.log(4.*g/(gamma*gamma*(1. - E2))) - 0.5*g*dt
+    return logP, C, logz
+
+@njit(cache=True, nogil=True)
+def _bk_h_min(kappa: float,
+              gamma: float,
+              vbar:  float,
+              dt:    float) -> float:
+    """Finest frequency step of the Broadie-Kaya cache. The support 2*pi/h_min of the coarsest level is 256 times
+       a generous bound 4*dt*(vbar + 20*gamma^2/kappa) of the integrated variance of a step started from the stationary law,
+       so that the cache does not depend on v0 and a v0 far above vbar is covered as well."""
+    return 2.*pi/(256.*4.*dt*(vbar + 20.*gamma**2/kappa))
+
+@njit(cache=True, nogil=True)
+def _bk_cache(kappa:     float,
+              gamma:     float,
+              dt:        float,
+              h_min:     float,
+              n_levels:  int,
+              max_terms: int):
+    """Characteristic function cache of the Broadie-Kaya engine for one (params, dt): the terms of _bk_char_terms
+       at the frequencies j*h_min*2^l, j = 0, ..., max_terms, on n_levels dyadic levels l."""
+    logP = np.empty((n_levels, max_terms + 1), dtype=np.complex128)
+    C    = np.empty((n_levels, max_terms + 1), dtype=np.complex128)
+    logz = np.empty((n_levels, max_terms + 1), dtype=np.complex128)
+    for l in range(n_levels):
+        h = h_min*2.**l
+        for j in range(max_terms + 1):
+            logP[l, j], C[l, j], logz[l, j] = _bk_char_terms(j*h, kappa, gamma, dt)
+    return logP, C, logz
+
+@lru_cache(maxsize=32)
+def _broadie_kaya_cache(kappa:     float,
+                        gamma:     float,
+                        vbar:      float,
+                        dt:        float,
+                        n_levels:  int,
+                        max_terms: int):
+    h_min = _bk_h_min(kappa, gamma, vbar, dt)
+    return (h_min,) + _bk_cache(kappa, gamma, dt, h_min, n_levels, max_terms)
+
+def broadie_kaya_cache(heston_params: HestonParameters,
+                       T:             float = 1.,
+                       N_T:           int   = 100,
+                       n_levels:      int   = 48,
+                       max_terms:     int   = 200) -> tuple:
+    """Characteristic function cache of simulate_heston_broadie_kaya for (kappa, gamma, vbar, dt = T/N_T), memoised,
+       so that the batches of a Monte-Carlo run, and the runs with the same parameters and time grid, build it once.
+       mc_price, mc_price_strikes and mc_price_portfolio pass it to the engine by themselves.
+    Args:
+        heston_params (HestonParameters): Parameters of the Heston model, v0 and rho are not used.
+        T (float, optional):              Contract termination time. Defaults to 1..
+        N_T (int, optional):              Number of steps in time. Defaults to 100.
+        n_levels (int, optional):         Number of dyadic levels, as in the engine. Defaults to 48.
+        max_terms (int, optional):        Maximal number of terms of the Fourier series, as in the engine. Defaults to 200.
+    Returns:
+        The tuple (h_min, logP, C, logz) taken by the engine as bk_cache. The arrays are shared by the memoised calls and must not be modified.
+    """
+    return _broadie_kaya_cache(float(heston_params.kappa), float(heston_params.gamma), float(heston_params.vbar),
+                               T/float(N_T), int(n_levels), int(max_terms))
+
+@njit(cache=True, nogil=True)
+def _bk_log_char(logP:   complex,
+                 C:      complex,
+                 logz:   complex,
+                 vs:     float,
+                 w:      float,
+                 log_w:  float,
+                 nu:     float,
+                 logI0:  complex,
+                 logz0:  complex):
+    """log of the characteristic function of the integrated variance conditional on v_t + v_u = vs and sqrt(v_t v_u) = w.
+       For w = 0 the ratio of the Bessel functions is replaced by its limit."""
+    if w > 0:
+        return logP + vs*C + _log_bessel_iv(nu, log_w + logz) - logI0
+    return logP + vs*C + nu*(logz - logz0)
+
+@njit(cache=True, nogil=True)
+def _bk_integrated_variance(u:     float,
+                            vt:    float,
+                            vu:    float,
+                            nu:    float,
+                            kappa: float,
+                            gamma: float,
+                            vbar:  float,
+                            dt:    float,
+                            h_min: float,
+                            logP:  np.ndarray,
+                            C:     np.ndarray,
+                            logz:  np.ndarray,
+                            eps:   float,
+                            buf:   np.ndarray):
+    """Inverts the conditional distribution function of the integrated variance over a step at the uniform u.
+       The distribution function is the Fourier sine series of Broadie & Kaya (2006, eq. 17) on the support [0, 2*pi/h].
+       The conditional mean and variance are read off the cumulants at a small frequency, h is then the largest cached
+       h_min*2^l with 2*pi/h above mean + 12 standard deviations, and the series is truncated as soon as
+       |Phi(hj)|/j < pi*eps/2. The root is found by Newton's method safeguarded by bisection."""
+    n_levels, n_terms = logP.shape[0], logP.shape[1] - 1
+    vs    = vt + vu
+    w     = sqrt(vt*vu)
+    log_w = log(w) if w > 0 else 0.
+    logz0 = logz[0, 0]
+    logI0 = _log_bessel_iv(nu, log_w + logz0) if w > 0 else 0j
+
+    scale = 0.5*dt*(vs + kappa*vbar*dt)
+    delta = 1e-2/scale
+    lP, Cd, lz = _bk_char_terms(delta, kappa, gamma, dt)
+    lphi  = _bk_log_char(lP, Cd, lz, vs, w, log_w, nu, logI0, logz0)
+    mean  = lphi.imag/delta
+    var   = max(-2.*lphi.real/(delta*delta), 0.)
+    u_eps = mean + 12.*sqrt(var)
+    if not u_eps > 0:
+        u_eps = 2.*scale
+
+    level = min(max(int(floor(log(2.*pi/(h_min*u_eps))/log(2.))), 0), n_levels - 1)
+    h     = h_min*2.**level
+    J     = 0
+    for j in range(1, n_terms + 1):
+        lphi     = _bk_log_char(logP[level, j], C[level, j], logz[level, j], vs, w, log_w, nu, logI0, logz0)
+        buf[j-1] = cmath.exp(lphi).real
+        J        = j
+        if exp(lphi.real) < 0.5*pi*eps*j:
+            break
 
+    lo, hi = 0., 2.*pi/h
+    x      = min(max(mean, 0.), hi)
+    for _ in range(100):
+        s1, c1 = sin(h*x), cos(h*x)
+        s, c   = s1, c1
+        F, f   = h*x, h
+        for j in range(1, J + 1):
+            F   += 2.*buf[j-1]*s/j
+            f   += 2.*h*buf[j-1]*c
+            s, c = s*c1 + c*s1, c*c1 - s*s1
+        G = F/pi - u
+        if G > 0:
+            hi = x
+        else:
+            lo = x
+        x_new = x - pi*G/f if f > 0 else 0.5*(lo + hi)
+        if not lo < x_new < hi:
+            x_new = 0.5*(lo + hi)
+        if abs(x_new - x) <= 1e-12*(2.*pi/h):
+            return x_new
+        x = x_new
+    return x
 
+@njit(parallel=True, cache=True, nogil=True)
+def simulate_heston_broadie_kaya(state:         MarketState,
+                                 heston_params: HestonParameters,
+                                 T:             float = 1.,
+                                 N_T:           int   = 100,
+                                 n_simulations: int   = 10_000,
+                                 eps:           float = 1e-5,
+                                 max_terms:     int   = 200,
+                                 n_levels:      int   = 48,
+                                 seed:          int   = -1,
+                                 path_offset:   int   = 0,
+                                 workspace            = None,
+                                 log_prices           = False,
+                                 bk_cache             = None
+                                 ) -> np.ndarray:
+    """Simulation engine for the Heston model using the exact scheme of Broadie and Kaya.
+       The variance is sampled from its non-central chi-square transition law as a Poisson mixture of gamma variables,
+       the integrated variance over a step by the compiled Fourier inversion of its distribution function conditional
+       on the end points, and the log-price from its exact Gaussian law given both. The scheme has no discretisation bias,
+       so few time steps are enough for the European payoffs. Every variance path is sampled in parallel from the
+       counter-based generator: the Poisson, gamma, uniform and normal draws of a step are keyed by (seed, path_offset + n, step).
 
+    Args:
+        state (MarketState):              Market state.
+        heston_params (HestonParameters): Parameters of the Heston model.
+        T (float, optional):              Contract termination time expressed as a non-integer amount of years. Defaults to 1..
+        N_T (int, optional):              Number of steps in time. Defaults to 100.
+        n_simulations (int, optional):    Number of simulations. Defaults to 10_000.
+        eps (float, optional):            Truncation error of the Fourier series of the distribution function. Defaults to 1e-5.
+        max_terms (int, optional):        Maximal number of terms of the Fourier series. It only binds when the variance is
+                                          close to 0 at both ends of a step and d = 4*kappa*vbar/gamma^2 is small, where the
+                                          characteristic function decays very slowly. Defaults to 200.
+        n_levels (int, optional):         Number of dyadic levels of the characteristic function cache. Defaults to 48.
+        seed (int, optional):             Key of the counter-based generator. A negative value draws a fresh key from the global
+                                          generator, so the paths follow np.random.seed as for the other engines. Defaults to -1.
+        path_offset (int, optional):      Global index of the first path of the batch for the counter-based generator. Defaults to 0.
+        workspace (optional):             Preallocated buffers from make_workspace, as for the full-path engines (Z is not used). Defaults to None.
+        log_prices (bool, optional):      Return the log-prices logS instead of exp(logS). Defaults to False.
+        bk_cache (tuple, optional):       Characteristic function cache of broadie_kaya_cache for the same parameters, N_T, n_levels
+                                          and max_terms. Defaults to None (built by the call).
 
+    Raises:
+        error: Contract termination time must be positive.
+        error: The workspace does not fit the batch.
 
+    Returns:
+        A tuple containing the simulated stock price and the simulated stochastic variance.
+        Every variance path is used with two antithetic log-price paths, so the number of paths is 4*n_simulations.
+    """
+    if T <= 0:
+        raise error("Contract termination time must be positive.")
 
-#non-working piece of code
+    r, s0 = state.interest_rate, state.stock_price
+    v0, rho, kappa, vbar, gamma = heston_params.v0, heston_params.rho, heston_params.kappa, heston_params.vbar, heston_params.gamma
 
+    dt         = T/float(N_T)
+    log_s0     = log(s0)
+    E          = exp(-kappa*dt)
+    c          = gamma**2*(1. - E)/(4.*kappa)
+    d          = 4.*kappa*vbar/gamma**2
+    lam_coef   = E/c
+    nu         = 0.5*d - 1.
+    K_0        = r*dt - rho*kappa*vbar*dt/gamma
+    K_1        = rho*kappa/gamma - 0.5
+    sqrt1_rho2 = sqrt(1. - rho**2)
+
+    if bk_cache is None:
+        h_min         = _bk_h_min(kappa, gamma, vbar, dt)
+        logP, C, logz = _bk_cache(kappa, gamma, dt, h_min, n_levels, max_terms)
+    else:
+        h_min, logP, C, logz = bk_cache
 
-def cir_chi_sq_sample(heston_params: HestonParameters,
-                      dt:            float,
-                      v_i:           np.ndarray,
-                      n_simulations: int):
-    """Samples chi_squared statistics for v_{i+1} conditional on 
-       v_i and parameters of the Heston model. 
-        
-    Args:
-        heston_params (HestonParameters): parameters of Heston model
-        dt (float): T step 
-        v_i: current volatility value
-        n_simulations (int): number of simulations.
-        
-    Returns:
-        np.ndarray: sampled chi_squared statistics 
-    """
-    kappa, vbar, gamma = heston_params.kappa, heston_params.vbar, heston_params.gamma
-    
-    barkappa=v_i*(4*kappa*np.exp(-kappa*dt))/(gamma**2 * (1 - np.exp(-kappa*dt)))
-    d=(4*kappa*vbar)/(gamma**2)
-    c=((gamma**2)/(4*kappa))*(1-np.exp(-kappa*dt))
-    
-    return  c*np.random.noncentral_chisquare(size = n_simulations, df   = d, nonc = barkappa)
+    if seed < 0:
+        seed = np.random.randint(0, 2**62)
 
+    if workspace is None:
+        V      = np.empty((4*n_simulations, N_T))
+        logS   = np.empty((4*n_simulations, N_T))
+    else:
+        if workspace.V.shape[0] < 4*n_simulations or workspace.V.shape[1] != N_T:
+            raise error("The workspace does not fit the batch.")
+        V      = workspace.V[:4*n_simulations]
+        logS   = workspace.logS[:4*n_simulations]
 
-def Phi_BK(a:             Union[float, np.ndarray], 
-        V:             Union[float, np.ndarray],
-        T:             Union[float, np.ndarray],
-        heston_params: HestonParameters
-        ) -> np.ndarray:
-    
-    
-    v0, rho, kappa, vbar, gamma = heston_params.v0, heston_params.rho, heston_params.kappa, \
-                                        heston_params.vbar, heston_params.gamma
-    dt = T[1::]-T[:-1:]
-    
-    A=np.ndarray(a)
-    gamma_a = np.sqrt(kappa**2 - 2*gamma**2*1j*A).reshape(1,1,len(A)).T
-    
-    E1 = np.exp(-kappa*dt)
-    E2 = np.exp(-gamma_a * dt)
-        
-    P1 = ((1.0-E1)*gamma_a/(kappa*(1.0-E2)))*np.exp(-0.5*(gamma_a - kappa)*dt)
-    
-    P2_2 = kappa * (1.0 + E1)/(1.0 - E1) - gamma_a*(1.0+E2)/(1-E2)
-    P2 = np.exp( (V[:,1::]+V[:,:-1:])/(gamma_a**2) * P2_2 )
-    
-    P3_1 = np.sqrt(V[:,1::]*V[:,:-1:])*4*gamma_a * np.exp(-0.5*gamma_a*dt) /(gamma**2 * (1.0 - E2))
-    P3_2 = np.sqrt(V[:,1::]*V[:,:-1:])*4*kappa*np.exp(-0.5*kappa*dt)/(gamma**2 * (1 - E1))
-    d=(4*kappa*vbar)/(gamma**2)
-    P3 = iv(0.5*d - 1, P3_1)/iv(0.5*d - 1, P3_2)
-    
-    return P1*P2*P3
-
-def Pr(V:             np.ndarray, 
-       T:          np.ndarray,
-       X:             Union[np.ndarray, float],
-       heston_params: HestonParameters,
-       h:             float=1e-2, 
-       eps:           float=1e-2
-       ) -> np.ndarray:
-    
-    x=np.ndarray(X)
-    P=h*x/np.pi
-    S = 0.0
-    j = 1
-    while(True):
-        Sin=np.sin(h*j*x)/j
-        Phi_hj=Phi_BK(h*j, V, T, heston_params)
-        S+=Sin.reshape(1,1,len(x)).T * Phi_hj[0]
-        if np.all(Phi_hj[0]<np.pi*eps*j/2.0):
-            break
-        j=j+1
-    
-    S=S*2.0/np.pi
-    return P+S
-
-def IV(V:             np.ndarray, 
-       T:          np.ndarray,
-       heston_params: HestonParameters,
-       h:             float=1e-2, 
-       eps:           float=1e-2
-       ) -> np.ndarray:
-    
-    U=np.random.uniform(size=(V.shape[0], V.shape[1] - 1))
-    
-    def f(x,i,j):
-        P=Pr(V, T, x, heston_params, h, eps)
-        return (P-U)[0][i,j]
-    
-    IVar = np.zeros((V.shape[0], V.shape[1] - 1))
-    
-    for i in range(IVar.shape[0]):
-        for j in range(IVar.shape[1]):     
-            IVar[i,j]=root_scalar(f, args=(i,j), x0=0.5, method='newton')
-    return IVar
\ No newline at end of file
+    for n in prange(n_simulations):
+        buf  = np.empty(max_terms)
+        path = path_offset + n
+        for q in range(2):
+            j              = 4*n + 2*q
+            V[j, 0]        = v0
+            logS[j, 0]     = log_s0
+            logS[j + 1, 0] = log_s0
+            for i in range(N_T - 1):
+                vt      = V[j, i]
+                sub     = (q << 20) + 1
+                N, sub  = _counter_poisson(0.5*lam_coef*vt, seed, path, i, sub)
+                g, sub  = _counter_gamma(0.5*d + N, seed, path, i, sub)
+                vu      = 2.*c*g
+                U, _    = _counter_uniform_pair(seed, path, i, sub)
+                z, _    = _counter_normal_pair(seed, path, i, sub + 1)
+                I       = _bk_integrated_variance(U, vt, vu, nu, kappa, gamma, vbar, dt, h_min, logP, C, logz, eps, buf)
+                drift   = K_0 + rho*(vu - vt)/gamma + K_1*I
+                diff    = sqrt1_rho2*sqrt(I)*z
+                V[j, i+1]        = vu
+                logS[j, i+1]     = logS[j, i]     + drift + diff
+                logS[j + 1, i+1] = logS[j + 1, i] + drift - diff
+            V[j + 1, :] = V[j, :]
+
+    if log_prices:
+        return [logS, V]
+    if workspace is None:
+        return [np.exp(logS), V]
+    S = workspace.S[:4*n_simulations]
+    np.exp(logS, S)
+    return [S, V]
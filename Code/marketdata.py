@@ -0,0 +1,298 @@
+import os
+import json
+import warnings
+import numpy as np
+
+from math import log, sqrt
+from collections import namedtuple
+
+from hestonmc import HestonParameters
+from calibration import LOWER_BOUNDS, UPPER_BOUNDS
+
+if __name__ == '__main__':
+    print("This is a module. Please import it.\n")
+    exit(-1)
+
+DATA_DIR             = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Data')
+CACHE_DIR            = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'),
+                                    'stochastic-volatility-models', 'marketdata')
+ASSET_CLASSES        = ('Equity', 'Curncy')
+CACHE_FORMAT_VERSION = 1
+CACHE_FILES          = {'dates': 'dates.npy', 'high': 'high.npy', 'low': 'low.npy'}
+DATE_FORMAT          = '%d/%m/%Y %H:%M'
+
+PriceSeries    = namedtuple('PriceSeries', ['dates', 'high', 'low'])
+VarianceSeries = namedtuple('VarianceSeries', ['days', 'variance', 'close', 'bars'])
+
+def list_tickers(data_dir:      str   = DATA_DIR,
+                 asset_classes: tuple = ASSET_CLASSES) -> dict:
+    """Finds the price files, e.g. Data/Equity/SBER RX Equity.csv.
+    Args:
+        data_dir (str, optional):        Directory with one subdirectory per asset class. Defaults to DATA_DIR.
+        asset_classes (tuple, optional): Subdirectories to look in. Defaults to ASSET_CLASSES.
+    Returns:
+        A dict ticker -> path of the file, the ticker being the file name without the extension ('SBER RX Equity').
+    """
+    tickers = {}
+    for asset_class in asset_classes:
+        directory = os.path.join(data_dir, asset_class)
+        if not os.path.isdir(directory):
+            continue
+        for file in sorted(os.listdir(directory)):
+            if file.endswith('.csv'):
+                tickers[file[:-len('.csv')]] = os.path.join(directory, file)
+    return tickers
+
+def read_price_chunks(path:       str,
+                      chunk_size: int = 100_000):
+    """Streams a tab-separated Dates/High/Low file in chunks of rows, so that a file is never held in memory as text.
+    Args:
+        path (str):                 Path of the file.
+        chunk_size (int, optional): Number of rows per chunk. Defaults to 100_000.
+    Yields:
+        PriceSeries of the chunk in the order of the file (reverse-chronological for the Bloomberg exports),
+        dates as datetime64[m].
+    """
+    import pandas as pd
+
+    for chunk in pd.read_csv(path, sep='\t', usecols=['Dates', 'High', 'Low'], dtype={'Dates': str, 'High': np.float64, 'Low': np.float64},
+                             chunksize=chunk_size):
+        dates = pd.to_datetime(chunk['Dates'].str.strip(), format=DATE_FORMAT).to_numpy().astype('datetime64[m]')
+        yield PriceSeries(dates, chunk['High'].to_numpy(), chunk['Low'].to_numpy())
+
+def _source_stamp(path: str) -> dict:
+    """Size and modification time of the source file, the cache is rebuilt when they change."""
+    stat = os.stat(path)
+    return {'source_size': stat.st_size, 'source_mtime_ns': stat.st_mtime_ns}
+
+def _read_cache(directory: str,
+                path:      str,
+                mmap:      bool):
+    """The cached series of the file, or None if there is no up-to-date cache of the current format."""
+    try:
+        with open(os.path.join(directory, 'meta.json')) as file:
+            meta = json.load(file)
+    except (OSError, ValueError):
+        return None
+    if meta.get('format_version') != CACHE_FORMAT_VERSION or {key: meta.get(key) for key in ('source_size', 'source_mtime_ns')} != _source_stamp(path):
+        return None
+    return PriceSeries(**{key: np.load(os.path.join(directory, file), mmap_mode='r' if mmap else None) for key, file in CACHE_FILES.items()})
+
+def load_prices(ticker:     str,
+                data_dir:   str  = DATA_DIR,
+                cache_dir:  str  = CACHE_DIR,
+                chunk_size: int  = 100_000,
+                mmap:       bool = True) -> PriceSeries:
+    """Loads the intraday High/Low series of a ticker in chronological order. The first call parses the csv in chunks and stores
+       the columns as .npy files in cache_dir/<ticker>/ with meta.json (format version and the size and modification time of the csv),
+       the next ones open the columns, memory-mapped by default, without parsing.
+    Args:
+        ticker (str):               Ticker as in list_tickers, or the path of a csv file.
+        data_dir (str, optional):   Directory of the data. Defaults to DATA_DIR.
+        cache_dir (str, optional):  Directory of the columnar cache, None to always parse the csv. Defaults to CACHE_DIR,
+                                    the user cache directory ($XDG_CACHE_HOME or ~/.cache) rather than the repository.
+        chunk_size (int, optional): Number of rows per parsed chunk. Defaults to 100_000.
+        mmap (bool, optional):      Memory-map the cached columns instead of loading them. Defaults to True.
+    Raises:
+        ValueError: Unknown ticker.
+    Returns:
+        PriceSeries with the dates (datetime64[m]) and the High and Low prices, sorted by date.
+    """
+    if os.path.isfile(ticker):
+        path, ticker = ticker, os.path.splitext(os.path.basename(ticker))[0]
+    else:
+        tickers = list_tickers(data_dir)
+        if ticker not in tickers:
+            raise ValueError(f"Unknown ticker {ticker}, expected one of {sorted(tickers)}.")
+        path = tickers[ticker]
+
+    directory = None if cache_dir is None else os.path.join(cache_dir, ticker)
+    if directory is not None:
+        cached = _read_cache(directory, path, mmap)
+        if cached is not None:
+            return cached
+
+    chunks = list(read_price_chunks(path, chunk_size))
+    dates  = np.concatenate([chunk.dates for chunk in chunks])
+    order  = np.argsort(dates, kind='stable')
+    series = PriceSeries(dates[order], np.concatenate([chunk.high for chunk in chunks])[order],
+                         np.concatenate([chunk.low for chunk in chunks])[order])
+
+    if directory is not None:
+        os.makedirs(directory, exist_ok=True)
+        for key, file in CACHE_FILES.items():
+            np.save(os.path.join(directory, file), np.ascontiguousarray(getattr(series, key)))
+        with open(os.path.join(directory, 'meta.json'), 'w') as file:
+            json.dump({'format_version': CACHE_FORMAT_VERSION, 'ticker': ticker, 'rows': int(len(dates)), **_source_stamp(path)}, file, indent=4)
+    return series
+
+def parkinson_variance(series:           PriceSeries,
+                       periods_per_year: float = 252.) -> VarianceSeries:
+    """Daily realized variance from the intraday ranges by the estimator of Parkinson (1980): every bar contributes
+       log(High/Low)^2/(4 log 2), the sum over the bars of a day estimates the variance of that day's log-returns.
+       The ranges do not see the overnight gaps and the bars without trades (High = Low) contribute 0,
+       so the estimate is the variance of the trading hours.
+    Args:
+        series (PriceSeries):              Intraday series of load_prices.
+        periods_per_year (float, optional): Number of trading days per year for the annualisation, e.g. 365 for crypto. Defaults to 252..
+    Returns:
+        VarianceSeries with the days (datetime64[D]), the annualised variances, the close of every day,
+        the mid price (High + Low)/2 of its last bar, and the number of its bars with High > Low.
+    """
+    days          = np.asarray(series.dates).astype('datetime64[D]')
+    high, low     = np.asarray(series.high), np.asarray(series.low)
+    bar           = np.log(high/low)**2/(4.*log(2.))
+    unique, start = np.unique(days, return_index=True)
+    last          = np.append(start[1:], len(days)) - 1
+    return VarianceSeries(unique, periods_per_year*np.add.reduceat(bar, start), 0.5*(high[last] + low[last]),
+                          np.add.reduceat((high > low).astype(np.int64), start))
+
+def trading_days_per_year(days: np.ndarray) -> float:
+    """Number of the days with trading per calendar year over the span of the days, about 252 for an exchange, 260 for FX and 365
+       for crypto. The Curncy files hold both FX and crypto, so the annualisation is read from the days rather than from the asset class.
+    Args:
+        days (np.ndarray): Sorted days with trading (datetime64[D]).
+    Returns:
+        The number of the days per year.
+    """
+    days = np.asarray(days).astype('datetime64[D]')
+    return 365.25*len(days)/((days[-1] - days[0]).astype(np.int64) + 1)
+
+def clean_variance(rv:               VarianceSeries,
+                   min_bar_fraction: float = 0.5,
+                   outlier_mads:     float = 5.) -> VarianceSeries:
+    """Filters the daily variances of parkinson_variance for the estimation. The thin days, with fewer moving bars (High > Low)
+       than min_bar_fraction of the median day, are dropped: the weekends of FX and the halted, shortened or stale sessions have
+       near-zero or a few wild ranges that break the autocorrelation of the series. The variances above exp(m + outlier_mads s),
+       m being the median and s the scaled median absolute deviation of the log-variances, are winsorised to that level,
+       so that a few crash days do not dominate the moments.
+    Args:
+        rv (VarianceSeries):                Daily variances of parkinson_variance.
+        min_bar_fraction (float, optional): Smallest number of moving bars of a kept day relative to the median day. Defaults to 0.5.
+        outlier_mads (float, optional):     Winsorisation level in scaled MADs of the log-variances, None to keep the outliers. Defaults to 5..
+    Returns:
+        VarianceSeries of the kept days with positive variance.
+    """
+    keep     = (rv.variance > 0.) & (rv.bars >= min_bar_fraction*np.median(rv.bars))
+    variance = rv.variance[keep]
+    if outlier_mads is not None and len(variance) > 0:
+        logv     = np.log(variance)
+        m        = np.median(logv)
+        variance = np.minimum(variance, np.exp(m + outlier_mads*1.4826*np.median(np.abs(logv - m))))
+    return VarianceSeries(rv.days[keep], variance, rv.close[keep], rv.bars[keep])
+
+def estimate_variance_parameters(variance:         np.ndarray,
+                                 periods_per_year: float = 252.) -> tuple:
+    """Method of moments estimates of the mean reversion speed, the volatility of variance and the long-run variance from a series of
+       realized variances taken as noisy observations of the CIR process dV = kappa(vbar - V)dt + gamma sqrt(V) dW on the grid dt = 1/periods_per_year.
+       Sampled on the grid, V is an AR(1) with the coefficient b = exp(-kappa dt), the mean vbar and the variance gamma^2 vbar/(2 kappa).
+       The measurement error of the realized variance adds to the variance and the lag 0 autocovariance only, so b is taken as
+       the ratio of the lag 2 and lag 1 autocovariances and the variance of V as the lag 1 autocovariance over b; if the ratio is not
+       in (0, 1), as for short or noisy series, the lag 1 autocorrelation is used instead. The estimates are starting points
+       (e.g. of calibrate_heston) rather than final values.
+    Args:
+        variance (np.ndarray):             Annualised realized variances of consecutive trading days. The days without trading
+                                           (non-positive variance) are dropped.
+        periods_per_year (float, optional): Number of observations per year. Defaults to 252..
+    Raises:
+        ValueError: Fewer than 10 positive variances or no positive autocorrelation.
+    Returns:
+        The tuple (kappa, gamma, vbar).
+    """
+    v = np.asarray(variance, dtype=np.float64)
+    v = v[v > 0.]
+    if len(v) < 10:
+        raise ValueError("At least 10 positive variances are needed.")
+
+    vbar = float(np.mean(v))
+    d    = v - vbar
+    acov = [np.dot(d[:len(d) - k], d[k:])/len(d) for k in range(3)]
+    if acov[1] > 0. and 0. < acov[2]/acov[1] < 1.:
+        b, var = acov[2]/acov[1], acov[1]/(acov[2]/acov[1])
+    elif 0. < acov[1] < acov[0]:
+        b, var = acov[1]/acov[0], acov[0]
+    else:
+        raise ValueError("The variances are not positively autocorrelated, the mean reversion speed cannot be estimated.")
+
+    kappa = -log(b)*periods_per_year
+    gamma = float(np.sqrt(2.*kappa*var/vbar))
+    return kappa, gamma, vbar
+
+def _within_bounds(ticker:    str,
+                   estimates: np.ndarray) -> HestonParameters:
+    """Clips the estimates (kappa, gamma, rho, vbar, v0) to the box of calibrate_heston and warns about the clipped ones.
+       A kappa above the bound is lowered with gamma scaled by sqrt(bound/kappa), which keeps the stationary variance
+       gamma^2 vbar/(2 kappa) of the estimates."""
+    x = np.array(estimates, dtype=np.float64)
+    if x[0] > UPPER_BOUNDS[0]:
+        x[1] *= sqrt(UPPER_BOUNDS[0]/x[0])
+    x       = np.clip(x, LOWER_BOUNDS, UPPER_BOUNDS)
+    clipped = [f"{name} = {value:.4g}" for name, value, kept in zip(HestonParameters._fields, estimates, x) if value != kept]
+    if clipped:
+        warnings.warn(f"Estimates of {ticker} outside the bounds of calibrate_heston were clipped: {', '.join(clipped)}.")
+    return HestonParameters(*map(float, x))
+
+def estimate_heston_parameters(ticker:           str,
+                               periods_per_year: float = None,
+                               v0_days:          int   = 5,
+                               min_bar_fraction: float = 0.5,
+                               outlier_mads:     float = 5.,
+                               **kwargs) -> HestonParameters:
+    """Historical Heston parameters of a ticker: kappa, gamma and vbar of estimate_variance_parameters on the Parkinson variances
+       filtered by clean_variance, rho as the correlation of the daily log-returns of the closes with the changes of the variance,
+       and v0 as the mean variance of the last v0_days days. A series of a few months of daily variances mean-reverts within days,
+       so kappa often exceeds the bound of calibrate_heston: the estimates are clipped to its box with a warning (see _within_bounds).
+    Args:
+        ticker (str):                       Ticker as in list_tickers.
+        periods_per_year (float, optional): Number of trading days per year. Defaults to None (trading_days_per_year of the kept days).
+        v0_days (int, optional):            Number of the last days averaged for v0. Defaults to 5.
+        min_bar_fraction (float, optional): Thin day threshold of clean_variance. Defaults to 0.5.
+        outlier_mads (float, optional):     Winsorisation level of clean_variance. Defaults to 5..
+        **kwargs:                           Arguments of load_prices (data_dir, cache_dir, ...).
+    Raises:
+        ValueError: Too little data for estimate_variance_parameters.
+    Returns:
+        The HestonParameters within the bounds of calibrate_heston, e.g. to seed it with initial.
+    """
+    rv = clean_variance(parkinson_variance(load_prices(ticker, **kwargs), 1.), min_bar_fraction, outlier_mads)
+    if len(rv.days) == 0:
+        raise ValueError(f"No days with trading for {ticker}.")
+    if periods_per_year is None:
+        periods_per_year = trading_days_per_year(rv.days)
+    variance           = periods_per_year*rv.variance
+    kappa, gamma, vbar = estimate_variance_parameters(variance, periods_per_year)
+
+    returns = np.diff(np.log(rv.close))
+    changes = np.diff(variance)
+    rho     = np.corrcoef(returns, changes)[0, 1] if np.std(returns) > 0. and np.std(changes) > 0. else 0.
+    v0      = float(np.mean(variance[-v0_days:]))
+    return _within_bounds(ticker, (kappa, gamma, rho, vbar, v0))
+
+def estimate_all(tickers:          list  = None,
+                 periods_per_year: dict  = None,
+                 **kwargs) -> dict:
+    """estimate_heston_parameters for many tickers, the cached ones without parsing their csv.
+    Args:
+        tickers (list, optional):          Tickers. Defaults to None (all of list_tickers).
+        periods_per_year (dict, optional): Trading days per year by ticker, the missing ones are inferred from the data
+                                           (see trading_days_per_year). Defaults to None.
+        **kwargs:                          Arguments of load_prices (data_dir, cache_dir, ...).
+    Raises:
+        ValueError: Unknown ticker.
+    Returns:
+        A dict ticker -> HestonParameters. The tickers with too little data are skipped.
+    """
+    known   = list_tickers(kwargs.get('data_dir', DATA_DIR))
+    tickers = list(known) if tickers is None else tickers
+    unknown = [ticker for ticker in tickers if ticker not in known and not os.path.isfile(ticker)]
+    if unknown:
+        raise ValueError(f"Unknown tickers {unknown}, expected some of {sorted(known)}.")
+    periods_per_year = {} if periods_per_year is None else periods_per_year
+
+    estimates = {}
+    for ticker in tickers:
+        try:
+            estimates[ticker] = estimate_heston_parameters(ticker, periods_per_year.get(ticker), **kwargs)
+        except ValueError:
+            continue
+    return estimates
@@ -0,0 +1,22 @@
+import os
+import sys
+
+import pytest
+
+# the modules of Code/ import each other by their plain names
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from hestonmc import MarketState, HestonParameters
+
+@pytest.fixture
+def state():
+    return MarketState(100., 0.03)
+
+@pytest.fixture
+def heston_params():
+    return HestonParameters(kappa=1.5, gamma=0.6, rho=-0.7, vbar=0.04, v0=0.06)
+
+@pytest.fixture(scope='session')
+def tg_tables():
+    from tg_tables import build_tg_tables
+    return build_tg_tables(N=10_000)
@@ -0,0 +1,23 @@
+import json
+
+import benchmark
+
+ARGS = ['--only', 'euler_terminal', 'payoff_european_call', '--n-simulations', '200', '--repeat', '1']
+
+def test_baseline_round_trip(tmp_path):
+    path = str(tmp_path/'baseline.json')
+    assert benchmark.main(ARGS + ['--N-T', '8', '--save-baseline', path]) == 0
+    with open(path) as file:
+        stored = json.load(file)
+    assert set(stored['results']) == {'euler_terminal', 'payoff_european_call', 'payoff_european_call_log', 'payoff_european_call_strikes'}
+
+    # the checksums are seeded, so only the throughput can drift between the runs
+    assert benchmark.main(ARGS + ['--N-T', '8', '--baseline', path, '--tolerance', '1.']) == 0
+    assert benchmark.main(ARGS + ['--N-T', '9', '--baseline', path]) == 2
+
+def test_compare_reports_regressions():
+    base    = {'qe': {'paths_per_s': 100., 'checksum': 1.}}
+    assert benchmark.compare({'qe': {'paths_per_s': 90., 'checksum': 1.}}, base, 0.15) == []
+    assert len(benchmark.compare({'qe': {'paths_per_s': 80., 'checksum': 1.}}, base, 0.15)) == 1
+    assert len(benchmark.compare({'qe': {'paths_per_s': 80., 'checksum': 1.1}}, base, 0.15)) == 2
+    assert benchmark.compare({'tg': {'paths_per_s': 1., 'checksum': 0.}}, base, 0.15) == []
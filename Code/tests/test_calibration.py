@@ -0,0 +1,74 @@
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+from hestonmc import HestonParameters
+from hestoncos import heston_cos_prices
+from calibration import heston_prices_and_gradients, calibrate_heston
+
+def _surface(state, heston_params):
+    strikes, maturities = np.meshgrid(np.linspace(80., 120., 9), [0.25, 0.5, 1., 2.])
+    strikes, maturities = strikes.ravel(), maturities.ravel()
+    prices              = np.array([heston_cos_prices(state, heston_params, [K], [T])[0, 0] for K, T in zip(strikes, maturities)])
+    return strikes, maturities, prices
+
+def test_gradients_match_finite_differences(state, heston_params):
+    strikes, maturities, prices = _surface(state, heston_params)
+    model, jacobian             = heston_prices_and_gradients(state, heston_params, strikes, maturities, N=512)
+    np.testing.assert_allclose(model, prices, atol=1e-6)
+
+    theta = np.array(heston_params)
+    for j in range(len(theta)):
+        h        = 1e-6*max(abs(theta[j]), 1.)
+        up, down = theta.copy(), theta.copy()
+        up[j]   += h
+        down[j] -= h
+        bumped   = [heston_prices_and_gradients(state, HestonParameters(*x), strikes, maturities, N=512)[0] for x in (up, down)]
+        np.testing.assert_allclose(jacobian[:, j], (bumped[0] - bumped[1])/(2.*h), atol=1e-5)
+
+def test_warm_start_recovers_the_parameters(state, heston_params):
+    strikes, maturities, prices = _surface(state, heston_params)
+    initial = HestonParameters(kappa=1., gamma=0.4, rho=-0.5, vbar=0.05, v0=0.05)
+    result  = calibrate_heston(state, strikes, maturities, prices, initial=initial)
+    assert result.rmse < 1e-6
+    np.testing.assert_allclose(np.array(result.heston_params), np.array(heston_params), rtol=1e-3)
+
+def test_multi_start_recovers_the_parameters(state, heston_params):
+    strikes, maturities, prices = _surface(state, heston_params)
+    result = calibrate_heston(state, strikes, maturities, prices, n_starts=4, n_workers=1, random_seed=1)
+    assert len(result.starts) == 4
+    assert result.rmse < 1e-6
+    np.testing.assert_allclose(np.array(result.heston_params), np.array(heston_params), rtol=1e-3)
+
+def test_too_few_quotes(state, heston_params):
+    strikes, maturities, prices = _surface(state, heston_params)
+    with pytest.raises(ValueError):
+        calibrate_heston(state, strikes[:4], maturities[:4], prices[:4])
+    with pytest.raises(ValueError):
+        calibrate_heston(state, strikes, maturities[:-1], prices)
+
+POOLED_AFTER_ENGINE = """
+import numpy as np
+import hestonmc
+from hestonmc import MarketState, HestonParameters
+from hestoncos import heston_cos_prices
+from calibration import calibrate_heston
+
+state  = MarketState(100., 0.03)
+params = HestonParameters(kappa=1.5, gamma=0.6, rho=-0.7, vbar=0.04, v0=0.06)
+hestonmc.simulate_heston_andersen_qe(state, params, T=1., N_T=10, n_simulations=1000, seed=1)
+
+strikes, maturities = np.meshgrid(np.linspace(80., 120., 5), [0.5, 1.])
+prices = heston_cos_prices(state, params, strikes[0], maturities[:, 0]).ravel()
+result = calibrate_heston(state, strikes.ravel(), maturities.ravel(), prices, n_starts=2, n_workers=2, random_seed=1)
+print(result.rmse)
+"""
+
+def test_pool_after_a_parallel_engine_exits():
+    # a forked pool hangs at the exit of a process that has run parallel Numba code
+    out = subprocess.run([sys.executable, '-c', POOLED_AFTER_ENGINE], cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                         capture_output=True, text=True, timeout=300, check=True).stdout
+    assert float(out.split()[-1]) < 1e-4
@@ -0,0 +1,74 @@
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+from numba import njit
+
+import derivatives
+import hestonmc
+from hestonmc import mc_price
+
+@pytest.mark.parametrize('factory, terms', derivatives.LOG_PAYOFF_FAMILIES)
+def test_log_payoffs_match_price_payoffs(factory, terms, state, heston_params):
+    logS, _ = hestonmc.simulate_heston_andersen_qe(state, heston_params, T=1., N_T=12, n_simulations=500, seed=3, log_prices=True)
+    S, _    = hestonmc.simulate_heston_andersen_qe(state, heston_params, T=1., N_T=12, n_simulations=500, seed=3)
+    terms   = (1., 105., state.interest_rate)[:len(terms)]
+    log_payoff, payoff = factory(*terms), getattr(derivatives, factory.__name__.replace('_log_payoff', '_payoff'))(*terms)
+    np.testing.assert_allclose(log_payoff(logS), payoff(S), rtol=1e-12)
+
+def test_log_prices_in_mc_price(state, heston_params):
+    common = dict(simulate=hestonmc.simulate_heston_andersen_qe, state=state, heston_params=heston_params, T=1., N_T=12,
+                  absolute_error=0., batch_size=1000, MAX_ITER=2, random_seed=3, counter_rng=True)
+    price  = mc_price(derivatives.asian_call_AM_payoff(1., 100., state.interest_rate), **common)
+    logged = mc_price(derivatives.asian_call_AM_log_payoff(1., 100., state.interest_rate), log_prices=True, **common)
+    assert logged == pytest.approx(price, rel=1e-12)
+
+CACHED_LOG_PAYOFF = """
+import numpy as np
+import derivatives
+payoff = derivatives.asian_call_AM_log_payoff(1., 100.)
+payoff(np.zeros((4, 3)))
+print(sum(payoff.kernel.stats.cache_hits.values()))
+"""
+
+def test_log_payoffs_load_from_the_cache():
+    derivatives.warm_up_payoffs()
+    out = subprocess.run([sys.executable, '-c', CACHED_LOG_PAYOFF], cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                         capture_output=True, text=True, timeout=300, check=True).stdout
+    assert int(out.split()[-1]) > 0
+
+def test_registry_covers_every_family():
+    registered = {factory.__name__ for factory, _ in derivatives.PAYOFF_FAMILIES + derivatives.LOG_PAYOFF_FAMILIES}
+    assert registered == {name for name in dir(derivatives) if name.endswith('_payoff') and not name.startswith('_')}
+    assert derivatives.warm_up_payoffs() == len(derivatives.PAYOFF_FAMILIES) + len(derivatives.LOG_PAYOFF_FAMILIES)
+
+@pytest.mark.parametrize('factory, terms', derivatives.PAYOFF_FAMILIES)
+def test_payoff_is_its_kernel_with_the_terms(factory, terms):
+    payoff = factory(*terms)
+    assert factory(*terms).kernel is payoff.kernel
+    assert {'name', 'maturity', 'strike', 'interest_rate'} <= set(payoff.contract)
+    S = 100.*np.exp(np.cumsum(0.05*np.random.default_rng(0).standard_normal((16, 6)), axis=1))
+    np.testing.assert_array_equal(payoff(S), payoff.kernel(S, *payoff.terms))
+
+def test_payoff_kernels_are_callable_in_compiled_code():
+    @njit
+    def mean_payoff(kernel, S, maturity, strike, interest_rate):
+        return np.mean(kernel(S, maturity, strike, interest_rate))
+
+    S = 100.*np.exp(np.cumsum(0.05*np.random.default_rng(0).standard_normal((16, 6)), axis=1))
+    for strike in (90., 110.):
+        payoff = derivatives.european_call_payoff(1., strike, 0.03)
+        assert mean_payoff(payoff.kernel, S, *payoff.terms) == pytest.approx(np.mean(payoff(S)), rel=1e-12)
+
+def test_new_contract_compiles_nothing():
+    S = 100.*np.exp(np.cumsum(0.05*np.random.default_rng(0).standard_normal((16, 6)), axis=1))
+    derivatives.european_put_payoff(1., 90., 0.03)(S)
+    signatures = list(derivatives._european_put.signatures)
+    for maturity, strike in ((0.5, 95.), (2., 120.)):
+        payoff = derivatives.european_put_payoff(maturity, strike, 0.03)
+        assert payoff.__name__ == 'european_put'
+        payoff(S)
+    assert derivatives._european_put.signatures == signatures
@@ -0,0 +1,92 @@
+import numpy as np
+import pytest
+
+import hestonmc
+from hestonmc import ACC_MEAN, ACC_LOG_MEAN, ACC_MAX, ACC_MIN, ACC_UP_HIT, ACC_DOWN_HIT
+from hestoncos import heston_cos_prices
+
+SCHEMES = ['euler', 'andersen_qe', 'em', 'andersen_tg']
+
+def _engines(scheme, tg_tables):
+    kwargs = tg_tables if scheme == 'andersen_tg' else {}
+    return (getattr(hestonmc, 'simulate_heston_' + scheme), getattr(hestonmc, 'simulate_heston_' + scheme + '_terminal'), kwargs)
+
+@pytest.mark.parametrize('scheme', SCHEMES)
+def test_terminal_engine_matches_full_path(scheme, state, heston_params, tg_tables):
+    full, terminal, kwargs = _engines(scheme, tg_tables)
+    S, V   = full(state, heston_params, T=1., N_T=12, n_simulations=500, seed=7, **kwargs)
+    St, Vt = terminal(state, heston_params, T=1., N_T=12, n_simulations=500, seed=7, **kwargs)
+    assert St.shape == (2000, 1) and Vt.shape == (2000, 1)
+    np.testing.assert_allclose(St[:, -1], S[:, -1], rtol=1e-12)
+    np.testing.assert_allclose(Vt[:, 0], V[:, -1], rtol=1e-12, atol=1e-15)
+
+@pytest.mark.parametrize('scheme', SCHEMES)
+def test_terminal_engine_matches_full_path_on_external_normals(scheme, state, heston_params, tg_tables):
+    full, terminal, kwargs = _engines(scheme, tg_tables)
+    Z      = np.random.default_rng(5).standard_normal((2, 500, 12))
+    S, V   = full(state, heston_params, T=1., N_T=12, n_simulations=500, normals=Z, **kwargs)
+    St, Vt = terminal(state, heston_params, T=1., N_T=12, n_simulations=500, normals=Z, **kwargs)
+    np.testing.assert_allclose(St[:, -1], S[:, -1], rtol=1e-12)
+    np.testing.assert_allclose(Vt[:, 0], V[:, -1], rtol=1e-12, atol=1e-15)
+
+def test_terminal_engine_global_generator_follows_set_seed(state, heston_params):
+    hestonmc.set_seed(11)
+    S1, _ = hestonmc.simulate_heston_euler_terminal(state, heston_params, T=1., N_T=12, n_simulations=500)
+    hestonmc.set_seed(11)
+    S2, _ = hestonmc.simulate_heston_euler_terminal(state, heston_params, T=1., N_T=12, n_simulations=500)
+    np.testing.assert_array_equal(S1, S2)
+
+def test_accumulators_match_full_path(state, heston_params):
+    codes    = np.array([ACC_MEAN, ACC_LOG_MEAN, ACC_MAX, ACC_MIN, ACC_UP_HIT, ACC_DOWN_HIT])
+    barriers = np.array([0., 0., 0., 0., 110., 90.])
+    S, _     = hestonmc.simulate_heston_andersen_qe(state, heston_params, T=1., N_T=12, n_simulations=500, seed=3)
+    A, _     = hestonmc.simulate_heston_andersen_qe_terminal(state, heston_params, T=1., N_T=12, n_simulations=500, seed=3,
+                                                             accumulators=codes, barriers=barriers)
+    expected = np.column_stack([S.mean(axis=1), np.log(S).mean(axis=1), S.max(axis=1), S.min(axis=1),
+                                (S >= 110.).any(axis=1), (S <= 90.).any(axis=1), S[:, -1]])
+    np.testing.assert_allclose(A, expected, rtol=1e-12)
+
+def _call_error(S, state, heston_params, T, N_T, strike=100.):
+    """MC error of a call on the last column of the paths against COS at its date (N_T - 1)T/N_T, and its standard error."""
+    t      = T*(N_T - 1)/N_T
+    payoff = np.exp(-state.interest_rate*t)*np.maximum(S[:, -1] - strike, 0.)
+    return payoff.mean() - heston_cos_prices(state, heston_params, [strike], [t])[0, 0], payoff.std()/np.sqrt(len(payoff))
+
+def test_broadie_kaya_is_exact_on_a_coarse_grid(state, heston_params):
+    S, _             = hestonmc.simulate_heston_broadie_kaya(state, heston_params, T=1., N_T=4, n_simulations=25_000, seed=3)
+    error, std_error = _call_error(S, state, heston_params, 1., 4)
+    assert abs(error) < 4.*std_error
+
+    cache = hestonmc.broadie_kaya_cache(heston_params, 1., 4)
+    S_cached, _ = hestonmc.simulate_heston_broadie_kaya(state, heston_params, T=1., N_T=4, n_simulations=500, seed=3, bk_cache=cache)
+    np.testing.assert_array_equal(S_cached, S[:len(S_cached)])
+
+def test_em_converges_to_cos(state, heston_params):
+    S, _             = hestonmc.simulate_heston_em_terminal(state, heston_params, T=1., N_T=192, n_simulations=100_000, seed=3)
+    error, std_error = _call_error(S, state, heston_params, 1., 192)
+    assert abs(error) < 4.*std_error
+
+    with pytest.raises(hestonmc.error):
+        hestonmc.simulate_heston_em(state, heston_params, T=1., N_T=12, n_simulations=10, gamma_1=1.5)
+
+@pytest.mark.parametrize('scheme', SCHEMES)
+def test_float32_storage_rounds_the_float64_paths(scheme, state, heston_params, tg_tables):
+    full, _, kwargs = _engines(scheme, tg_tables)
+    S, V     = full(state, heston_params, T=1., N_T=50, n_simulations=500, seed=7, **kwargs)
+    S32, V32 = full(state, heston_params, T=1., N_T=50, n_simulations=500, seed=7, storage_dtype=np.float32, **kwargs)
+    assert S32.dtype == V32.dtype == np.float32
+    np.testing.assert_array_equal(V32, V.astype(np.float32))
+    np.testing.assert_allclose(S32, S, rtol=1e-6)
+
+@pytest.mark.parametrize('scheme', SCHEMES)
+def test_workspace_gives_the_same_paths(scheme, state, heston_params, tg_tables):
+    full, _, kwargs = _engines(scheme, tg_tables)
+    workspace = hestonmc.make_workspace(500, 12)
+    S, V      = full(state, heston_params, T=1., N_T=12, n_simulations=300, seed=7, **kwargs)
+    Sw, Vw    = full(state, heston_params, T=1., N_T=12, n_simulations=300, seed=7, workspace=workspace, **kwargs)
+    np.testing.assert_array_equal(Sw, S)
+    np.testing.assert_array_equal(Vw, V)
+    assert np.shares_memory(Sw, workspace.S) and np.shares_memory(Vw, workspace.V)
+
+    with pytest.raises(hestonmc.error):
+        full(state, heston_params, T=1., N_T=12, n_simulations=600, seed=7, workspace=workspace, **kwargs)
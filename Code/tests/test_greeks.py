@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+
+import derivatives
+import hestonmc
+from hestonmc import MarketState, HestonParameters, mc_price
+from greeks import mc_greeks, GREEK_PARAMS
+
+# Feller condition holds and Psi stays below Psi_c, so the simulated price is a smooth function of the parameters
+SMOOTH_PARAMS = HestonParameters(kappa=2., gamma=0.2, rho=-0.7, vbar=0.04, v0=0.06)
+
+@pytest.mark.parametrize('scheme', ['qe', 'euler'])
+def test_pathwise_greeks_match_finite_differences(scheme, state):
+    payoff     = derivatives.european_call_payoff(1., 100., state.interest_rate)
+    derivative = derivatives.european_call_pathwise_payoff(1., 100., state.interest_rate)
+    common     = dict(T=1., N_T=20, n_simulations=5000, scheme=scheme, seed=3)
+    greeks, _  = mc_greeks(payoff, state, SMOOTH_PARAMS, payoff_derivative=derivative, **common)
+
+    def price(state, heston_params):
+        return mc_greeks(payoff, state, heston_params, **common)[0]['price']
+
+    h = 1e-5
+    up, down = MarketState(state.stock_price + h, state.interest_rate), MarketState(state.stock_price - h, state.interest_rate)
+    assert greeks['delta'] == pytest.approx((price(up, SMOOTH_PARAMS) - price(down, SMOOTH_PARAMS))/(2.*h), rel=1e-5)
+
+    h = 1e-6
+    for name in GREEK_PARAMS:
+        value    = getattr(SMOOTH_PARAMS, name)
+        up, down = SMOOTH_PARAMS._replace(**{name: value + h}), SMOOTH_PARAMS._replace(**{name: value - h})
+        assert greeks['d' + name] == pytest.approx((price(state, up) - price(state, down))/(2.*h), rel=1e-4, abs=1e-6)
+
+def test_likelihood_ratio_agrees_with_pathwise(state):
+    payoff     = derivatives.european_call_payoff(1., 100., state.interest_rate)
+    derivative = derivatives.european_call_pathwise_payoff(1., 100., state.interest_rate)
+    pathwise, _      = mc_greeks(payoff, state, SMOOTH_PARAMS, 1., 20, 20_000, payoff_derivative=derivative, seed=3)
+    ratio, intervals = mc_greeks(payoff, state, SMOOTH_PARAMS, 1., 20, 20_000, seed=3)
+    assert ratio['price'] == pathwise['price']
+    # the likelihood-ratio estimates are much noisier, twice the half-width of the interval is about 4 standard errors
+    for name in ('delta', 'dv0', 'dkappa', 'dvbar', 'dgamma', 'drho'):
+        low, high = intervals[name]
+        assert abs(ratio[name] - pathwise[name]) < high - low
+
+def test_default_price_is_the_qe_price(state, heston_params):
+    payoff    = derivatives.european_call_payoff(1., 100., state.interest_rate)
+    greeks, _ = mc_greeks(payoff, state, heston_params, 1., 20, 5000, batch_size=5000, seed=3)
+    price     = mc_price(payoff, hestonmc.simulate_heston_andersen_qe, state, heston_params, T=1., N_T=20, absolute_error=0.,
+                         batch_size=5000, MAX_ITER=1, random_seed=3, counter_rng=True)
+    assert greeks['price'] == pytest.approx(price, rel=1e-12)
@@ -0,0 +1,20 @@
+import numpy as np
+
+from grid_runner import make_jobs, make_chunks, run_grid
+
+def test_sweep_does_not_depend_on_the_scheduling(state, heston_params):
+    test_params = {'schemes': ['simulate_heston_andersen_qe', 'simulate_heston_euler'], 'strikes': [90., 110.], 'Ts': [0.5],
+                   'N_Ts': [4], 'batch_sizes': [1000], 'heston_params_n': [1]}
+    runs = [run_grid(test_params, [heston_params], state, {'absolute_error': 0.5}, n_workers=2, chunk_size=chunk_size)
+            for chunk_size in (1, 4)]
+    np.testing.assert_array_equal(runs[0]['MC_price'].to_numpy(), runs[1]['MC_price'].to_numpy())
+    assert list(runs[0]['strike']) == [job['strike'] for job in make_jobs(test_params)]
+
+def test_chunks_are_queued_scheme_by_scheme():
+    test_params = {'schemes': ['simulate_heston_andersen_qe', 'simulate_heston_euler'], 'strikes': [90., 100., 110.], 'Ts': [0.5, 2.],
+                   'N_Ts': [4, 40], 'batch_sizes': [1000], 'heston_params_n': [1]}
+    chunks  = make_chunks(make_jobs(test_params), 2)
+    schemes = [chunk[0]['scheme'] for chunk in chunks]
+    assert all(job['scheme'] == chunk[0]['scheme'] for chunk in chunks for job in chunk)
+    assert schemes == sorted(schemes, key=test_params['schemes'].index)
+    assert sorted(job['index'] for chunk in chunks for job in chunk) == list(range(24))
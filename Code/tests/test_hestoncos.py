@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+
+from scipy.integrate import quad
+from scipy.stats import norm
+
+import derivatives
+import hestonmc
+from hestonmc import HestonParameters
+from hestoncos import heston_char_func, heston_cos_prices, heston_geometric_asian_prices, control_variate_mean
+
+def _gil_pelaez_call(state, heston_params, T, strike):
+    """Call price from the inversion formula of Gil-Pelaez with adaptive quadrature, independent of the COS machinery."""
+    r, s0 = state.interest_rate, state.stock_price
+    k     = np.log(strike/s0)
+    phi   = lambda u: heston_char_func(u, T, r, heston_params)
+    forward = phi(-1j).real
+
+    def probability(shift, norm):
+        def integrand(u):
+            return (np.exp(-1j*u*k)*phi(u - shift)/(1j*u*norm)).real
+        return 0.5 + quad(integrand, 1e-12, 200., limit=500, epsabs=1e-12)[0]/np.pi
+
+    P1 = probability(1j, forward)
+    P2 = probability(0., 1.)
+    return s0*P1 - strike*np.exp(-r*T)*P2
+
+def test_char_func_accepts_complex_arguments(state, heston_params):
+    for T in (0.25, 1., 5.):
+        value = heston_char_func(np.array([-1j, 0.]), T, state.interest_rate, heston_params)
+        np.testing.assert_allclose(value, [np.exp(state.interest_rate*T), 1.], rtol=1e-12)
+
+@pytest.mark.parametrize('T', [0.1, 1., 3.])
+def test_cos_matches_quadrature(state, heston_params, T):
+    strikes = np.array([70., 90., 100., 110., 140.])
+    cos     = heston_cos_prices(state, heston_params, strikes, [T])[0]
+    exact   = [_gil_pelaez_call(state, heston_params, T, K) for K in strikes]
+    np.testing.assert_allclose(cos, exact, atol=1e-5)
+
+def test_put_call_parity(state, heston_params):
+    strikes = np.linspace(60., 160., 11)
+    T       = 2.
+    calls   = heston_cos_prices(state, heston_params, strikes, [T], option_type='call')[0]
+    puts    = heston_cos_prices(state, heston_params, strikes, [T], option_type='put')[0]
+    np.testing.assert_allclose(calls - puts, state.stock_price - strikes*np.exp(-state.interest_rate*T), atol=1e-10)
+
+def test_unknown_option_type(state, heston_params):
+    with pytest.raises(ValueError):
+        heston_cos_prices(state, heston_params, [100.], [1.], option_type='straddle')
+
+def test_geometric_asian_black_scholes_limit(state):
+    """With v0 = vbar, rho = 0 and a vanishing vol of vol the variance stays at v0 and log(I) = dt sum_i log(S_{t_i}) is Gaussian."""
+    sigma, T, N_T = 0.2, 1., 12
+    params        = HestonParameters(kappa=1.5, gamma=1e-4, rho=0., vbar=sigma**2, v0=sigma**2)
+    strikes       = np.array([80., 95., 100., 105., 120.])
+
+    r, dt = state.interest_rate, T/N_T
+    t     = dt*np.arange(N_T)
+    mean  = dt*np.sum(np.log(state.stock_price) + (r - 0.5*sigma**2)*t)
+    std   = dt*sigma*np.sqrt(np.minimum.outer(t, t).sum())
+    d1    = (mean - np.log(strikes) + std**2)/std
+    exact = np.exp(-r*T)*(np.exp(mean + 0.5*std**2)*norm.cdf(d1) - strikes*norm.cdf(d1 - std))
+
+    np.testing.assert_allclose(heston_geometric_asian_prices(state, params, strikes, T, N_T), exact, atol=1e-6)
+
+def test_geometric_asian_matches_simulation(state):
+    """The monitoring dates are every 16th column of a fine Euler grid, so that the discretisation bias of the engine is negligible."""
+    T, N_T, m = 1., 12, 16
+    params    = HestonParameters(kappa=2., gamma=0.2, rho=-0.7, vbar=0.04, v0=0.06)
+    strikes   = np.array([90., 100., 110.])
+
+    S       = hestonmc.simulate_heston_euler(state, params, T, m*N_T, 20_000, seed=5)[0][:, ::m]
+    I       = np.exp(np.sum(np.log(S), axis=1)*T/N_T)
+    payoffs = np.exp(-state.interest_rate*T)*np.maximum(I[:, None] - strikes, 0.)
+    exact   = heston_geometric_asian_prices(state, params, strikes, T, N_T)
+    assert np.all(np.abs(payoffs.mean(axis=0) - exact) < 4.*payoffs.std(axis=0)/np.sqrt(len(payoffs)))
+
+    payoff = derivatives.asian_call_GM_payoff(T, 100., state.interest_rate)
+    assert control_variate_mean(payoff, state, params, T, N_T) == pytest.approx(exact[1], abs=1e-12)
@@ -0,0 +1,90 @@
+import os
+
+import numpy as np
+import pytest
+
+from math import log
+
+from calibration import LOWER_BOUNDS, UPPER_BOUNDS
+from marketdata import (VarianceSeries, load_prices, parkinson_variance, trading_days_per_year, clean_variance,
+                        estimate_variance_parameters, estimate_heston_parameters)
+
+ROWS = [('03/03/2022 10:01', 101., 100.), ('03/03/2022 10:00', 102., 100.), ('02/03/2022 19:45', 100.5, 99.5),
+        ('02/03/2022 19:14', 100., 100.), ('02/03/2022 19:13', 101., 99.)]
+
+def _write_csv(path, rows):
+    with open(path, 'w') as file:
+        file.write('Dates\tHigh\tLow\n')
+        for row in rows:
+            file.write('%s\t%s\t%s\n' % row)
+
+def test_prices_are_cached_in_columns(tmp_path):
+    path, cache = str(tmp_path/'TEST Equity.csv'), str(tmp_path/'cache')
+    _write_csv(path, ROWS)
+    parsed = load_prices(path, cache_dir=cache, chunk_size=2)
+    assert np.all(np.diff(parsed.dates.astype(np.int64)) > 0)
+    np.testing.assert_array_equal(parsed.high, [101., 100., 100.5, 102., 101.])
+    assert os.path.exists(os.path.join(cache, 'TEST Equity', 'meta.json'))
+
+    cached = load_prices(path, cache_dir=cache)
+    assert isinstance(cached.high, np.memmap)
+    for key in parsed._fields:
+        np.testing.assert_array_equal(getattr(cached, key), getattr(parsed, key))
+
+    # a changed source is parsed again
+    _write_csv(path, ROWS[:3])
+    assert len(load_prices(path, cache_dir=cache).dates) == 3
+
+def test_unknown_ticker(tmp_path):
+    with pytest.raises(ValueError):
+        load_prices('NO SUCH Equity', data_dir=str(tmp_path), cache_dir=None)
+
+def test_parkinson_variance_sums_the_bars(tmp_path):
+    path = str(tmp_path/'TEST Equity.csv')
+    _write_csv(path, ROWS)
+    rv = parkinson_variance(load_prices(path, cache_dir=None), periods_per_year=1.)
+    np.testing.assert_array_equal(rv.days, np.array(['2022-03-02', '2022-03-03'], dtype='datetime64[D]'))
+    expected = [(log(101./99.)**2 + log(100.5/99.5)**2)/(4.*log(2.)), (log(102./100.)**2 + log(101./100.)**2)/(4.*log(2.))]
+    np.testing.assert_allclose(rv.variance, expected, rtol=1e-14)
+    np.testing.assert_allclose(rv.close, [100., 100.5])
+    np.testing.assert_array_equal(rv.bars, [2, 2])
+
+def test_variance_parameters_of_a_cir_series():
+    """Exact CIR transitions (scaled noncentral chi-square) observed with multiplicative noise, as the realized variances."""
+    kappa, gamma, vbar, periods = 3., 0.4, 0.04, 252.
+    dt, rng = 1./periods, np.random.default_rng(0)
+    c       = gamma**2*(1. - np.exp(-kappa*dt))/(4.*kappa)
+    v       = np.empty(100*252)
+    v[0]    = vbar
+    for i in range(1, len(v)):
+        v[i] = c*rng.noncentral_chisquare(4.*kappa*vbar/gamma**2, v[i-1]*np.exp(-kappa*dt)/c)
+    observed = v*rng.lognormal(-0.02, 0.2, len(v))
+
+    estimates = estimate_variance_parameters(observed, periods)
+    np.testing.assert_allclose(estimates, (kappa, gamma, vbar), rtol=0.25)
+    with pytest.raises(ValueError):
+        estimate_variance_parameters(observed[:5], periods)
+
+def test_clean_variance_drops_thin_days_and_winsorises():
+    days     = np.arange('2022-01-03', '2022-01-13', dtype='datetime64[D]')
+    variance = np.array([1., 2., 1., 1e-6, 2., 1., 500., 2., 1., 0.])*1e-4
+    bars     = np.array([400, 390, 410, 3, 400, 405, 395, 400, 410, 400])
+    rv       = clean_variance(VarianceSeries(days, variance, np.ones(10), bars))
+    np.testing.assert_array_equal(rv.days, np.delete(days, [3, 9]))
+    assert rv.variance.max() < 500e-4 and rv.variance[5] > 2e-4
+    np.testing.assert_array_equal(np.delete(rv.variance, 5), np.delete(variance, [3, 6, 9]))
+
+def test_trading_days_per_year():
+    days = np.arange('2021-01-04', '2022-01-03', dtype='datetime64[D]')
+    assert trading_days_per_year(days) == pytest.approx(365.25)
+    assert trading_days_per_year(days[np.is_busday(days)]) == pytest.approx(262, abs=1.)
+
+def test_heston_parameters_of_a_real_ticker(tmp_path):
+    """EURUSD over the first quarter of 2022: the daily variances mean-revert within days, so kappa is clipped to the bound,
+       the level and the volatility of the variance are those of a 5-10% volatility currency pair."""
+    with pytest.warns(UserWarning, match='kappa'):
+        params = estimate_heston_parameters('EURUSD Curncy', cache_dir=str(tmp_path))
+    assert np.all(np.array(params) >= LOWER_BOUNDS) and np.all(np.array(params) <= UPPER_BOUNDS)
+    assert params.kappa == UPPER_BOUNDS[0]
+    assert 0.05**2 < params.vbar < 0.1**2 and 0.05**2 < params.v0 < 0.1**2
+    assert 0.1 < params.gamma < 1. and -0.5 < params.rho < 0.
@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+
+from math import ceil
+
+import derivatives
+import hestonmc
+from hestonmc import mc_price, mc_price_strikes, mc_price_portfolio
+
+def test_strike_ladder_matches_single_strikes(state, heston_params):
+    strikes = np.array([90., 100., 110.])
+    common  = dict(simulate=hestonmc.simulate_heston_andersen_qe, state=state, heston_params=heston_params, T=1., N_T=10,
+                   absolute_error=0., batch_size=2000, MAX_ITER=2, random_seed=11, counter_rng=True)
+    prices, _ = mc_price_strikes(derivatives.european_call_strikes_payoff, strikes, **common)
+    singles   = [mc_price(derivatives.european_call_payoff(1., K, state.interest_rate), **common) for K in strikes]
+    np.testing.assert_allclose(prices, singles, rtol=1e-12)
+
+def test_control_variates_reduce_the_error(state):
+    heston_params = hestonmc.HestonParameters(kappa=2., gamma=0.2, rho=-0.7, vbar=0.04, v0=0.06)
+    payoff        = derivatives.asian_call_AM_payoff(1., 100., state.interest_rate)
+    controls      = [derivatives.asian_call_GM_payoff(1., 100., state.interest_rate), derivatives.terminal_stock_payoff(1., state.interest_rate)]
+    common        = dict(simulate=hestonmc.simulate_heston_euler, state=state, heston_params=heston_params, T=1., N_T=48,
+                         absolute_error=0., batch_size=20_000, MAX_ITER=4, random_seed=3, counter_rng=True, return_statistics=True)
+    plain, plain_stats = mc_price(payoff, **common)
+    price, stats       = mc_price(payoff, control_variate_payoff=controls, **common)
+    # the means of the controls are exact for the model, so the difference includes the discretisation bias of the engine
+    assert abs(price - plain) < 4.*plain_stats.std_error()[0]
+    assert stats.std_error()[0] < 0.05*plain_stats.std_error()[0]
+
+def test_portfolio_matches_single_contracts(state, heston_params):
+    strikes  = np.array([90., 110.])
+    payoffs  = [derivatives.european_call_strikes_payoff(1., strikes, state.interest_rate),
+                derivatives.asian_call_AM_payoff(1., 100., state.interest_rate)]
+    weights  = np.array([1., -2., 0.5])
+    common   = dict(simulate=hestonmc.simulate_heston_andersen_qe, state=state, heston_params=heston_params, T=1., N_T=10,
+                    absolute_error=0., batch_size=2000, MAX_ITER=2, random_seed=11, counter_rng=True)
+    prices, lengths = mc_price_portfolio(payoffs, weights=weights, **common)
+    ladder, _       = mc_price_strikes(derivatives.european_call_strikes_payoff, strikes, **common)
+    asian           = mc_price(payoffs[1], **common)
+    assert len(prices) == len(lengths) == 4
+    np.testing.assert_allclose(prices[:3], [*ladder, asian], rtol=1e-12)
+    assert prices[3] == pytest.approx(np.dot(weights, prices[:3]), rel=1e-12)
+
+def test_planner_reaches_the_tolerance_in_few_batches(state, heston_params):
+    sizes = []
+    def simulate(**kwargs):
+        sizes.append(kwargs['n_simulations'])
+        return hestonmc.simulate_heston_andersen_qe_terminal(**kwargs)
+
+    payoff       = derivatives.european_call_payoff(1., 100., state.interest_rate)
+    price, stats = mc_price(payoff, simulate, state, heston_params, T=1., N_T=10, absolute_error=0.05, batch_size=1000,
+                            random_seed=5, counter_rng=True, return_statistics=True, plan_batches=True, max_batch_size=50_000)
+    assert stats.conf_interval_length(0.05)[0] <= 0.05
+    assert sizes[0] == 1000 and max(sizes) <= 50_000
+    # a single plan normally suffices, a correction may add one more batch
+    assert len(sizes) <= 1 + ceil(stats.n/4/50_000) + 1
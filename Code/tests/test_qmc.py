@@ -0,0 +1,24 @@
+import numpy as np
+
+import derivatives
+import hestonmc
+from hestonmc import mc_price, sobol_normals
+
+def test_bridge_normals_are_independent_standard():
+    Z = sobol_normals(4096, 9, rng=1)
+    assert Z.shape == (2, 4096, 9)
+    np.testing.assert_array_equal(Z[:, :, -1], 0.)
+    z = np.concatenate([Z[0, :, :-1], Z[1, :, :-1]], axis=1)
+    np.testing.assert_allclose(z.mean(axis=0), 0., atol=0.02)
+    np.testing.assert_allclose(np.cov(z, rowvar=False), np.eye(16), atol=0.05)
+
+def test_qmc_price_agrees_with_monte_carlo(state, heston_params):
+    payoff = derivatives.european_call_payoff(1., 100., state.interest_rate)
+    common = dict(simulate=hestonmc.simulate_heston_euler, state=state, heston_params=heston_params, T=1., N_T=16,
+                  absolute_error=0., batch_size=4096, return_statistics=True)
+    qmc, qmc_stats = mc_price(payoff, MAX_ITER=8, qmc_scrambles=8, random_seed=2, **common)
+    mc, mc_stats   = mc_price(payoff, MAX_ITER=8, random_seed=2, counter_rng=True, **common)
+    assert qmc_stats.n == 8
+    assert abs(qmc - mc) < 4.*np.hypot(qmc_stats.std_error()[0], mc_stats.std_error()[0])
+    # the standard errors of the estimates from the same number of paths
+    assert qmc_stats.std_error()[0] < 0.5*mc_stats.std_error()[0]
@@ -0,0 +1,25 @@
+import numpy as np
+import pytest
+
+import derivatives
+import hestonmc
+from hestonmc import mc_price, _standard_normals
+
+def test_counter_normals_do_not_depend_on_the_split():
+    Z = _standard_normals(1000, 8, 5)
+    np.testing.assert_array_equal(np.concatenate([_standard_normals(300, 8, 5), _standard_normals(700, 8, 5, 300)], axis=1), Z)
+    np.testing.assert_array_equal(_standard_normals(1000, 3, 5, 0, 5), Z[:, :, 5:])
+
+def test_counter_normals_are_standard():
+    z = _standard_normals(100_000, 2, 1).ravel()
+    assert abs(z.mean()) < 0.01
+    assert abs(z.var() - 1.) < 0.01
+    assert abs(np.corrcoef(z[:-1], z[1:])[0, 1]) < 0.01
+
+@pytest.mark.parametrize('simulate', [hestonmc.simulate_heston_andersen_qe, hestonmc.simulate_heston_andersen_qe_terminal,
+                                      hestonmc.simulate_heston_broadie_kaya])
+def test_counter_price_does_not_depend_on_the_batch_size(simulate, state, heston_params):
+    payoff = derivatives.european_call_payoff(1., 100., state.interest_rate)
+    prices = [mc_price(payoff, simulate, state, heston_params, T=1., N_T=4, absolute_error=0., batch_size=batch_size,
+                       MAX_ITER=2400//batch_size, random_seed=3, counter_rng=True) for batch_size in (300, 800, 2400)]
+    np.testing.assert_allclose(prices, prices[0], rtol=1e-12)
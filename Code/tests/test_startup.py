@@ -0,0 +1,27 @@
+import os
+import subprocess
+import sys
+
+import numpy as np
+
+from scipy.special import ndtri
+
+import hestonmc
+from hestonmc import _norm_ppf
+
+def test_norm_ppf_matches_scipy():
+    p = np.concatenate([np.logspace(-300, -1, 300), np.linspace(0.01, 0.99, 99), 1. - np.logspace(-16, -1, 100)])
+    np.testing.assert_allclose([_norm_ppf(x) for x in p], ndtri(p), rtol=1e-14, atol=1e-14)
+    assert _norm_ppf(0.) == -np.inf and _norm_ppf(1.) == np.inf
+
+def test_import_does_not_load_scipy_stats():
+    script = "import sys, hestonmc, derivatives; print('scipy.stats' in sys.modules)"
+    out    = subprocess.run([sys.executable, '-c', script], cwd=os.path.dirname(hestonmc.__file__),
+                            capture_output=True, text=True, check=True).stdout
+    assert out.strip() == 'False'
+
+def test_precompile_covers_the_mc_price_calls():
+    engines = (hestonmc.simulate_heston_euler, hestonmc.simulate_heston_euler_terminal)
+    count   = hestonmc.precompile(engines=engines, payoffs=False)
+    # the full-path engine with and without log_prices, the terminal one once, each with both generators
+    assert count == 6
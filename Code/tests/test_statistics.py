@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+
+from hestonmc import MCStatistics, MCRegressionStatistics, statistics_from_moments
+
+def test_merged_statistics_match_numpy():
+    rng   = np.random.default_rng(0)
+    batch = rng.standard_normal((10_001, 3))*[1., 2., 3.] + [1., 2., 3.]
+    stats = MCStatistics(3)
+    for part in np.array_split(batch, [1, 4000, 4001, 7000]):
+        stats.update(part)
+    assert stats.n == len(batch)
+    np.testing.assert_allclose(stats.mean, batch.mean(axis=0), rtol=1e-13)
+    np.testing.assert_allclose(stats.variance(), batch.var(axis=0, ddof=1), rtol=1e-12)
+
+    first, second = MCStatistics(3), statistics_from_moments(stats.n, stats.mean, stats.M2)
+    first.merge(second)
+    np.testing.assert_allclose(first.mean, stats.mean, rtol=1e-13)
+    np.testing.assert_allclose(first.M2, stats.M2, rtol=1e-13)
+
+def test_regression_statistics_match_least_squares():
+    rng   = np.random.default_rng(1)
+    X     = rng.standard_normal((20_001, 2)) + [1., -1.]
+    Y     = 3. + 2.*X[:, 0] - X[:, 1] + 0.1*rng.standard_normal(len(X))
+    batch = np.column_stack([Y, X])
+    stats = MCRegressionStatistics(2)
+    means = [stats.update(part) for part in np.array_split(batch, [3, 10_000])]
+    np.testing.assert_allclose(means[-1], batch[10_000:].mean(axis=0), rtol=1e-13)
+
+    np.testing.assert_allclose(stats.mean, batch.mean(axis=0), rtol=1e-13)
+    np.testing.assert_allclose(stats.C, np.cov(batch, rowvar=False)*(len(batch) - 1), rtol=1e-11)
+    centred = batch - batch.mean(axis=0)
+    np.testing.assert_allclose(stats.coefficients(), np.linalg.lstsq(centred[:, 1:], centred[:, 0], rcond=None)[0], rtol=1e-10)
+
+    # at the sample means of the controls the estimate is the plain mean, at the exact ones the noise is only the residual one
+    assert stats.estimate(stats.mean[1:])[0] == pytest.approx(stats.mean[0], abs=1e-12)
+    price, std_error = stats.estimate(np.array([1., -1.]))
+    assert abs(price - 6.) < 4.*std_error
+    assert std_error == pytest.approx(0.1/np.sqrt(len(batch)), rel=0.05)
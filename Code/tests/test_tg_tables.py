@@ -0,0 +1,38 @@
+import json
+import os
+
+import numpy as np
+import pytest
+from scipy.stats import norm
+
+from hestonmc import calculate_tg_tables
+from tg_tables import build_tg_tables, save_tg_tables, open_tg_tables, f_nu_f_sigma_from_r
+
+def test_tables_round_trip(tmp_path):
+    tables = build_tg_tables(stop=10., N=101)
+    save_tg_tables(str(tmp_path), tables)
+    for mmap in (True, False):
+        opened = open_tg_tables(str(tmp_path), mmap=mmap)
+        for key, value in tables.items():
+            np.testing.assert_array_equal(opened[key], value)
+    assert isinstance(open_tg_tables(str(tmp_path))['x_grid'], np.memmap)
+
+def test_unsupported_version_is_rejected(tmp_path):
+    save_tg_tables(str(tmp_path), build_tg_tables(stop=10., N=11))
+    with open(os.path.join(tmp_path, 'meta.json')) as file:
+        meta = json.load(file)
+    meta['format_version'] += 1
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as file:
+        json.dump(meta, file)
+    with pytest.raises(ValueError):
+        open_tg_tables(str(tmp_path))
+
+def test_builder_solves_the_moment_matching_equation():
+    x = np.linspace(0., 50., 501)
+    r, f_nu, f_sigma = calculate_tg_tables(x)
+    psi, root = x[1:], r[1:]
+    residual  = root*norm.pdf(root) + norm.cdf(root)*(1. + root**2) - (1. + psi)*(norm.pdf(root) + root*norm.cdf(root))**2
+    assert np.max(np.abs(residual)) < 1e-10
+    expected = f_nu_f_sigma_from_r(x, r)
+    np.testing.assert_allclose(f_nu, expected[0], rtol=1e-10)
+    np.testing.assert_allclose(f_sigma, expected[1], rtol=1e-10)
@@ -0,0 +1,127 @@
+import os
+import json
+import numpy as np
+
+from math import sqrt, pi, erf
+
+if __name__ == '__main__':
+    print("This is a module. Please import it.\n")
+    exit(-1)
+
+TABLE_FORMAT_VERSION = 1
+TABLE_FILES          = {'x_grid': 'x.npy', 'f_nu_grid': 'f_nu.npy', 'f_sigma_grid': 'f_sigma.npy'}
+
+def f_nu_f_sigma_from_r(x: np.ndarray,
+                        r: np.ndarray):
+    """Moment-matching functions of the Truncated Gaussian scheme, nu = m*f_nu(\psi) and sigma = s*f_sigma(\psi).
+    Args:
+        x (np.ndarray): Values of \psi.
+        r (np.ndarray): Roots r(\psi) of the moment-matching equation.
+    Returns:
+        The pair of arrays (f_nu, f_sigma). At \psi = 0 the limits f_nu = f_sigma = 1 are used.
+    """
+    x, r    = np.asarray(x, dtype=np.float64), np.asarray(r, dtype=np.float64)
+    f_nu    = np.ones_like(x)
+    f_sigma = np.ones_like(x)
+    pos     = x > 0
+    pdf     = np.exp(-0.5*r[pos]**2)/sqrt(2*pi)
+    cdf     = 0.5 + 0.5*np.vectorize(erf)(r[pos]/sqrt(2))
+    denom   = pdf + r[pos]*cdf
+
+    f_nu[pos]    = r[pos]/denom
+    f_sigma[pos] = 1./(np.sqrt(x[pos])*denom)
+    return f_nu, f_sigma
+
+def build_tg_tables(stop: float = 100.,
+                    N:    int   = 5_000_000):
+    """Builds the tables of simulate_heston_andersen_tg on the uniform grid 0, dx, ..., stop with the compiled builder.
+    Args:
+        stop (float, optional): Last point of the \psi grid. Defaults to 100..
+        N (int, optional):      Number of points of the grid. Defaults to 5_000_000.
+    Returns:
+        A dict with the x_grid, f_nu_grid, f_sigma_grid arrays that can be passed to the engine as kwargs.
+    """
+    from hestonmc import calculate_tg_tables
+
+    x                = np.linspace(0., stop, N)
+    _, f_nu, f_sigma = calculate_tg_tables(x)
+    return {'x_grid': x, 'f_nu_grid': f_nu, 'f_sigma_grid': f_sigma}
+
+def save_tg_tables(path:   str,
+                   tables: dict):
+    """Stores the tables in the versioned on-disk format: a directory with one .npy file per table and meta.json with the grid metadata.
+    Args:
+        path (str):    Directory to store the tables in.
+        tables (dict): The x_grid, f_nu_grid, f_sigma_grid arrays.
+    """
+    _check_tables(tables)
+    os.makedirs(path, exist_ok=True)
+
+    for key, file in TABLE_FILES.items():
+        np.save(os.path.join(path, file), np.ascontiguousarray(tables[key], dtype=np.float64))
+
+    x    = tables['x_grid']
+    meta = {'format_version': TABLE_FORMAT_VERSION,
+            'start':          float(x[0]),
+            'stop':           float(x[-1]),
+            'dx':             float(x[1] - x[0]),
+            'N':              int(len(x))}
+    with open(os.path.join(path, 'meta.json'), 'w') as file:
+        json.dump(meta, file, indent=4)
+
+def open_tg_tables(path: str,
+                   mmap: bool = True) -> dict:
+    """Opens the tables stored by save_tg_tables.
+       With mmap the arrays are memory-mapped read-only, so all the processes opening the same tables share one physical copy
+       through the page cache and start without reading the files.
+    Args:
+        path (str):            Directory the tables are stored in.
+        mmap (bool, optional): Memory-map the tables instead of loading them. Defaults to True.
+    Raises:
+        ValueError: The format version is not supported or the tables do not match their metadata.
+    Returns:
+        A dict with the x_grid, f_nu_grid, f_sigma_grid arrays that can be passed to the engine as kwargs.
+    """
+    with open(os.path.join(path, 'meta.json')) as file:
+        meta = json.load(file)
+
+    if meta.get('format_version') != TABLE_FORMAT_VERSION:
+        raise ValueError(f"Unsupported format version {meta.get('format_version')} of the tables in {path}, "
+                         f"expected {TABLE_FORMAT_VERSION}.")
+
+    tables = {key: np.load(os.path.join(path, file), mmap_mode='r' if mmap else None) for key, file in TABLE_FILES.items()}
+    _check_tables(tables, meta)
+    return tables
+
+def get_tg_tables(path: str,
+                  stop: float = 100.,
+                  N:    int   = 5_000_000,
+                  mmap: bool  = True) -> dict:
+    """Opens the tables stored in path, building and storing them first if they do not exist yet.
+    Args:
+        path (str):             Directory of the tables.
+        stop (float, optional): Last point of the \psi grid used if the tables have to be built. Defaults to 100..
+        N (int, optional):      Number of points of the grid used if the tables have to be built. Defaults to 5_000_000.
+        mmap (bool, optional):  Memory-map the tables instead of loading them. Defaults to True.
+    Returns:
+        A dict with the x_grid, f_nu_grid, f_sigma_grid arrays that can be passed to the engine as kwargs.
+    """
+    if not os.path.exists(os.path.join(path, 'meta.json')):
+        save_tg_tables(path, build_tg_tables(stop, N))
+    return open_tg_tables(path, mmap)
+
+def _check_tables(tables: dict,
+                  meta:   dict = None):
+    """Checks the assumptions simulate_heston_andersen_tg makes about the tables: equal lengths and
+       a uniform grid starting at 0, since the kernel looks the tables up with int(Psi/dx)."""
+    x = tables['x_grid']
+    if len(x) < 2 or any(len(tables[key]) != len(x) for key in TABLE_FILES):
+        raise ValueError("The tables must have the same length of at least 2.")
+    if x[0] != 0.:
+        raise ValueError(f"The grid must start at 0, got {x[0]}: the kernel computes the index as int(Psi/dx).")
+
+    dx = x[1] - x[0]
+    if abs(x[-1] - (len(x) - 1)*dx) > 1e-6*x[-1]:
+        raise ValueError("The grid must be uniform.")
+    if meta is not None and (meta['N'] != len(x) or meta['start'] != x[0] or meta['stop'] != x[-1] or meta['dx'] != dx):
+        raise ValueError("The tables do not match their metadata.")